@@ -1,20 +1,98 @@
 ﻿from __future__ import division   
 from PyQt4 import QtCore
-from drivepy.thorlabs.aptlib import AptPiezo, AptMotor
-from drivepy.thorlabs.aptlib import aptconsts as consts
-#from drivepy.newfocus.powermeter import PowerMeter
-from drivepy.newport.powermeter import PowerMeter
+from simulator import SIMULATE
+if SIMULATE:
+    from simulator import AptPiezo, AptMotor, aptconsts as consts, PowerMeter, simulatedTime as time
+else:
+    from time import time
+    from drivepy.thorlabs.aptlib import AptPiezo, AptMotor
+    from drivepy.thorlabs.aptlib import aptconsts as consts
+    #from drivepy.newfocus.powermeter import PowerMeter
+    from drivepy.newport.powermeter import PowerMeter
+from asyncinstrument import asyncCall, gather
+import threading
 from numpy import *
 from scipy import optimize
 import matplotlib.pyplot as plt
 
 X_CHANNEL=0
 Y_CHANNEL=1
+NEIGHBOURS=[(-1,-1),(-1,0),(-1,1),(0,1),(1,1),(1,0),(1,-1),(0,-1)]  # (y,x) index offsets of the 8 points adjacent to a grid point, going around them
 MOTOR_TRAVEL=4.0
 FIRST_SIGNAL_RESOLUTION=0.02  # default resolution in mm for first signal search
+ALIGN_METHOD="model"          # default search used by autoalign: "model" (modelSearch) or "grid" (hill-climbing with searchGrid)
+MODEL_MAX_EVALUATIONS=25      # maximum number of profit measurements made by modelSearch
+MODEL_INITIAL_RADIUS=4        # initial trust region radius for modelSearch as a multiple of the resolution
+MODEL_EXPAND=2.0              # factor the trust region grows by when a proposed point improves the profit
+MODEL_SHRINK=0.5              # factor the trust region shrinks by when a proposed point doesn't improve the profit
+CONTINUOUS_SEARCH=False       # MotorAlign.findFirstSignal scans each line with the motor moving continuously instead of stopping at each point
+SCAN_SAMPLES_PER_POINT=2      # number of profit readings to aim for per grid point during a continuous scan
+SEARCH_PATTERN="pyramid"      # MotorAlign.findFirstSignal search: "raster" (measureGrid), "spiral" or "pyramid" (coarse to fine spirals)
+PYRAMID_COARSE_FACTOR=8       # default coarse resolution of the pyramid search as a multiple of the final resolution
+PYRAMID_REFINE_COUNT=3        # number of the most promising points which are refined at each level of the pyramid search
+ADAPTIVE_MIN_TAU=50           # averaging time in ms of each of the short power meter readings made by adaptiveProfitFunction
+ADAPTIVE_MIN_READINGS=3       # minimum number of readings averaged by adaptiveProfitFunction before it can stop
+ADAPTIVE_CONFIDENCE=2.0       # half-width of the confidence interval of the mean reading in standard errors
+ADAPTIVE_PRECISION=0.005      # relative half-width of the confidence interval which is always good enough
+# Motion cost model of the stages: time for each axis to accelerate and settle in s, and velocity in mm/s (motor) or um/s (piezo)
+MOTOR_SETTLE_TIME=0.15
+MOTOR_VELOCITY=1.0
+PIEZO_SETTLE_TIME=0.01
+PIEZO_VELOCITY=1000.0
+SIMULTANEOUS_MOVES=True       # _Align.moveTo moves the x and y axes at the same time instead of one after the other
 
 class SignalTooWeakError(Exception): pass
-class PiezoControl(AptPiezo):
+
+def adaptiveProfitFunction(pm,tau,minTau=ADAPTIVE_MIN_TAU,**kwargs):
+    """ Return a profit function which reads the power meter pm with short averaging times of minTau [ms] and keeps averaging them only
+    until the confidence interval of the mean is within ADAPTIVE_PRECISION of it, or is smaller than its difference from the best profit
+    returned so far (so that it's clear whether the point is better or worse), or until the total averaging time reaches tau [ms].
+    The best profit is remembered between calls, so a new profit function should be made for each alignment """
+    best=[None]
+    def profitFunction():
+        readings=[]
+        while True:
+            readings.append(pm.readPowerAuto(tau=minTau,**kwargs))
+            n=len(readings)
+            if n*minTau>=tau: break
+            if n>=ADAPTIVE_MIN_READINGS:
+                mean=sum(readings)/n
+                halfWidth=ADAPTIVE_CONFIDENCE*std(readings,ddof=1)/sqrt(n)
+                if halfWidth<=ADAPTIVE_PRECISION*abs(mean): break
+                if best[0] is not None and halfWidth<abs(mean-best[0]): break
+        profit=sum(readings)/len(readings)
+        if best[0] is None or profit>best[0]: best[0]=profit
+        return profit
+    return profitFunction
+
+def _setPositionsConcurrently(ctrl,channels,positions):
+    """ Move each of the channels of ctrl to its position with blocking setPositions, and wait for all of them. A controller object
+    can't be used from two threads at once, so the channels driven by the same controller object are moved one after the other, and only
+    the moves on separate controller objects (given by ctrl.channelController(channel) if it has one) are made at the same time """
+    channelController=getattr(ctrl,"channelController",lambda channel: ctrl)
+    groups=[]       # (controller,[(channel,position),...]) for each of the controller objects
+    for channel,position in zip(channels,positions):
+        controller=channelController(channel)
+        moves=[m for c,m in groups if c is controller]
+        if moves: moves[0].append((channel,position))
+        else: groups.append((controller,[(channel,position)]))
+    def move(controller,moves):
+        for channel,position in moves: controller.setPosition(channel,position)
+    if len(groups)==1: move(*groups[0])
+    else: gather(*[asyncCall(move,controller,moves) for controller,moves in groups])
+
+class _SerializedControl(object):
+    """ Mixin for the APT controls which holds a lock on the controller object while talking to it, so that the blocking moves made on
+    worker threads are never interleaved with other calls such as getPosition from the main thread """
+    def __init__(self,*args,**kwargs):
+        self.lock=threading.RLock()
+        super(_SerializedControl, self).__init__(*args,**kwargs)
+    def getPosition(self,channel):
+        with self.lock: return super(_SerializedControl, self).getPosition(channel)
+    def setPosition(self,channel,position):
+        with self.lock: return super(_SerializedControl, self).setPosition(channel,position)
+
+class PiezoControl(_SerializedControl,AptPiezo):
     """ Convenience class inherited from aptlib.AptPiezo to allow customization""" 
     def __init__(self,autoZero,*args,**kwargs):
         super(PiezoControl, self).__init__(*args,**kwargs)      
@@ -25,15 +103,33 @@ class PiezoControl(AptPiezo):
             if autoZero: self.zero(ch)
             # Initialize to center
             self.moveToCenter(ch)
+    if not hasattr(AptPiezo,"setPositions"):
+        setPositions=_setPositionsConcurrently
 
-class MotorControl(AptMotor):
+class MotorControl(_SerializedControl,AptMotor):
     """ Convenience class inherited from aptlib.AptMotor to allow customization"""
     def __init__(self,autoZero,*args,**kwargs):
         super(MotorControl, self).__init__(*args,**kwargs)
+        self._moves={}
         for ch in range(len(self.channelAddresses)):
             if autoZero: 
                 self.zero(ch)
                 self.setPosition(ch,self.GetMaxTravel()/2)
+    if not hasattr(AptMotor,"setPositions"):
+        setPositions=_setPositionsConcurrently
+    if not hasattr(AptMotor,"startMove"):
+        # The APT library moves block until they're finished, so for continuous scans they are run on a worker thread instead. The
+        # worker holds the controller lock for the whole move, so getPosition waits for the move to finish rather than polling it
+        def startMove(self,channel,position):
+            """ Start moving channel to position and return without waiting for it to get there """
+            self._moves[channel]=asyncCall(self.setPosition,channel,position)
+        def isMoving(self,channel):
+            move=self._moves.get(channel)
+            return move is not None and not move.ready()
+        def stopMove(self,channel):
+            """ Wait for the move started by startMove to finish (it can't be interrupted), re-raising any error from it """
+            move=self._moves.pop(channel,None)
+            if move is not None: move.get()
     def GetMaxTravel(self,channel=0):
         """ Get the max travel of the stepper motor stage """
         return MOTOR_TRAVEL
@@ -42,35 +138,84 @@ class MotorControl(AptMotor):
         y=self.getPosition(Y_CHANNEL)
         return (x,y)
 
+class MotionCostModel(object):
+    """ Model of the time a stage takes to move between points, where each axis that moves takes a fixed settle time plus the distance
+    over the velocity, and the axes are either moved at the same time (simultaneous, as in _Align.moveTo) or one after the other """
+    def __init__(self,settleTime,velocity,simultaneous=SIMULTANEOUS_MOVES):
+        self.settleTime=settleTime
+        self.velocity=velocity
+        self.simultaneous=simultaneous
+
+    def moveTime(self,p0,p1):
+        """ Time to move from p0 to p1, or from p0 to each of the points in the array p1 """
+        d=abs(asarray(p1,dtype=float)-asarray(p0,dtype=float))
+        t=where(d>0,self.settleTime+d/self.velocity,0)
+        return t.max(axis=-1) if self.simultaneous else t.sum(axis=-1)
+
+    def pathTime(self,points,start):
+        """ Time to move from start through each of the points in turn """
+        path=vstack([start,points])
+        return self.moveTime(path[:-1],path[1:]).sum()
+
+    def order(self,points,start):
+        """ Return the indices of the points in the order to visit them from start, going to the quickest point to move to each time """
+        points=asarray(points,dtype=float)
+        remaining=list(range(len(points)))
+        order=[]
+        position=start
+        while remaining:
+            nearest=remaining.pop(argmin(self.moveTime(position,points[remaining])))
+            order.append(nearest)
+            position=points[nearest]
+        return order
+
 class _Align(QtCore.QObject):
+    continuousScan=False
+    simultaneousMoves=SIMULTANEOUS_MOVES
+    searchPattern="raster"
+    motionCost=MotionCostModel(PIEZO_SETTLE_TIME,PIEZO_VELOCITY)
     def __init__(self,*args,**kwargs):
         super(_Align, self).__init__(*args,**kwargs)
       
-    def autoalign(self,p0=None,res=1,span=None,profitFunction=None):
-        """ Automatically align the piezo stage to get maximum value from profitFunction using a discrete search algorithm
+    def autoalign(self,p0=None,res=1,span=None,profitFunction=None,method=None,prior=None):
+        """ Automatically align the piezo stage to get maximum value from profitFunction
         input arguments are starting position p0 (x,y) tuple in um
         grid resolution in um
         grid span (i.e. +/- how much to search over) in um
-        a profitFunction method which gives the profit for optimization (e.g. the total power) """
+        a profitFunction method which gives the profit for optimization (e.g. the total power)
+        the search method, either "model" for modelSearch or "grid" for the discrete searchGrid (default ALIGN_METHOD)
+        an optional prior (points,profit) from an earlier alignment which is passed to modelSearch
+        The points and profits measured by the search are kept in self.profitMap """
         # Setup the input variables properly
         if p0 is None: p0=self.coordinates
         if span is None: span=self.ctrl.GetMaxTravel()/2
         if profitFunction is None: 
             pm=PowerMeter()
             profitFunction=lambda : pm.readPowerAuto()
-        # Create a discrete grid with specified span and resolution centered at p0
-        x,y=self.gridPoints(span,res,p0)
-        #x,y=self.gridPoints(maxTravel/2,ROUGH_GRID_RES,(maxTravel/2,maxTravel/2))
-        ix, iy = self.searchGrid(x,y,p0,profitFunction)
-        self.coordinates = (x[ix], y[iy])
+        if method is None: method=ALIGN_METHOD
+        if method=="model":
+            self.coordinates=self.modelSearch(p0,res,span,profitFunction,prior=prior)
+        else:
+            # Create a discrete grid with specified span and resolution centered at p0
+            x,y=self.gridPoints(span,res,p0)
+            #x,y=self.gridPoints(maxTravel/2,ROUGH_GRID_RES,(maxTravel/2,maxTravel/2))
+            I=zeros((len(y),len(x)))
+            ix, iy = self.searchGrid(x,y,p0,profitFunction,I)
+            self.coordinates = (x[ix], y[iy])
+            iyMeasured,ixMeasured=nonzero(I)
+            self.profitMap=(column_stack([x[ixMeasured],y[iyMeasured]]),I[iyMeasured,ixMeasured])
         self.moveTo(self.coordinates)
         finalProfit=profitFunction()
         # TO DO: send a pyqt signal when finished so it can be run in a separate thread
         return (self.coordinates,finalProfit)
 
-    def findFirstSignal(self,p0=None,res=FIRST_SIGNAL_RESOLUTION,span=None,profitFunction=None,threshold=None, softThreshold=None, plotFlag=False):
+    def findFirstSignal(self,p0=None,res=FIRST_SIGNAL_RESOLUTION,span=None,profitFunction=None,threshold=None, softThreshold=None, plotFlag=False, continuous=None,
+            pattern=None, coarseRes=None):
         """ Automatically look for the first sign of a signal by measuring across a grid, outwards from the center
-        point, and stopping the measurement prematurely if the threshold is exceeded for profitFunction """
+        point, and stopping the measurement prematurely if the threshold is exceeded for profitFunction.
+        The pattern (default self.searchPattern) is either "raster" which measures the grid line by line, "spiral" which measures it
+        in a square spiral out from p0, or "pyramid" which uses pyramidSearch starting at coarseRes.
+        If continuous is True then each line of the raster is measured while moving continuously (default self.continuousScan) """
         if p0 is None: p0=self.ctrl.getCoordinates()
         if span is None: span=self.ctrl.GetMaxTravel()/2
         if profitFunction is None: 
@@ -79,21 +224,41 @@ class _Align(QtCore.QObject):
         # If the current center point already has a signal then stop the search before it begins
         profit=profitFunction()
         if profit >threshold: return (self.ctrl.getCoordinates(),profit)
-        # Create grid points evenly spaced according to span and resolution about p0
-        x,y=self.gridPoints(span,res,p0)
-        #x=x[logical_and(x>=0,x<=self.ctrl.GetMaxTravel())]
-        #y=y[logical_and(y>=0,y<=self.ctrl.GetMaxTravel())]
-        # Permute the x values so that they start at the center and move outwards
-        xp,xip=self.permuteOutwards(x)
-        #yp,yip=self.permuteOutwards(y) # This may significantly slow down the motor movement
-        P=self.measureGrid(x,y,xip,profitFunction,threshold,softThreshold)
-        # Optionally plot the grid
-        if plotFlag:
-            plt.imshow(P,extent=[min(x),max(x),max(y),min(y)])
-            plt.show()
-        # Extract the maximum value
-        maxIdx=where(P==P.max())
-        self.coordinates=(x[maxIdx[1][0]],y[maxIdx[0][0]])
+        if pattern is None: pattern=self.searchPattern
+        if pattern=="spiral":
+            points=self.spiralPoints(span,res,p0)
+            P=self.measurePoints(points,profitFunction,threshold)
+            self.coordinates=tuple(points[argmax(P)])
+        elif pattern=="pyramid":
+            if coarseRes is None: coarseRes=res*PYRAMID_COARSE_FACTOR
+            points,P=self.pyramidSearch(p0,res,span,profitFunction,threshold,softThreshold,coarseRes)
+            # The pyramid only refines the most promising points, so if it missed the signal (or none of its points were within the
+            # stage travel) then fall back to the full raster
+            if not len(P):
+                print("No points of the pyramid search are within the stage travel, so searching the full grid...")
+                pattern="raster"
+            else:
+                self.coordinates=tuple(points[argmax(P)])
+                if threshold is not None and P.max()<threshold:
+                    print("Signal not found by the pyramid search, so searching the full grid...")
+                    pattern="raster"
+        if pattern=="raster":
+            # Create grid points evenly spaced according to span and resolution about p0
+            x,y=self.gridPoints(span,res,p0)
+            #x=x[logical_and(x>=0,x<=self.ctrl.GetMaxTravel())]
+            #y=y[logical_and(y>=0,y<=self.ctrl.GetMaxTravel())]
+            # Permute the x values so that they start at the center and move outwards
+            xp,xip=self.permuteOutwards(x)
+            #yp,yip=self.permuteOutwards(y) # This may significantly slow down the motor movement
+            if continuous is None: continuous=self.continuousScan
+            P=self.measureGrid(x,y,xip,profitFunction,threshold,softThreshold,continuous)
+            # Optionally plot the grid
+            if plotFlag:
+                plt.imshow(P,extent=[min(x),max(x),max(y),min(y)])
+                plt.show()
+            # Extract the maximum value
+            maxIdx=where(P==P.max())
+            self.coordinates=(x[maxIdx[1][0]],y[maxIdx[0][0]])
         # Move to the position of max value
         self.moveTo(self.coordinates)
         # Measure the profit again
@@ -101,6 +266,75 @@ class _Align(QtCore.QObject):
         return (self.coordinates,finalProfit)
 
 
+    def pyramidSearch(self,p0,res,span,profitFunction,threshold=None,softThreshold=None,coarseRes=None):
+        """ Coarse to fine search which first measures a spiral over +/- span around p0 at coarseRes, and then refines the
+        PYRAMID_REFINE_COUNT most promising points (only those above softThreshold, if any are) with spirals over +/- the previous 
+        resolution at half of it, until the resolution reaches res. The points to refine are visited in the order which minimizes the
+        stage travel time according to self.motionCost. Stop as soon as the profit is above threshold.
+        Return (points,profit) for all of the points measured """
+        if coarseRes is None: coarseRes=res*PYRAMID_COARSE_FACTOR
+        levelRes=maximum(coarseRes,res)
+        levelSpan=span
+        centers=[p0]
+        position=array(p0,dtype=float)
+        measured=zeros((0,2))
+        profit=zeros(0)
+        while True:
+            levelPoints=zeros((0,2))
+            levelProfit=zeros(0)
+            for idx in self.motionCost.order(centers,position):
+                points=self.spiralPoints(levelSpan,levelRes,centers[idx])
+                # Don't measure points again which were measured at a previous level
+                if len(measured):
+                    points=points[(abs(points[:,newaxis,:]-measured[newaxis,:,:]).max(axis=2)>res/2).all(axis=1)]
+                P=self.measurePoints(points,profitFunction,threshold)
+                measured=vstack([measured,points])
+                profit=concatenate([profit,P])
+                levelPoints=vstack([levelPoints,points])
+                levelProfit=concatenate([levelProfit,P])
+                if len(points): position=points[-1]
+                if threshold is not None and (P>=threshold).any():
+                    return (measured,profit)
+            if levelRes<=res or not len(levelProfit): break
+            # Refine around the best points of this level
+            best=argsort(levelProfit)[::-1][:PYRAMID_REFINE_COUNT]
+            if softThreshold is not None and (levelProfit>=softThreshold).any():
+                best=best[levelProfit[best]>=softThreshold]
+            centers=levelPoints[best]
+            levelSpan=levelRes
+            levelRes=maximum(levelRes/2,res)
+        return (measured,profit)
+
+    def spiralPoints(self,span,res,center):
+        """ Return an (n,2) array of the points on the square grid with extent +/- span spaced at res and centered at center, in the 
+        order of a square spiral outwards from the center, so that each point is a single step from the last. Points outside of the
+        stage travel are left out """
+        n=int(round(span/res))
+        points=[(0,0)]
+        ix=iy=0
+        for ring in range(1,n+1):
+            # Step out to the next ring and go around it
+            ix+=1
+            points.append((ix,iy))
+            for dx,dy,steps in [(0,1,2*ring-1),(-1,0,2*ring),(0,-1,2*ring),(1,0,2*ring)]:
+                for step in range(steps):
+                    ix+=dx
+                    iy+=dy
+                    points.append((ix,iy))
+        points=array(center,dtype=float)+res*array(points,dtype=float)
+        rMax=self.ctrl.GetMaxTravel()
+        return points[logical_and(points>=0,points<=rMax).all(axis=1)]
+
+    def measurePoints(self,points,profitFunction,threshold=None):
+        """ Measure the profit at each of the (x,y) points in turn, and stop prematurely if a threshold is given and the profit exceeds it """
+        profit=zeros(len(points))
+        for idx in range(len(points)):
+            self.moveTo(points[idx])
+            profit[idx]=profitFunction()
+            if threshold is not None and profit[idx]>=threshold:
+                break
+        return profit
+
     def searchGrid(self,x,y,p0,profitFunction, I=None):
         """ Use a discrete search algorithm which creates a grid specified by the x,y vectors, starts at a point p0 on the grid,
         then measures the profit at each of the 8 immediately adjacent grid points. If any of these points have a greater profit then
@@ -108,7 +342,10 @@ class _Align(QtCore.QObject):
         or a local maxima has been found. Return a tuple with (x,y) coordinate of maxmima"""
         # Create empty array for intensity over the grid and boolean array to keep track of which points have been measured
         if I is None: I=zeros((len(y),len(x)))
-        Imask=I!=I
+        Imask=zeros(I.shape,dtype=bool)
+        # Precompute the grid points which are within the stage travel, so the search loop only has to look them up
+        rMax=self.ctrl.GetMaxTravel()
+        valid=logical_and.outer(logical_and(y>=0,y<=rMax),logical_and(x>=0,x<=rMax))
         # Find the x and y indices for the closest point on the grid to p0
         ix0=argmin(abs(x-p0[0]))
         iy0=argmin(abs(y-p0[1]))
@@ -116,60 +353,187 @@ class _Align(QtCore.QObject):
         self.moveTo(p0)
         I[iy0,ix0]=profitFunction()
         Imask[iy0,ix0]=True
-        while Imask.any():
-            # Measure all points immediately adjacent to current index if they haven't been measured yet
-            for ix in [-1,0,1]+array(ix0):
-                for iy in [-1,0,1]+array(iy0):
-                    try:
-                        if not Imask[iy,ix]:
-                            rMax=self.ctrl.GetMaxTravel()
-                            if ix >= 0 and iy >= 0 and ix < len(x) and iy < len(y):
-                                if x[ix]>=0 and y[iy]>=0 and x[ix]<=rMax and y[iy]<=rMax:
-                                    self.moveTo((x[ix],y[iy]))
-                                    I[iy,ix]=profitFunction()
-                                Imask[iy,ix]=True
-                            else:
-                                print('Index out of bounds: (%d, %d)'%(ix, iy))
-                    except IndexError:
-                        # Just ignore any points which are out of bounds
-                        pass
-            # Find the point with maximum profit on the grid measured so far
-            iyMax,ixMax=where(I==I.max())
-            ixMax=ixMax[0]
-            iyMax=iyMax[0]
+        # Keep track of the maximum measured so far, rather than searching the whole grid for it after each step
+        iyMax,ixMax=iy0,ix0
+        while True:
+            # Measure all points immediately adjacent to current index if they are on the grid and haven't been measured yet
+            for dy,dx in NEIGHBOURS:
+                iy,ix=iy0+dy,ix0+dx
+                if 0<=iy<len(y) and 0<=ix<len(x) and valid[iy,ix] and not Imask[iy,ix]:
+                    self.moveTo((x[ix],y[iy]))
+                    I[iy,ix]=profitFunction()
+                    Imask[iy,ix]=True
+                    if I[iy,ix]>I[iyMax,ixMax]:
+                        iyMax,ixMax=iy,ix
             # If the center of the grid is the maximum then stop the optimization here, otherwise set maximum point as new center
-            if I.max() > 0:
-                if iyMax==iy0 and ixMax==ix0:
-                    break
-                else:
-                    ix0=ixMax
-                    iy0=iyMax
-            else:
-                test=profitFunction()
-                pass
-        # Set maximum point from optimization as new coordinates
-        assert ixMax==ix0 and iyMax==iy0
+            if iyMax==iy0 and ixMax==ix0:
+                break
+            ix0=ixMax
+            iy0=iyMax
         return (ixMax, iyMax)
-   
+
+    def modelSearch(self,p0,res,span,profitFunction,maxEvaluations=MODEL_MAX_EVALUATIONS,prior=None):
+        """ Trust region search which fits a 2D gaussian coupling model (a quadratic in log(profit)) to all of the points measured
+        so far and moves towards the peak of the model, within a radius around the best point which grows when the new point improves
+        the profit and shrinks when it doesn't. Stops when the model peak is within res/2 of the best point, the radius is below res/2, 
+        or after maxEvaluations profit measurements. Only points within +/- span of p0 and the stage travel are measured.
+        An optional prior (points,profit) measured in an earlier alignment (and already shifted by any expected drift) is included in
+        the fit with its own scale, so that only a few new points are needed to start with.
+        Return a tuple with (x,y) coordinate of the best point measured, and keep the points measured in self.profitMap """
+        rMax=self.ctrl.GetMaxTravel()
+        lower=maximum(array(p0,dtype=float)-span,0)
+        upper=minimum(array(p0,dtype=float)+span,rMax)
+        points=[]
+        profits=[]
+        def measure(p):
+            p=clip(p,lower,upper)
+            self.moveTo(p)
+            points.append(p)
+            profits.append(profitFunction())
+        # Start with p0 and a stencil around it which has the 6 points needed to fit the quadratic, or just enough for the
+        # scale and gradient if there's a prior which gives the shape
+        best=clip(array(p0,dtype=float),lower,upper)
+        stencil=[(0,0),(1,0),(-1,0),(0,1),(0,-1),(1,1)] if prior is None else [(0,0),(1,0),(0,1)]
+        for d in stencil:
+            measure(best+res*array(d))
+        radius=minimum(MODEL_INITIAL_RADIUS*res,span)
+        while len(profits)<maxEvaluations and radius>=res/2:
+            iBest=argmax(profits)
+            best=points[iBest]
+            step=self._modelStep(array(points)-best,array(profits),radius,None if prior is None else (asarray(prior[0])-best,asarray(prior[1])))
+            if step is None: break
+            if sqrt(sum((clip(best+step,lower,upper)-best)**2))<res/2: break
+            measure(best+step)
+            if profits[-1]>profits[iBest]:
+                radius=minimum(radius*MODEL_EXPAND,span)
+            else:
+                radius*=MODEL_SHRINK
+        self.profitMap=(array(points),array(profits))
+        return tuple(points[argmax(profits)])
+
+    def _modelStep(self,d,profit,radius,prior=None):
+        """ Fit a quadratic to the profit (or its log, which makes it a gaussian, when all of the profits are positive) at the
+        displacements d from the best point, and return the displacement towards the peak of the fit limited to radius. If the fit
+        has no maximum then step radius along the gradient instead, or return None if not even a gradient can be fitted.
+        The optional prior (displacements,profit) is fitted with the same curvature but its own offset and gradient, so that it
+        gives the shape of the peak while its position comes from the new points """
+        isNew=ones(len(profit))
+        if prior is not None:
+            isNew=concatenate([isNew,zeros(len(prior[1]))])
+            d=vstack([d,prior[0]])
+            profit=concatenate([profit,prior[1]])
+        z=log(profit) if (profit>0).all() else profit
+        dx,dy=d[:,0],d[:,1]
+        linear=[isNew,isNew*dx,isNew*dy]
+        if prior is not None:
+            linear+=[1-isNew,(1-isNew)*dx,(1-isNew)*dy]
+        n=len(linear)+3
+        if len(z)>=n:
+            A=column_stack(linear+[dx**2,dx*dy,dy**2])
+            c,residuals,rank,sv=linalg.lstsq(A,z)
+            if rank==n:
+                g=c[1:3]
+                H=array([[2*c[-3],c[-2]],[c[-2],2*c[-1]]])
+                if (linalg.eigvalsh(H)<0).all():
+                    step=-linalg.solve(H,g)
+                    stepSize=sqrt(sum(step**2))
+                    return step*radius/stepSize if stepSize>radius else step
+                # No maximum, so go uphill as far as the trust region allows
+                if g.any(): return g*radius/sqrt(sum(g**2))
+        A=column_stack(linear)
+        c,residuals,rank,sv=linalg.lstsq(A,z)
+        g=c[1:3]
+        if rank<len(linear) or not g.any(): return None
+        return g*radius/sqrt(sum(g**2))
+
     def measureLine(self,channel,r,profitFunction,threshold=None):
         """ Given a channel, and a vector of positions, measure the profit function at all points on the given channel. 
         Stop the measurement prematurely if a threshold is given and the profit exceeds it"""
         profit=zeros(shape(r))
+        inRange=logical_and(r>=0,r<=self.ctrl.GetMaxTravel())
         for idx in range(len(r)):
-            if r[idx]>=0 and r[idx]<=self.ctrl.GetMaxTravel():
+            if inRange[idx]:
                 self.move1d(channel,r[idx])
                 profit[idx]=profitFunction()
             if threshold!=None and profit[idx]>=threshold:
                 return profit
         return profit
 
-    def measureGrid(self,x,y,xOrder,profitFunction,threshold=None, softThreshold=None):
-        """ Measure the profit vs position on a grid specified by x and y vectors and optionally stop if the profit is above a certain threshold"""
+    def scanLine(self,channel,r,profitFunction,threshold=None):
+        """ Measure the profit at all points in r on the given channel like measureLine, but with the stage moving continuously from
+        r[0] to r[-1]. Each reading is timestamped, and placed at the position interpolated at its timestamp from the (timestamped) encoder
+        positions read between the readings, so the stage doesn't need to move at a constant rate. The line is then reconstructed by
+        reconstructLine. If the stage allows its velocity to be set then it's set to give SCAN_SAMPLES_PER_POINT readings per point,
+        using the time taken by the first reading (e.g. with the averaging time chosen by an adaptive profit function); otherwise the stage
+        moves at its current velocity. Stop the scan prematurely if a threshold is given and the profit exceeds it """
+        rMax=self.ctrl.GetMaxTravel()
+        inRange=logical_and(r>=0,r<=rMax)
+        if not inRange.any(): return zeros(shape(r))
+        start,stop=r[inRange][0],r[inRange][-1]
+        self.move1d(channel,start)
+        track=[]        # (time,position) of each encoder reading
+        readings=[]     # (time,profit) of each profit reading, with the time in the middle of the reading
+        def readPosition():
+            t=time()
+            position=self.ctrl.getPosition(channel)
+            track.append(((t+time())/2,position))
+        def read():
+            t=time()
+            profit=profitFunction()
+            readings.append(((t+time())/2,profit))
+            readPosition()
+        readPosition()
+        read()
+        if start!=stop and (threshold is None or readings[-1][1]<threshold):
+            # Set the velocity for the scan if the stage allows it, and restore it afterwards
+            velocity=self.ctrl.getVelocity(channel) if hasattr(self.ctrl,"setVelocity") else None
+            sampleTime=track[-1][0]-track[0][0]
+            if velocity is not None and sampleTime>0: self.ctrl.setVelocity(channel,abs(r[1]-r[0])/(SCAN_SAMPLES_PER_POINT*sampleTime))
+            try:
+                self.ctrl.startMove(channel,stop)
+                while self.ctrl.isMoving(channel):
+                    read()
+                    if threshold is not None and readings[-1][1]>=threshold: break
+            finally:
+                self.ctrl.stopMove(channel)
+                if velocity is not None: self.ctrl.setVelocity(channel,velocity)
+            read()
+        track=array(track)
+        readings=array(readings)
+        positions=interp(readings[:,0],track[:,0],track[:,1])
+        profit=self.reconstructLine(r,positions,readings[:,1])
+        profit[logical_not(inRange)]=0
+        return profit
+
+    def reconstructLine(self,r,positions,readings):
+        """ Reconstruct the profit at the points r from readings taken at arbitrary positions, using the maximum of the readings
+        closest to each point and interpolating at points which don't have any. Points outside of the positions are set to zero """
+        profit=zeros(shape(r))
+        nearest=argmin(abs(positions[:,newaxis]-r[newaxis,:]),axis=1)
+        for idx,reading in zip(nearest,readings):
+            profit[idx]=maximum(profit[idx],reading)
+        missing=ones(shape(r),dtype=bool)
+        missing[nearest]=False
+        order=argsort(positions)
+        profit[missing]=interp(r[missing],positions[order],readings[order],left=0,right=0)
+        return profit
+
+    def measureGrid(self,x,y,xOrder,profitFunction,threshold=None, softThreshold=None, continuous=False):
+        """ Measure the profit vs position on a grid specified by x and y vectors and optionally stop if the profit is above a certain threshold.
+        Each line in y is measured starting from whichever end is closer to where the last one finished, so that the y axis goes back and
+        forth instead of returning to the start of every line. If continuous is True then each line is measured with scanLine instead of measureLine """
         profit=zeros((len(y),len(x)))
+        inRange=logical_and(x>=0,x<=self.ctrl.GetMaxTravel())
+        yLast=self.ctrl.getPosition(Y_CHANNEL)
         for ix in xOrder:
-            if x[ix]>=0 and x[ix]<=self.ctrl.GetMaxTravel():
+            if inRange[ix]:
                 self.move1d(X_CHANNEL,x[ix])
-                profit[:,ix]=self.measureLine(Y_CHANNEL,y,profitFunction,threshold)
+                yOrder=slice(None,None,-1) if abs(y[-1]-yLast)<abs(y[0]-yLast) else slice(None)
+                if continuous:
+                    profit[yOrder,ix]=self.scanLine(Y_CHANNEL,y[yOrder],profitFunction,threshold)
+                else:
+                    profit[yOrder,ix]=self.measureLine(Y_CHANNEL,y[yOrder],profitFunction,threshold)
+                yLast=y[yOrder][-1]
             if not threshold is None and max(profit[:,ix])>=threshold:
                 return profit
             if not threshold is None and not softThreshold is None and max(profit[:,ix]) >= softThreshold:
@@ -203,9 +567,12 @@ class _Align(QtCore.QObject):
         """ Move y coordinate to y """
         self.move1d(Y_CHANNEL,y)
     def moveTo(self,pos):
-        """ Move to x,y coords given by pos """
-        self.moveX(pos[0])
-        self.moveY(pos[1])
+        """ Move to x,y coords given by pos, moving both axes at the same time if simultaneousMoves is set """
+        if self.simultaneousMoves:
+            self.ctrl.setPositions((X_CHANNEL,Y_CHANNEL),(pos[0],pos[1]))
+        else:
+            self.moveX(pos[0])
+            self.moveY(pos[1])
     def gridPoints(self,span,res,center):
         """ Return (x,y) points for square grid with extent +/- span spaced at res, and centered at center """
         d=linspace(-span,span,round(2*span/res+1))
@@ -240,9 +607,18 @@ class PiezoAlign(_Align):
         self.ctrl=PiezoControl(autoZero)
         self.coordinates=(self.ctrl.getPosition(X_CHANNEL),self.ctrl.getPosition(Y_CHANNEL))
 
+    def moveToCenter(self):
+        """ Move all channels to the center of their travel, as done when the controller is first initialized """
+        for ch in range(len(self.ctrl.channelAddresses)):
+            self.ctrl.moveToCenter(ch)
+        self.coordinates=(self.ctrl.getPosition(X_CHANNEL),self.ctrl.getPosition(Y_CHANNEL))
+
 class MotorAlign(_Align):
     """Class that does automatic alignment by using a stepping motor controller to set the position to optimize a profitFunction 
     The position should be specified in mm"""
+    continuousScan=CONTINUOUS_SEARCH
+    searchPattern=SEARCH_PATTERN
+    motionCost=MotionCostModel(MOTOR_SETTLE_TIME,MOTOR_VELOCITY)
     def __init__(self,autoZero=False,*args,**kwargs):
         super(MotorAlign, self).__init__(*args,**kwargs)
         self.ctrl=MotorControl(autoZero)
@@ -0,0 +1,103 @@
+from __future__ import division
+import threading
+from numpy import nan
+from measurement import Measurement, SMU, FineAlignPowerMeter, ALIGNMENT_CURRENT, ALIGNMENT_TAU, ALIGNMENT_TAU_LOWTEMP, LOWTEMP_THRESHOLD, \
+    REALIGNMENT_LOSS_THRESHOLD
+
+ALIGNMENT_SERVICE_PROBE_INTERVAL=60   # Time in s between readings of the coupling by the background alignment service
+ALIGNMENT_SERVICE_ROUGH_FRACTION=0.5  # Fraction of the power after the last alignment, below which a fine alignment is followed by a rough one
+
+class _ServiceAlignment(Measurement):
+    """ Measurement without any data, which the AlignmentService uses for its alignment routines and instrument leases """
+    def __init__(self,info,service,parent=None,lock=None):
+        info["type"]="Alignment"
+        super(_ServiceAlignment, self).__init__(info,False,parent=parent,lock=lock)
+        self.piezoAlignObject=None
+        self.service=service
+
+    def _alignmentTemperature(self):
+        """ The temperature reported to the service, since whoever runs it is already reading the temperature controller """
+        return self.service.temperature
+
+class AlignmentService(object):
+    """ Keeps the fiber coupling optimal in a background thread while the stages are otherwise idle, e.g. while a profile waits for the
+    temperature to stabilize. The coupling at the fine align current is read every probeInterval [s], and if it has dropped by more than
+    REALIGNMENT_LOSS_THRESHOLD since the last alignment then a fine alignment is done, followed by a rough alignment and another fine
+    alignment if the coupling has mostly been lost. The instruments are leased from the pool only for each cycle, and stop() waits for
+    a cycle in progress to finish, so a measurement started after it starts from an aligned position. If the service has aligned with
+    at least ALIGNMENT_SIGNAL_SEARCH_THRESH of power then the measurements keep that position instead of centering the piezo and rough
+    aligning again, and their fine alignments are warm started from the profit maps recorded by the service.
+    The status messages of the service are connected to the optional statusMessage slot (or signal) """
+    def __init__(self,parent,lock,pool,info=None,probeInterval=ALIGNMENT_SERVICE_PROBE_INTERVAL,statusMessage=None):
+        self.main=parent
+        self.lock=lock
+        self.pool=pool
+        self.info=info if info is not None else {}
+        self.probeInterval=probeInterval
+        self.statusMessage=statusMessage
+        self.temperature=nan
+        self.alignedPower=None
+        self.numAlignments=0
+        self.lastError=None
+        self.alignment=None
+        self._stop=threading.Event()
+        self._thread=None
+
+    def start(self):
+        """ Start the service thread, with the first cycle aligning straight away """
+        if self.running(): return
+        self.alignedPower=None
+        self.alignment=_ServiceAlignment(dict(self.info,Name="Background alignment"),self,parent=self.main,lock=self.lock)
+        self.alignment.pool=self.pool
+        if self.statusMessage is not None: self.alignment.progressMessage.connect(self.statusMessage)
+        self._stop.clear()
+        self._thread=threading.Thread(target=self._run,name="AlignmentService")
+        self._thread.daemon=True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the service, waiting for an alignment in progress to finish """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread=None
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.cycle()
+            except Exception as e:
+                # Keep the service going, since the next cycle will lease (and reconnect) the instruments again
+                self.lastError=e
+                self.alignment.sendStatusMessage("Background alignment failed: "+str(e))
+            self._stop.wait(self.probeInterval)
+
+    def cycle(self):
+        """ Read the coupling and realign if it has dropped. Return the power at the fine align current after the cycle """
+        alignment=self.alignment
+        # Average for longer with the cryostat on, as the measurements do (nan compares as cold, so the longer time is used if it's unknown)
+        alignment.cryostatOff=self.temperature > LOWTEMP_THRESHOLD
+        tau=ALIGNMENT_TAU if alignment.cryostatOff else ALIGNMENT_TAU_LOWTEMP
+        failed=True
+        try:
+            # Open the SMU with the same configuration as the spectrum measurements, so the pool doesn't reopen it for each of them
+            smu=alignment.openInstrument(SMU,autoZero=True,defaultCurrent=ALIGNMENT_CURRENT)
+            pm=alignment.openInstrument(FineAlignPowerMeter)
+            smu.setCurrent(self.info.get("fineAlignCurrent",ALIGNMENT_CURRENT))
+            smu.setOutputState("ON")
+            power=pm.readPowerAuto(tau=tau)
+            if self.alignedPower is None or power < (1-REALIGNMENT_LOSS_THRESHOLD)*self.alignedPower:
+                previousPower=self.alignedPower
+                power=alignment.fineAlign(smu=smu)
+                if previousPower is not None and power < ALIGNMENT_SERVICE_ROUGH_FRACTION*previousPower:
+                    alignment.roughAlign()
+                    power=alignment.fineAlign(smu=smu)
+                self.alignedPower=power
+                self.numAlignments+=1
+            failed=False
+        finally:
+            alignment.releaseInstruments(failed)
+        return power
@@ -0,0 +1,109 @@
+from __future__ import division
+import threading
+from time import sleep, time
+from multiprocessing.pool import ThreadPool
+from simulator import SIMULATE
+if SIMULATE:
+    from simulator import SimulatedAsyncResult
+
+NUM_WORKERS=4           # Number of worker threads used for asynchronous instrument calls
+
+_executor=None
+_executorLock=threading.Lock()
+
+def executor():
+    """ Return the thread pool shared by all asynchronous instrument calls, creating it the first time """
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            _executor=ThreadPool(NUM_WORKERS)
+    return _executor
+
+def asyncCall(func,*args,**kwargs):
+    """ Run the blocking func(*args,**kwargs) on the shared executor and return an AsyncResult straight away.
+    The result is read with .get(), which re-raises any exception from the call """
+    if SIMULATE:
+        # Keep the simulated time of the worker thread in step with the thread making the call
+        return SimulatedAsyncResult(executor().apply_async,func,args,kwargs)
+    return executor().apply_async(func,args,kwargs)
+
+def gather(*results):
+    """ Wait for all of the AsyncResults and return a list of their values, so that an exception in one of them doesn't leave
+    the others still running. If any of the calls failed then the first exception is re-raised """
+    for result in results:
+        result.wait()
+    return [result.get() for result in results]
+
+class AsyncInstrument(object):
+    """ Adapter for a blocking (drivepy) instrument whose methods return an AsyncResult instead of blocking, so that reads from
+    independent instruments can overlap. Calls to the same instrument are still run one at a time and in the order they were
+    made, since the instrument connections aren't thread safe """
+    def __init__(self,instrument):
+        self.instrument=instrument
+        self._lock=threading.Lock()
+        self._last=None
+
+    def __getattr__(self,name):
+        attr=getattr(self.instrument,name)
+        if not callable(attr):
+            return attr
+        def call(*args,**kwargs):
+            with self._lock:
+                previous=self._last
+                self._last=result=asyncCall(self._call,previous,attr,args,kwargs)
+            return result
+        return call
+
+    def _call(self,previous,method,args,kwargs):
+        """ Wait for the previous call to this instrument to finish and then make this one """
+        if previous is not None:
+            previous.wait()
+        return method(*args,**kwargs)
+
+class FakeInstrument(object):
+    """ Stand-in for an instrument when benchmarking, where each method in values sleeps for the latency [s] given in latencies
+    and then returns the value (or the result of calling it, if it's a function) """
+    def __init__(self,values,latencies=None):
+        self._values=values
+        self._latencies=latencies if latencies is not None else {}
+
+    def __getattr__(self,name):
+        if name.startswith("_") or name not in self._values:
+            raise AttributeError, name
+        def method(*args,**kwargs):
+            sleep(self._latencies.get(name,0))
+            value=self._values[name]
+            return value(*args,**kwargs) if callable(value) else value
+        return method
+
+def fakeInstruments(smuLatency=0.05,powerMeterLatency=0.4,dmmLatency=0.1,temperatureLatency=0.05):
+    """ Fake SMU, power meter, DMM and temperature controller with the specified latencies [s] for the per-point reads """
+    smu=FakeInstrument({"setCurrent":None,"measure":(1.5,10e-3)},{"setCurrent":smuLatency,"measure":smuLatency})
+    pm=FakeInstrument({"readPowerAuto":1e-3},{"readPowerAuto":powerMeterLatency})
+    dmm=FakeInstrument({"measure":0.1},{"measure":dmmLatency})
+    tempController=FakeInstrument({"getTemperature":295.0},{"getTemperature":temperatureLatency})
+    return smu,pm,dmm,tempController
+
+def benchmark(numPoints=10,**latencies):
+    """ Time numPoints of the per-point reads (temperature, IV, optical power and photocurrent) done one after the other and done
+    concurrently with the fake instruments, and return (sequential,concurrent) in seconds """
+    smu,pm,dmm,tempController=fakeInstruments(**latencies)
+    t0=time()
+    for i in range(numPoints):
+        tempController.getTemperature()
+        smu.setCurrent(i*1e-3)
+        smu.measure()
+        pm.readPowerAuto()
+        dmm.measure()
+    sequential=time()-t0
+    asyncSmu,asyncPm,asyncDmm,asyncTempController=[AsyncInstrument(inst) for inst in (smu,pm,dmm,tempController)]
+    t0=time()
+    for i in range(numPoints):
+        asyncSmu.setCurrent(i*1e-3).get()
+        gather(asyncTempController.getTemperature(),asyncSmu.measure(),asyncPm.readPowerAuto(),asyncDmm.measure())
+    concurrent=time()-t0
+    return sequential,concurrent
+
+if __name__=="__main__":
+    sequential,concurrent=benchmark()
+    print("Sequential: %.3fs, concurrent: %.3fs, speedup: %.2fx" % (sequential,concurrent,sequential/concurrent))
@@ -0,0 +1,257 @@
+from __future__ import division
+import os, sys, json, tempfile, shutil, platform, imp, argparse, sip
+sip.setapi("QString", 2)
+sip.setapi("QVariant", 2)
+from time import time
+from datetime import datetime
+# The benchmarks run headless against the simulated instruments, so this has to be set before any of the app modules are imported
+os.environ["LMS_SIMULATE"]="1"
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import numpy as np
+from scipy import constants as scipycsts
+from PyQt4 import QtCore
+import simulator
+import measurement
+from hakkipaoli import HakkiPaoli, peakDetect, peakClean
+from spefile import read_spe, read_spe_frames, write_spe
+
+DEFAULT_REPEATS=5               # Number of times each benchmark is timed (the median and best times are reported)
+DEFAULT_OUTPUT="benchmark.json" # File the results are written to
+REGRESSION_THRESHOLD=0.2        # Relative increase in the median time vs the baseline which is flagged as a regression
+
+# Registry of (name, setup function) in the order they are run. Each setup function prepares its data and returns the function to time
+BENCHMARKS=[]
+
+def benchmark(name):
+    """ Decorator which registers a setup function as a benchmark """
+    def register(setup):
+        BENCHMARKS.append((name,setup))
+        return setup
+    return register
+
+class _BenchmarkMain(QtCore.QObject):
+    """ Stand-in for the main window, with the attributes the measurements use from it """
+    def __init__(self):
+        super(_BenchmarkMain, self).__init__()
+        self.tempController=None
+        self.motorCoordinates=(0.0,0.0)
+        self.piezoCoordinates=(0.0,0.0)
+
+class _NullSignal(object):
+    def emit(self,*args): pass
+
+def _measurementInfo(name,**info):
+    """ Info dictionary for a synthetic measurement """
+    info.update({"Name":name,"groupName":"Benchmark"})
+    return info
+
+def _livData(numPoints,seed=0):
+    """ Synthetic LIV data from the simulator's laser model """
+    laser=simulator.LaserModel()
+    random=np.random.RandomState(seed)
+    current=np.linspace(0,60e-3,numPoints)
+    power=laser.outputPower(current,295)*(1+1e-3*random.randn(numPoints))
+    return {"iMeas":current,"vMeas":laser.voltage(current,295),"lMeas":power,"temperature":295.0}
+
+def _fabryPerotSpectrum(numPoints,L=375e-6,n=3.619):
+    """ Synthetic below-threshold Fabry-Perot spectrum [m], [a.u.] with a gaussian net gain around 1300nm """
+    x=np.linspace(1250e-9,1350e-9,numPoints)
+    PRG=0.9*np.exp(-(x-1300e-9)**2/(2*(20e-9)**2))
+    return (x,1/((1-PRG)**2+4*PRG*np.sin(2*np.pi*n*L/x)**2))
+
+def _rinMeasurement(numFreq,numCurrents):
+    """ Synthetic RinSpectrum with the ESA spectra calculated from the simulator's laser model """
+    meas=measurement.RinSpectrum(_measurementInfo("RIN",numCurrPoints=numCurrents,preampGain=100.0),parent=_BenchmarkMain())
+    laser=simulator.LaserModel()
+    freq=np.linspace(0,10e9,numFreq)
+    currents=np.linspace(20e-3,80e-3,numCurrents)
+    photoCurrent=laser.outputPower(currents,295)*simulator.PHOTODIODE_RESPONSIVITY
+    thermalNoise=4*scipycsts.k*295*np.ones(numFreq)
+    meas.data["wavelength"]=np.tile(freq[:,np.newaxis],(1,numCurrents))
+    meas.data["intensity"]=np.array([i**2*laser.rin(freq,c,295)*50 for i,c in zip(photoCurrent,currents)]).T+thermalNoise[:,np.newaxis]
+    meas.data["thermalNoisePower"]=thermalNoise
+    meas.data["photoCurrent"]=photoCurrent
+    meas.data["iMeas"]=currents
+    return meas
+
+@benchmark("liv_acquisition")
+def benchLivAcquisition():
+    """ LIV.acquireData against the simulated SMU, power meter and temperature controller """
+    def run():
+        meas=measurement.LIV(_measurementInfo("LIV",Istart=0,Istop=60e-3,numCurrPoints=50,Vcomp=3.0),parent=_BenchmarkMain(),lock=QtCore.QReadWriteLock())
+        meas.acquireData()
+    return run
+
+@benchmark("threshold_current")
+def benchThresholdCurrent():
+    meas=measurement.LIV(_measurementInfo("LIV"),parent=_BenchmarkMain())
+    meas.data=_livData(1000)
+    return meas.getThresholdCurrent
+
+@benchmark("hakki_paoli_gain")
+def benchHakkiPaoli():
+    x,y=_fabryPerotSpectrum(20000)
+    return HakkiPaoli(x,y).gainCalculation
+
+@benchmark("peak_detect_clean")
+def benchPeakDetectClean():
+    x,y=_fabryPerotSpectrum(100000)
+    return lambda: peakClean(x,y,peakDetect(y))
+
+@benchmark("read_spe")
+def benchReadSpe():
+    fname=os.path.join(_tempDir(),"benchmark.spe")
+    write_spe(fname,np.random.RandomState(0).randint(0,2**16,(20,256,1024)))
+    return lambda: read_spe(fname)
+
+@benchmark("read_spe_frames")
+def benchReadSpeFrames():
+    fname=os.path.join(_tempDir(),"benchmark.spe")
+    if not os.path.exists(fname):
+        write_spe(fname,np.random.RandomState(0).randint(0,2**16,(20,256,1024)))
+    return lambda: np.asarray(read_spe_frames(fname)).sum(0)
+
+def _largeSession(fname,numMeasurements):
+    """ Create a session in fname with numMeasurements each of LIV and spectra, without saving it """
+    session=measurement.Session(True,fname)
+    for idx in range(numMeasurements):
+        liv=measurement.LIV(_measurementInfo("LIV %d"%idx),parent=_BenchmarkMain())
+        liv.data=_livData(1000,idx)
+        spectrum=measurement.WinspecSpectrum(_measurementInfo("Spectrum %d"%idx),parent=_BenchmarkMain())
+        spectrum.data={"wavelength":np.tile(np.linspace(950e-9,1010e-9,1024)[:,np.newaxis],(1,11)),"intensity":np.random.RandomState(idx).rand(1024,11),
+            "iMeas":np.linspace(1e-3,80e-3,11),"vMeas":np.linspace(1,2,11),"temperature":295*np.ones(11)}
+        session.measurements+=[liv,spectrum]
+    return session
+
+@benchmark("session_save")
+def benchSessionSave():
+    directory=_tempDir()
+    def run():
+        fname=os.path.join(directory,"save.h5")
+        session=_largeSession(fname,100)
+        session.saveToDB()
+        # the session closes the database when it's deleted
+        del session
+    return run
+
+@benchmark("session_fetch")
+def benchSessionFetch():
+    fname=os.path.join(_tempDir(),"fetch.h5")
+    session=_largeSession(fname,100)
+    session.saveToDB()
+    del session
+    def run():
+        session=measurement.Session(False,fname)
+        del session
+    return run
+
+@benchmark("rin_conversion")
+def benchRinConversion():
+    meas=_rinMeasurement(501,41)
+    def run():
+        meas._rinCache={}
+        meas.getRin()
+    return run
+
+@benchmark("grid_search")
+def benchGridSearch():
+    """ Hill-climbing PiezoAlign.searchGrid on a fine grid against the simulated piezo and power meter, starting away from the optimum """
+    from align import PiezoAlign
+    aligner=PiezoAlign()
+    pm=simulator.PowerMeter()
+    x=np.arange(0,100,0.1)
+    y=np.arange(0,100,0.1)
+    p0=tuple(simulator.setup.piezoOptimum+5.0)
+    return lambda: aligner.searchGrid(x,y,p0,lambda: pm.readPowerAuto(tau=50))
+
+@benchmark("render_plot")
+def benchRenderPlot():
+    """ MplCanvas.renderPlot from the main window with the RIN plot of 41 currents, drawn on an Agg canvas so no QApplication is needed """
+    mainModule=imp.load_source("lms_main",os.path.join(os.path.dirname(os.path.abspath(__file__)),"main.pyw"))
+    methods=mainModule.MplCanvas.__dict__
+    class HeadlessCanvas(FigureCanvasAgg):
+        readyToDraw=_NullSignal()
+        initialize=methods["initialize"]
+        addTwinAxis=methods["addTwinAxis"]
+        renderPlot=methods["renderPlot"]
+    canvas=HeadlessCanvas(Figure(figsize=(5,4),dpi=100))
+    plots=[]
+    meas=_rinMeasurement(501,41)
+    meas.plotDataReady.connect(plots.append)
+    meas.plot()
+    return lambda: canvas.renderPlot(plots[-1])
+
+_tempDirectory=None
+def _tempDir():
+    """ Temporary directory for files created by the benchmarks, which is removed when they finish """
+    global _tempDirectory
+    if _tempDirectory is None:
+        _tempDirectory=tempfile.mkdtemp(prefix="lms_benchmark_")
+    return _tempDirectory
+
+def timeBenchmark(setup,repeats=DEFAULT_REPEATS):
+    """ Run the setup function and then time the function it returns repeats times """
+    func=setup()
+    times=[]
+    for idx in range(repeats):
+        t0=time()
+        func()
+        times.append(time()-t0)
+    return {"median":float(np.median(times)),"best":min(times),"repeats":repeats}
+
+def runBenchmarks(names=None,repeats=DEFAULT_REPEATS):
+    """ Run the benchmarks (all of them if names is None) and return a dictionary of the results together with some info on the environment """
+    results={}
+    try:
+        for name,setup in BENCHMARKS:
+            if names is None or name in names:
+                print("Running %s..." % name)
+                results[name]=timeBenchmark(setup,repeats)
+    finally:
+        global _tempDirectory
+        if _tempDirectory is not None:
+            shutil.rmtree(_tempDirectory,ignore_errors=True)
+            _tempDirectory=None
+    return {"created":str(datetime.now().replace(microsecond=0)),"platform":platform.platform(),"python":platform.python_version(),
+        "numpy":np.__version__,"timeScale":simulator.TIME_SCALE,"results":results}
+
+def compareToBaseline(results,baseline,threshold=REGRESSION_THRESHOLD):
+    """ Return a list of (name, baseline median, median) for each benchmark whose median time is more than threshold slower than the baseline """
+    regressions=[]
+    for name,result in sorted(results["results"].items()):
+        if name in baseline["results"]:
+            reference=baseline["results"][name]["median"]
+            if result["median"] > reference*(1+threshold):
+                regressions.append((name,reference,result["median"]))
+    return regressions
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Time the acquisition, analysis and storage hot paths and compare them to a baseline")
+    parser.add_argument("benchmarks",nargs="*",help="names of the benchmarks to run (default: all)")
+    parser.add_argument("-o","--output",default=DEFAULT_OUTPUT,help="JSON file to write the results to")
+    parser.add_argument("-b","--baseline",help="JSON results of a previous run to compare against")
+    parser.add_argument("-n","--repeats",type=int,default=DEFAULT_REPEATS)
+    parser.add_argument("-t","--threshold",type=float,default=REGRESSION_THRESHOLD,help="relative slowdown flagged as a regression")
+    parser.add_argument("--time-scale",type=float,default=0.0,help="TIME_SCALE of the simulated instruments (0 only times the software)")
+    args=parser.parse_args(argv)
+    simulator.TIME_SCALE=args.time_scale
+    results=runBenchmarks(args.benchmarks or None,args.repeats)
+    with open(args.output,"w") as f:
+        json.dump(results,f,indent=1,sort_keys=True)
+    for name,result in sorted(results["results"].items()):
+        print("%-20s median %9.4fs   best %9.4fs" % (name,result["median"],result["best"]))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline=json.load(f)
+        regressions=compareToBaseline(results,baseline,args.threshold)
+        for name,reference,median in regressions:
+            print("REGRESSION: %s took %.4fs vs %.4fs in the baseline" % (name,median,reference))
+        if regressions:
+            return 1
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main())
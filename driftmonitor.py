@@ -0,0 +1,71 @@
+from __future__ import division
+from time import time
+from numpy import *
+
+def nearestIndex(grid,values,tolerance):
+    """ For each of values, return the index of the nearest element in grid (which needn't be sorted), or -1 if it isn't within tolerance """
+    grid=asarray(grid)
+    values=asarray(values)
+    order=argsort(grid)
+    sortedGrid=grid[order]
+    # Nearest element is either side of the insertion point in the sorted grid
+    pos=searchsorted(sortedGrid,values)
+    left=clip(pos-1,0,len(grid)-1)
+    right=clip(pos,0,len(grid)-1)
+    nearest=where(abs(sortedGrid[left]-values)<=abs(sortedGrid[right]-values),left,right)
+    return where(abs(sortedGrid[nearest]-values)<=tolerance,order[nearest],-1)
+
+class DriftMonitor(object):
+    """ Tracks cheap proxies for the fiber coupling (e.g. a power reading at the alignment current, or the integral of spectra at the
+    same current) after an alignment, and predicts the loss of coupling from how quickly they drop. The coupling is gaussian in the
+    misalignment, which drifts roughly linearly in time, so the loss is modelled as growing with the square of the time since the alignment.
+    Each proxy has a key, and its loss is relative to its reference value, which is either given at the alignment or is its first value after it """
+    def __init__(self):
+        self.reset()
+
+    def reset(self,alignTime=None,references=None):
+        """ Start tracking from an alignment at alignTime, with optional reference values {key:value} measured at the alignment """
+        self.alignTime=time() if alignTime is None else alignTime
+        self.references={}
+        self.samples=[]
+        if references is not None:
+            for key in references:
+                self.references[key]=(self.alignTime,references[key])
+
+    def setPointKey(self,proxy,current,tolerance):
+        """ Key for a proxy measured at a current set point [A], which is the key of the proxy's reference at the nearest current within
+        tolerance if there is one, so that the proxy is compared whenever the same set point is measured again """
+        keys=[key for key in self.references if isinstance(key,tuple) and key[0]==proxy]
+        if keys:
+            idx=nearestIndex([key[1] for key in keys],[current],tolerance)[0]
+            if idx>=0: return keys[idx]
+        return (proxy,current)
+
+    def addSample(self,key,value,t=None):
+        """ Add a value of the proxy with the given key measured at time t """
+        if t is None: t=time()
+        if key not in self.references:
+            self.references[key]=(t,value)
+            return
+        t0,reference=self.references[key]
+        if reference>0 and t>t0:
+            # The loss relative to the reference is the difference between the losses at t and t0 in the model
+            self.samples.append(((t-self.alignTime)**2-(t0-self.alignTime)**2,1-value/reference))
+
+    def lossCoefficient(self):
+        """ Least squares fit of the coefficient [1/s^2] of the loss vs the square of the time since the alignment """
+        if not self.samples: return 0.0
+        x,loss=array(self.samples).T
+        return maximum((loss*x).sum()/(x**2).sum(),0)
+
+    def predictedLoss(self,t=None):
+        """ Relative loss of coupling predicted at time t (default now) since the alignment """
+        if t is None: t=time()
+        return self.lossCoefficient()*(t-self.alignTime)**2
+
+    def timeToLoss(self,loss,t=None):
+        """ Time from t (default now) until the predicted loss reaches loss, which is inf if no loss has been seen yet """
+        if t is None: t=time()
+        coefficient=self.lossCoefficient()
+        if coefficient==0: return inf
+        return maximum(sqrt(loss/coefficient)-(t-self.alignTime),0)
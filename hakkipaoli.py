@@ -229,4 +229,16 @@ def peakClean(x,y,maxIdx,xth=MIN_MODE_SPACING,yth=None):
                 maxIdxClean.append(maxIdx[i])
         maxIdx=maxIdxClean
 
-    return maxIdx
\ No newline at end of file
+    return maxIdx
+
+def modeRipple(y,maxIdxRaw,maxIdx):
+    """ Given all of the peaks maxIdxRaw in y and the mode peaks maxIdx left after peakClean, return the magnitude of the ripple in each mode,
+    i.e. the largest of the other peaks between each pair of neighbouring mode peaks minus the minimum of y between them (zero if there aren't any) """
+    if len(maxIdx)<2: return zeros(0)
+    ripplePeakIdx=setdiff1d(maxIdxRaw,maxIdx)
+    rippleY=-inf*ones(len(y))
+    rippleY[ripplePeakIdx]=y[ripplePeakIdx]
+    # Reduce over the segments which start at each mode peak, leaving out the last one which runs to the end of y
+    rippleMax=maximum.reduceat(rippleY,maxIdx)[:-1]
+    modeMin=minimum.reduceat(y,maxIdx)[:-1]
+    return where(isfinite(rippleMax),rippleMax-modeMin,0)
@@ -0,0 +1,137 @@
+from __future__ import division
+import threading
+from contextlib import contextmanager
+
+class _PoolEntry(object):
+    """ An open instrument in the pool together with the lock which is held by whoever has leased it, and the configuration it has """
+    def __init__(self,factory,args,kwargs):
+        self.factory=factory
+        self.args=args
+        self.kwargs=kwargs
+        self.instrument=None
+        self.failed=False
+        self.lock=threading.RLock()
+        self.leases=0
+
+class InstrumentPool(object):
+    """ Registry of open instrument connections which can be shared between measurements, so that the (slow) VISA/APT/COM setup
+    of each instrument is only done once instead of for every measurement or measurement point.
+    An instrument is identified by its class (or any other factory) and positional constructor arguments (i.e. its address, if it has
+    one), and is only constructed the first time it's acquired. The keyword arguments are its configuration: if it's acquired with a
+    different configuration than it has, then the configuration function for the factory (if any) applies it to the open instrument,
+    and otherwise the instrument is reopened with the new configuration, so there is only ever one connection to each instrument.
+    Acquiring it without any keyword arguments takes it with whatever configuration it has.
+    Each instrument can only be leased by one thread at a time, although the same thread can lease it more than once. A nested lease
+    can't reopen the instrument, so its configuration is only applied if the configuration function can apply it to the open one.
+    If a lease is released as failed, or the optional health check for the factory fails, then the instrument is reconnected the next
+    time it's acquired """
+    def __init__(self):
+        self._entries={}
+        self._leased={}
+        self._healthChecks={}
+        self._configures={}
+        self._lock=threading.Lock()
+
+    def setHealthCheck(self,factory,check):
+        """ Set a function which is called with the instrument each time an instrument from factory is acquired, and which should
+        return False (or raise an exception) if the connection needs to be reopened """
+        self._healthChecks[factory]=check
+
+    def setConfigure(self,factory,configure):
+        """ Set a function configure(instrument,opened,requested) which applies the requested configuration (a dictionary of the keyword
+        arguments) to an instrument from factory which was opened with the opened configuration. It should return False if the
+        configuration can't be changed without reopening the instrument """
+        self._configures[factory]=configure
+
+    def acquire(self,factory,*args,**kwargs):
+        """ Lease the instrument constructed by factory(*args,**kwargs), opening it if necessary, and blocking until it's available """
+        key=(factory,args)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key]=_PoolEntry(factory,args,kwargs)
+            entry=self._entries[key]
+        entry.lock.acquire()
+        try:
+            if entry.instrument is not None and (entry.failed or not self._isHealthy(entry)):
+                self._disconnect(entry)
+            if entry.instrument is not None and kwargs and kwargs!=entry.kwargs:
+                if self._configure(entry,kwargs):
+                    entry.kwargs=kwargs
+                elif entry.leases==0:
+                    self._disconnect(entry)
+            if entry.instrument is None:
+                entry.kwargs=kwargs
+                entry.instrument=entry.factory(*entry.args,**entry.kwargs)
+                entry.failed=False
+        except:
+            entry.lock.release()
+            raise
+        entry.leases+=1
+        with self._lock:
+            self._leased[id(entry.instrument)]=entry
+        return entry.instrument
+
+    def release(self,instrument,failed=False):
+        """ Return a leased instrument to the pool. If failed then it will be reconnected the next time it's acquired """
+        with self._lock:
+            entry=self._leased[id(instrument)]
+        if failed: entry.failed=True
+        entry.leases-=1
+        if entry.leases==0:
+            with self._lock:
+                del self._leased[id(instrument)]
+        entry.lock.release()
+
+    @contextmanager
+    def lease(self,factory,*args,**kwargs):
+        """ Context manager which acquires an instrument and releases it afterwards, marking it as failed if there was an exception """
+        instrument=self.acquire(factory,*args,**kwargs)
+        try:
+            yield instrument
+        except:
+            self.release(instrument,failed=True)
+            raise
+        else:
+            self.release(instrument)
+
+    def close(self):
+        """ Close all instruments which aren't currently leased, e.g. to return them to front panel control """
+        with self._lock:
+            entries=self._entries.values()
+        for entry in entries:
+            if entry.lock.acquire(False):
+                try:
+                    if entry.leases==0: self._disconnect(entry)
+                finally:
+                    entry.lock.release()
+
+    def _isHealthy(self,entry):
+        """ Run the health check for the entry (if any) """
+        check=self._healthChecks.get(entry.factory)
+        if check is None: return True
+        try:
+            return bool(check(entry.instrument))
+        except Exception:
+            return False
+
+    def _configure(self,entry,kwargs):
+        """ Apply the configuration kwargs to the open instrument of the entry, returning False if it has to be reopened instead """
+        configure=self._configures.get(entry.factory)
+        if configure is None: return False
+        return configure(entry.instrument,entry.kwargs,kwargs) is not False
+
+    def _disconnect(self,entry):
+        """ Close the connection of the instrument with its close() method (if it has one) and drop it, otherwise its destructor
+        closes the connection once the last reference to it is gone """
+        instrument=entry.instrument
+        entry.instrument=None
+        close=getattr(instrument,"close",None)
+        if close is not None:
+            try:
+                close()
+            except Exception:
+                # The connection is often dropped because it's already broken, so there may be nothing left to close
+                pass
+
+# Process-wide pool shared by all measurements and profiles
+instrumentPool=InstrumentPool()
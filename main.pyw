@@ -31,6 +31,9 @@ except WindowsError as e:
 # Assume that if VISA module not installed then none of the instrumentation imports will work
     print("Error importing visaconnection from drivepy... \n"+e.args[1])
     DUMMY_MODE=True
+# The simulated instruments don't need VISA, so run the real measurement code against them
+if measurement.SIMULATE:
+    DUMMY_MODE=False
 
 try:
     from winspec import Winspec, readDetectorDefinition
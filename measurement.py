@@ -1,6 +1,6 @@
 ﻿# Python imports
 from __future__ import division
-from hakkipaoli import HakkiPaoli, peakDetect, peakClean
+from hakkipaoli import HakkiPaoli, peakDetect, peakClean, modeRipple
 import gainmedium
 from numpy import *
 from matplotlib import pyplot as pp
@@ -18,6 +18,10 @@ from scipy import io as scipyio, optimize, interpolate
 from filter import savitzky_golay, smooth
 from functools import partial
 from multiprocessing import Pool, cpu_count
+from asyncinstrument import AsyncInstrument, asyncCall
+from profitmap import ProfitMap, ProfitMapCache
+from driftmonitor import DriftMonitor, nearestIndex
+from instrumentpool import instrumentPool
 # QT imports
 from PyQt4.QtCore import QCoreApplication,Qt,QTimer, QReadLocker
 from PyQt4 import QtGui,QtCore
@@ -27,8 +31,15 @@ try:
     NO_VISA=False
 except (ImportError, OSError) as e:
     NO_VISA=True
+from simulator import SIMULATE
+# Use the simulated instruments if simulating, so that every measurement type can be run without any hardware
+if SIMULATE:
+    from simulator import SMU, PowerMeter, WinspecAnalyzer, MAX_COUNTS, SpectrumAnalyzer, DMM, TemperatureController
+    from align import PiezoAlign, MotorAlign, adaptiveProfitFunction
+    POWER_METERS={"primary":"Simulated","secondary":"Simulated","prealign":"Simulated","roughAlign":"Simulated","fineAlign":"Simulated"}
+    PrimaryPowerMeter=SecondaryPowerMeter=PrealignPowerMeter=RoughAlignPowerMeter=FineAlignPowerMeter=PowerMeter
 # Import the rest of the instruments if visa library exists, otherwise don't bother since no real tests can be done without this library
-if not NO_VISA:
+elif not NO_VISA:
     # SMU
     from drivepy.keithley.smu import SMU
     # Flags for instrument to use for power meters. Can take values ("Newport", "DMM", "Winspec", None)
@@ -81,7 +92,7 @@ if not NO_VISA:
     from drivepy.keithley.dmm import DMM
     #from drivepy.advantest.spectrumanalyzer import SpectrumAnalyzer
     from drivepy.scientificinstruments.temperaturecontroller import TemperatureController
-    from align import PiezoAlign, MotorAlign
+    from align import PiezoAlign, MotorAlign, adaptiveProfitFunction
     try:
         from drivepy.thorlabs.fw102c import FilterWheel
     except:
@@ -111,6 +122,9 @@ PREALIGNMENT_SOFT_SEARCH_THRESH = 100e-9
 ALIGNMENT_SIGNAL_SEARCH_RES=0.004   # Resolution for signal search in mm
 ALIGNMENT_SIGNAL_SEARCH_THRESH=1e-6 # Power threshold for detected signal
 ALIGNMENT_SOFT_SEARCH_THRESH=1e-9   # Power threshold before we even attempt optimization during signal search
+ALIGNMENT_WARM_START_SPAN=0.01      # Minimum half-span in mm of a rough alignment warm started from the cached profit maps
+ALIGNMENT_RIPPLE_TAU=20             # Minimum averaging time in ms of each spectrum for the ripple fine alignment
+ALIGNMENT_RIPPLE_WINDOW=3e-9        # Half-width in m of the window around the lasing peak in which the ripple is calculated
 FEEDBACK_CALIBRATION_CURRENT=60e-3  # Drive current used when calibrating the feedback amount for RIN
 LIV_TAU=20                          # Averaging time in ms for power meter measurements (normal conditions)
 LIV_TAU_LOWTEMP=500                 # Averaging time in ms for power meter measurements (low temperature conditions)
@@ -118,9 +132,30 @@ LIV_MIN_MAX_POWER=0.5e-6              # The threshold for max(power), below whic
 LOWTEMP_THRESHOLD=295               # Temperature in Kelvin, below which we assume the cryostat is on and use a longer measurement time to average vibration
 SPECTRUM_MIN_CURRENT=0.01e-3         # Currents below this point will be clipped
 MIN_REALIGNMENT_TIME=15             # Minimum time before re-checking the alignment (minutes)
+REALIGNMENT_LOSS_THRESHOLD=0.03     # Relative loss of coupling predicted by the drift monitor above which the fine alignment is redone
+DRIFT_PROBE_INTERVAL=60             # Minimum time in s between readings of the coupling at the fine align current for the drift monitor
+DRIFT_PROBE_MAX_INTERVAL=900        # Maximum time in s between readings of the coupling for the drift monitor
+MIN_CENTER_CONFIDENCE=0.5           # Minimum confidence in the measured peak luminescence before the spectrometer center is moved to it
 RIN_MIN_FREQ=500e6                  # Lower cutoff frequency for RIN plotting and noise floor calculation
+RIN_HIGH_RES_CENTER=0.9             # Center frequency of the high resolution RIN window in GHz
+RIN_HIGH_RES_SPAN=1.8               # Span of the high resolution RIN window in GHz
+CURRENT_MATCH_TOLERANCE=1e-6        # Currents [A] closer than this are treated as the same set point when comparing measurements
+POWER_CAL_DRIFT_THRESHOLD=0.02      # Relative change in optical efficiency between power meter calibrations, below which the next calibration is skipped
+POWER_CAL_MAX_SKIP=3                # Maximum number of consecutive spectra which can skip the power meter calibration
 AUTO_ALIGN=False
 __DBPATH__=None                     # Path to the database file
+PROFIT_MAP_NODE="profitMaps"        # Group in the database which holds the alignment profit maps (rather than measurements)
+
+def configureSMU(smu,opened,requested):
+    """ Apply the requested keyword arguments to an SMU which the instrument pool opened with the opened ones. Only the default
+    current can be changed on an open SMU, so it has to be reopened if any of the other arguments (auto zero etc) are different """
+    options=lambda kwargs: dict((k,v) for k,v in kwargs.items() if k!="defaultCurrent")
+    if options(opened)!=options(requested): return False
+    smu.setCurrent(requested.get("defaultCurrent",0.0))
+    return True
+
+if SIMULATE or not NO_VISA:
+    instrumentPool.setConfigure(SMU,configureSMU)
 
 class Session(QtCore.QObject):
     finished=QtCore.pyqtSignal()
@@ -153,6 +188,8 @@ class Session(QtCore.QObject):
             # Exit the application if there was an error opening the database for some reason
             QtGui.QMessageBox.warning(None,"Database Error",("There was a database error... exiting the application"))
             sys.exit(1)
+        # Profit maps measured by the alignments, which are used to warm start the next alignment
+        self.profitMaps=ProfitMapCache()
         if newDB:
             # create new database
             self.initializeDatabase_()
@@ -160,6 +197,7 @@ class Session(QtCore.QObject):
         else:
             # open existing database
             self.measurements=self.fetchAllMeasurements()
+            self.fetchProfitMaps()
         # set global variable for the database directory
         global __DBPATH__
         __DBPATH__=os.path.normpath(fname)
@@ -250,35 +288,26 @@ class Session(QtCore.QObject):
         elif plotType=="PeakRIN":
             rinMeas=self.dataByClassHandle(RinSpectrum,measList)
             feedback=[]
-            peakRin=[]
-            # Get list of all unique current set points in set of measurements
-            current=unique(hstack(array([linspace(m.info["Istart"],m.info["Istop"],m.info["numCurrPoints"]) for m in rinMeas])))
+            # Get list of all unique current set points in set of measurements, merging values which only differ by rounding errors
+            current=sort(hstack([linspace(m.info["Istart"],m.info["Istop"],m.info["numCurrPoints"]) for m in rinMeas]))
+            current=current[concatenate(([True],diff(current)>CURRENT_MATCH_TOLERANCE))]
             # Get all feedback levels
             feedback=array([10*log10(m.data["feedbackAmount"]) if "feedbackAmount" in m.data else NaN for m in rinMeas])
             # Sort measurement list by feedback level
             sortIdx=feedback.argsort()
             feedback=feedback[sortIdx]
             rinMeas=[rinMeas[i] for i in sortIdx]
-            # Create array of peak RIN for each current and feedback level
-            for m in rinMeas:
-                # Calculate start index to trim all frequencies below RIN_MIN_FREQ
-                s=where(m.data["wavelength"] >= RIN_MIN_FREQ)[0][0]
-                # Get current set points for current meas
+            # Create array of peak RIN for each feedback level and current, leaving a dummy value if the current wasn't included in m
+            peakRin=zeros((len(rinMeas),len(current)))*NaN
+            for k,m in enumerate(rinMeas):
+                # Get current set points for current meas and find the column of m for each current
                 ism=linspace(m.info["Istart"],m.info["Istop"],m.info["numCurrPoints"])
-                # Calculate peak rin at each current in allCurr, setting a dummy value if the current value wasn't included in m
-                peakRinIdx=[]
-                for idx in range(len(current)):
-                    try:
-                        idx2=where(ism==current[idx])[0][0]
-                        rin=m.powerDensityToRin(m.data["intensity"][s:,idx2],m.data["thermalNoisePower"][s:],m.data["photoCurrent"][idx2])
-                        peakRinIdx.append(max(rin))
-                    except IndexError:
-                        peakRinIdx.append(NaN)
-                # Append to main arrays
-                peakRin.append(array(peakRinIdx))
+                idx=nearestIndex(ism,current,CURRENT_MATCH_TOLERANCE)
+                # Peak rin (above RIN_MIN_FREQ) for every current in m at once
+                freq,rin=m.getRin()
+                peakRin[k,idx>=0]=amax(rin,0)[idx[idx>=0]]
             # Convert to numpy arrays
             feedback=array(feedback)-6-8
-            peakRin=array(peakRin)
             # Make plot dictionary
             x=tuple(tile(feedback,(len(current),1)))
             y=tuple(transpose(peakRin))
@@ -311,6 +340,7 @@ class Session(QtCore.QObject):
             # Traverse first 3 levels of file heirarchy assuming pytables group structure in format \groupName\testType\testName\
             groupNameDic=self.db.root._v_children
             for groupName in groupNameDic:
+                if groupName==PROFIT_MAP_NODE: continue
                 testTypeDic=groupNameDic[groupName]._v_children
                 for testType in testTypeDic:
                     testNameDic=testTypeDic[testType]._v_children
@@ -418,9 +448,36 @@ class Session(QtCore.QObject):
                     info=measDic[groupName][typeName][testId].info
                     for attrName in info:
                         self.db.setNodeAttr(measNode,attrName,info[attrName])
+        self.saveProfitMaps()
         # force changes to be commited
         self.db.flush()
 
+    def saveProfitMaps(self):
+        """ Saves any profit maps which aren't in the database yet, each as a group with the points and profit arrays and the other
+        fields as attributes """
+        if PROFIT_MAP_NODE not in self.db.root._v_children:
+            mapsNode=self.db.createGroup(self.db.root,PROFIT_MAP_NODE)
+        else:
+            mapsNode=self.db.getNode(self.db.root,PROFIT_MAP_NODE)
+        for idx,profitMap in enumerate(list(self.profitMaps.maps)):
+            mapName="map%d"%idx
+            if mapName not in mapsNode._v_children:
+                mapNode=self.db.createGroup(mapsNode,mapName)
+                self.db.createArray(mapNode,"points",profitMap.points)
+                self.db.createArray(mapNode,"profit",profitMap.profit)
+                for attrName in ["stage","best","temperature","current","timestamp"]:
+                    self.db.setNodeAttr(mapNode,attrName,getattr(profitMap,attrName))
+
+    def fetchProfitMaps(self):
+        """ Fetch the profit maps from the database into self.profitMaps """
+        if type(self.db)==sqlite3.Connection or PROFIT_MAP_NODE not in self.db.root._v_children: return
+        mapsNode=self.db.getNode(self.db.root,PROFIT_MAP_NODE)
+        for mapName in sorted(mapsNode._v_children,key=lambda name: int(name[3:])):
+            mapNode=mapsNode._v_children[mapName]
+            attrs=mapNode._v_attrs
+            self.profitMaps.append(ProfitMap(attrs["stage"],mapNode.points.read(),mapNode.profit.read(),attrs["best"],attrs["temperature"],
+                attrs["current"],attrs["timestamp"]))
+
 
     def saveAs(self,groupName):
         # This needs to export the threshold current vs temperature for LIV data with groupName as well as raw data for .mat and .pickle
@@ -552,6 +609,11 @@ class Measurement(QtCore.QObject):
         self.preAlignFlag=self.info.get("preAlign",True)
         self.roughAlignFlag=self.info.get("roughAlign",False)
         self.fineAlignFlag=self.info.get("fineAlign",False)
+        # Optional InstrumentPool which instruments are leased from (e.g. set by a Profile), and the instruments currently leased
+        self.pool=None
+        self._leases=[]
+        # Optional AlignmentService which keeps the device aligned before the measurement (e.g. set by a Profile)
+        self.alignmentService=None
         # Set filter wheel position to 1
         try:
             attentuator=FilterWheel()
@@ -588,24 +650,81 @@ class Measurement(QtCore.QObject):
     def getID(self):
         """ Returns a human intelligible unique ID for usage in the database"""
         return self.info["Name"]+" "+self.info["creationTime"]
+
+    def serviceAligned(self):
+        """ Whether the alignment service has aligned the device with at least the signal search threshold of power, so that the measurement
+        can start from its position without a rough align """
+        if self.alignmentService is None or self.alignmentService.alignedPower is None: return False
+        return self.alignmentService.alignedPower >= ALIGNMENT_SIGNAL_SEARCH_THRESH
+
+    def openInstrument(self,factory,*args,**kwargs):
+        """ Create an instrument, or lease it from self.pool (if set) so that an already open connection can be reused """
+        if self.pool is None: return factory(*args,**kwargs)
+        instrument=self.pool.acquire(factory,*args,**kwargs)
+        self._leases.append(instrument)
+        return instrument
+
+    def releaseInstrument(self,instrument,failed=False):
+        """ Return a single instrument leased by openInstrument() to self.pool before the end of the measurement """
+        if self.pool is None: return
+        idx=len(self._leases)-1-self._leases[::-1].index(instrument)
+        self.pool.release(self._leases.pop(idx),failed)
+
+    def releaseInstruments(self,failed=False):
+        """ Return all the instruments leased by openInstrument() to self.pool, optionally marking them as failed so they're reconnected """
+        while self._leases:
+            self.pool.release(self._leases.pop(),failed)
         
        
     def roughAlign(self, preAlign = True):
         smu = self._setAlignmentCurrent()
-        pm = RoughAlignPowerMeter()
-        motorAlignObject=MotorAlign()
-        if preAlign:
-            # If the rough align power meter is below the search threshold then use a pre-align to get the interesting search range
-            if pm.readPowerAuto(mode='max') < ALIGNMENT_SIGNAL_SEARCH_THRESH: 
-                xm, xM, ym, yM = self._preAlign(motorAlignObject)
-                span = max((xM - xm)/2, (yM - ym)/2)
-            else:
-                span = None
-        self.sendStatusMessage("\nMain align (rough):\n")
-        self._roughAlign(motorAlignObject, pm, ALIGNMENT_SIGNAL_SEARCH_RES, ALIGNMENT_ROUGH_RES, ALIGNMENT_SIGNAL_SEARCH_THRESH, ALIGNMENT_SOFT_SEARCH_THRESH, span = span)
+        try:
+            pm = self.openInstrument(RoughAlignPowerMeter)
+            motorAlignObject=self.openInstrument(MotorAlign)
+            if preAlign:
+                # If the rough align power meter is below the search threshold then use a pre-align to get the interesting search range
+                if pm.readPowerAuto(mode='max') < ALIGNMENT_SIGNAL_SEARCH_THRESH: 
+                    xm, xM, ym, yM = self._preAlign(motorAlignObject)
+                    span = max((xM - xm)/2, (yM - ym)/2)
+                else:
+                    span = None
+            self.sendStatusMessage("\nMain align (rough):\n")
+            self._roughAlign(motorAlignObject, pm, ALIGNMENT_SIGNAL_SEARCH_RES, ALIGNMENT_ROUGH_RES, ALIGNMENT_SIGNAL_SEARCH_THRESH, ALIGNMENT_SOFT_SEARCH_THRESH, span = span)
+        finally:
+            # Return the SMU to the pool straight away, so that the measurement can lease it with its own configuration
+            self.releaseInstrument(smu)
+
+    def _profitMaps(self):
+        """ The ProfitMapCache of the session, or None if there isn't a session (e.g. when benchmarking) """
+        session=getattr(self.main,"session",None)
+        return None if session is None else session.profitMaps
+
+    def _alignmentTemperature(self):
+        """ Temperature to record with the alignment profit maps, or nan if there's no temperature controller available """
+        tempController=getattr(self,"tempController",None) or getattr(self.main,"tempController",None)
+        if tempController is None or NO_TEMP_SENSOR or self.lock is None: return nan
+        with QReadLocker(self.lock):
+            return tempController.getTemperature()
+
+    def _warmStart(self,stage):
+        """ Return (p0,span,prior) to warm start the alignment of stage from the cached profit maps, or None if there aren't any """
+        profitMaps=self._profitMaps()
+        if profitMaps is None: return None
+        return profitMaps.warmStart(stage,self._alignmentTemperature())
+
+    def _recordProfitMap(self,stage,alignObject,p,current):
+        """ Add the profit map of the last alignment done by alignObject to the session's cache """
+        profitMaps=self._profitMaps()
+        if profitMaps is not None and getattr(alignObject,"profitMap",None) is not None:
+            points,profit=alignObject.profitMap
+            profitMaps.append(ProfitMap(stage,points,profit,p,self._alignmentTemperature(),current))
+
+    def _alignmentState(self):
+        """ Return a snapshot of the motor and piezo coordinates which identifies the current alignment """
+        return tuple(ravel(array(self.main.motorCoordinates,dtype=float)))+tuple(ravel(array(self.main.piezoCoordinates,dtype=float)))
 
     def _setAlignmentCurrent(self):
-        smu = SMU()
+        smu = self.openInstrument(SMU)
         smu.setCurrent(ALIGNMENT_CURRENT)
         smu.setOutputState("ON")
         return smu    
@@ -622,29 +741,44 @@ class Measurement(QtCore.QObject):
                 motorAlignObject.move1d(chan, pos)
             return pos        
         self.sendStatusMessage("Prealign:\n")
-        pm = PrealignPowerMeter()
-        p, preAlignPower = self._roughAlign(motorAlignObject, pm, PRE_ALIGNMENT_SEARCH_RES, PRE_ALIGNMENT_ROUGH_RES, ALIGNMENT_SIGNAL_SEARCH_THRESH, PREALIGNMENT_SOFT_SEARCH_THRESH)
+        pm = self.openInstrument(PrealignPowerMeter)
+        p, preAlignPower = self._roughAlign(motorAlignObject, pm, PRE_ALIGNMENT_SEARCH_RES, PRE_ALIGNMENT_ROUGH_RES, ALIGNMENT_SIGNAL_SEARCH_THRESH, PREALIGNMENT_SOFT_SEARCH_THRESH, stage = "prealign")
         self.sendStatusMessage("Pre align power meter measured %f uW"%(preAlignPower*1e6))
         limits = (scan(0, -1), scan(0, 1), scan(1, -1), scan(1, 1))
         self.sendStatusMessage("Pre align determined scan range: x: (%f, %f) y: (%f, %f)"%limits)
         return limits
 
-    def _roughAlign(self, motorAlignObject, pm, searchRes, res, threshold, softThreshold = None, span = None):
-        """ Run findFirstSignal() and then do a rough align """
+    def _roughAlign(self, motorAlignObject, pm, searchRes, res, threshold, softThreshold = None, span = None, stage = "motor"):
+        """ Run findFirstSignal() and then do a rough align. If the profit maps cached in the session give a predicted position with a
+        signal then the search is skipped and the rough align is warm started from there """
         self.sendStatusMessage("Initializing motor controller...")
-        # Search for the first sign of signal over wide coarse grid using motor controller
-        self.sendStatusMessage("Searching for the signal...")
-        p0=self.main.motorCoordinates
         profitFunc=lambda : pm.readPowerAuto(tau=1,mode="max")
-        p,power=motorAlignObject.findFirstSignal(p0,res=searchRes,profitFunction=profitFunc,threshold=threshold, span = span, softThreshold = softThreshold)
+        alignSpan=None
+        prior=None
+        warmStart=self._warmStart(stage)
+        if warmStart is not None:
+            p,warmSpan,prior=warmStart
+            motorAlignObject.moveTo(p)
+            if profitFunc()>=threshold:
+                self.sendStatusMessage("Warm starting from the predicted position "+"(%.3f,%.3f)"%p+"mm...")
+                alignSpan=maximum(warmSpan,ALIGNMENT_WARM_START_SPAN)
+            else:
+                prior=None
+        if prior is None:
+            # Search for the first sign of signal over wide coarse grid using motor controller
+            self.sendStatusMessage("Searching for the signal...")
+            p0=self.main.motorCoordinates
+            p,power=motorAlignObject.findFirstSignal(p0,res=searchRes,profitFunction=profitFunc,threshold=threshold, span = span, softThreshold = softThreshold,
+                coarseRes=maximum(PRE_ALIGNMENT_SEARCH_RES,searchRes))
         with QReadLocker(self.lock):
             self.main.motorCoordinates=p
         # Rough align to get the rough optimum position over wide but coarse grid
         self.sendStatusMessage("Signal found at "+"(%.3f,%.3f)"%p+"mm.\nNow performing rough alignment...")
         tau=ALIGNMENT_TAU if self.cryostatOff else ALIGNMENT_TAU_LOWTEMP
         p0=p
-        profitFunc=lambda : pm.readPowerAuto(tau=tau)
-        p,power=motorAlignObject.autoalign(p0,res=res,profitFunction=profitFunc)
+        profitFunc=adaptiveProfitFunction(pm,tau)
+        p,power=motorAlignObject.autoalign(p0,res=res,span=alignSpan,profitFunction=profitFunc,prior=prior)
+        self._recordProfitMap(stage,motorAlignObject,p,ALIGNMENT_CURRENT)
         with QReadLocker(self.lock):
             self.main.motorCoordinates=p
         settings=QtCore.QSettings()
@@ -656,22 +790,33 @@ class Measurement(QtCore.QObject):
         """ Perform a fine alignment using the piezoelectric actuators, and only the power as the optimization conditions"""
         self.sendStatusMessage("Doing fine align with power meter and piezo actuators...")
         alignmentCurrent=self.info.get("fineAlignCurrent",ALIGNMENT_CURRENT)
-        if smu is None: smu = SMU()
+        ownSmu = smu is None
+        if ownSmu: smu = self.openInstrument(SMU)
         if piezoAlignObject is None:
             if self.piezoAlignObject is None:
-                piezoAlignObject=PiezoAlign()
+                piezoAlignObject=self.openInstrument(PiezoAlign)
             else:
                 piezoAlignObject = self.piezoAlignObject
-        pm=FineAlignPowerMeter()
+        pm=self.openInstrument(FineAlignPowerMeter)
         smu.setCurrent(alignmentCurrent)
         p0=self.main.piezoCoordinates
+        span=ALIGNMENT_FINE_SPAN
+        prior=None
+        warmStart=self._warmStart("piezo")
+        if warmStart is not None:
+            p0,warmSpan,prior=warmStart
+            span=maximum(warmSpan,ALIGNMENT_FINE_SPAN)
         tau=ALIGNMENT_TAU if self.cryostatOff else ALIGNMENT_TAU_LOWTEMP
-        profitFunc=lambda : pm.readPowerAuto(tau=tau)
-        p,power=piezoAlignObject.autoalign(p0,ALIGNMENT_FINE_RES,ALIGNMENT_FINE_SPAN,profitFunction=profitFunc)
+        profitFunc=adaptiveProfitFunction(pm,tau)
+        p,power=piezoAlignObject.autoalign(p0,ALIGNMENT_FINE_RES,span,profitFunction=profitFunc,prior=prior)
+        self._recordProfitMap("piezo",piezoAlignObject,p,alignmentCurrent)
         with QReadLocker(self.lock):
             self.main.piezoCoordinates=p
         self.sendStatusMessage("Fine alignment completed with peak at "+"(%.3f,%.3f)"%p+"um.")
         #del PiezoAlignObject, smu, profitFunc
+        # Return the SMU to the pool if it was leased here, so that the measurement can lease it with its own configuration
+        if ownSmu: self.releaseInstrument(smu)
+        return power
 
     def initTempController(self):
         """ Initializes the temperature controller. """
@@ -691,6 +836,11 @@ class Measurement(QtCore.QObject):
                     QtGui.QMessageBox.warning(None,"VisaIOError",("Please check that the temperature controller is turned on and connected properly:\n %1").arg(e.args[0]))
                     raise MeasurementAbortedError
 
+    def readTemperature(self):
+        """ Read the temperature, holding the lock shared with the temperature widget so that it can be called from a worker thread """
+        with QReadLocker(self.lock):
+            return self.tempController.getTemperature()
+
     def serializeArray(self,numpyArray):
         """ Serializes numpy array into vector for database """
         return reshape(numpyArray.transpose(),-1)
@@ -828,16 +978,20 @@ class LIV(Measurement):
         """ Cycles through each current point and does Source/Measure of IV, then power measurement. I'd like to refactor some of this code into the Measurement class 
        to avoid duplication with acquireData() method in the Spectrum class"""
         if not self.DUMMY_MODE:
-            if self.roughAlignFlag:
+            if self.roughAlignFlag and self.serviceAligned():
+                self.sendStatusMessage("Keeping the alignment found by the background alignment service")
+            elif self.roughAlignFlag:
                 self.sendStatusMessage("Initializing piezo controller to center for rough align...")
-                piezoAlignObject=PiezoAlign()
+                piezoAlignObject=self.openInstrument(PiezoAlign)
+                piezoAlignObject.moveToCenter()
                 self.roughAlign(self.preAlignFlag)
             self.initTempController()
             n=self.info["numCurrPoints"]
             #self.iSet=around(linspace(self.info["Istart"],self.info["Istop"],n),5)
             self.iSet=linspace(self.info["Istart"],self.info["Istop"],n)
-            pm=PrimaryPowerMeter()
-            smu=SMU(autoZero=False,disableScreen=True,defaultCurrent=ALIGNMENT_CURRENT)
+            pm=self.openInstrument(PrimaryPowerMeter)
+            smu=self.openInstrument(SMU,autoZero=False,disableScreen=True,defaultCurrent=ALIGNMENT_CURRENT)
+            asyncSmu=AsyncInstrument(smu)
             self.data["lMeas"]=zeros(n)
             self.data["iMeas"]=zeros(n)
             self.data["vMeas"]=zeros(n)
@@ -854,17 +1008,19 @@ class LIV(Measurement):
                     return
                 # Emit progress
                 self.sendProgress(i/n)
-                # Set current, then measure V/I/L
+                # Set current, then measure V/I on the SMU while the power meter settles and measures L
                 smu.setCurrent(self.iSet[i],self.info["Vcomp"])
-                self.data["vMeas"][i],self.data["iMeas"][i]=smu.measure()
+                ivResult=asyncSmu.measure()
                 sleep(20e-3) # 20ms wait to account for 1kHz analog filter on power meter + digital filter(10 samples)
                 try:
                     tau=LIV_TAU if self.cryostatOff else LIV_TAU_LOWTEMP
                     powerMeas=pm.readPowerAuto(tau=tau)
                 except Exception as e:                
+                    ivResult.wait()
                     QtGui.QMessageBox.warning(None,"CommError",("There was a persistent problem with the power meter:\n %1").arg(e.args[0]))
                     self.aborted.emit()
                     return
+                self.data["vMeas"][i],self.data["iMeas"][i]=ivResult.get()
                 self.data["lMeas"][i]=powerMeas                   
                 # Update the plot if not already rendering
                 QtCore.QCoreApplication.processEvents()
@@ -1033,9 +1189,13 @@ class Spectrum(Measurement):
     def acquireData(self,canvas=None,dummy=False):
         """ Acquire data """
         if not self.DUMMY_MODE:
-            if self.roughAlignFlag or self.fineAlignFlag:
+            if (self.roughAlignFlag or self.fineAlignFlag) and self.serviceAligned():
+                self.sendStatusMessage("Keeping the alignment found by the background alignment service")
+                self.piezoAlignObject=self.openInstrument(PiezoAlign)
+            elif self.roughAlignFlag or self.fineAlignFlag:
                 self.sendStatusMessage("Initializing piezo controller to center for rough align...")
-                self.piezoAlignObject=PiezoAlign()
+                self.piezoAlignObject=self.openInstrument(PiezoAlign)
+                self.piezoAlignObject.moveToCenter()
                 self.roughAlign(self.preAlignFlag)
             else:
                 self.piezoAlignObject=None
@@ -1059,6 +1219,10 @@ class Spectrum(Measurement):
                 self.mainProgressStep=1/nCurr
                 # Measure spectrum for each current
                 alignTime=0
+                spectrumTime=0
+                self.driftMonitor=DriftMonitor()
+                self._probeTime=0
+                self._probeInterval=DRIFT_PROBE_INTERVAL
                 for i in range(nCurr):
                     # Cancel the measurement if it has been aborted
                     QtCore.QCoreApplication.processEvents()
@@ -1070,28 +1234,32 @@ class Spectrum(Measurement):
                     if not self.running:
                         self.aborted.emit()
                         return
-                    # Fine-adjust the alignment to compensate for thermal/mechanical drift
+                    # Fine-adjust the alignment to compensate for thermal/mechanical drift, when the drift monitor predicts too much loss of coupling
                     if self.fineAlignFlag and POWER_METERS["fineAlign"]:
-                        if (time()-alignTime)>MIN_REALIGNMENT_TIME*60:
-                            self.fineAlign(smu=self.smu)
+                        if alignTime==0 or self._realignmentDue(alignTime,spectrumTime):
+                            alignedPower=self.fineAlign(smu=self.smu)
                             alignTime=time()
+                            self.driftMonitor.reset(alignTime,None if alignedPower is None else {"probe":alignedPower})
+                            self._probeInterval=DRIFT_PROBE_INTERVAL
                     else:
                         if i>1:
                             #self.manualAlign()
                             pass
+                    spectrumStart=time()
                     # Send the main progress and assign to self so that subprogress can be taken into account if available
                     self.mainProgress=self.mainProgressStep*i
                     self.sendProgress(self.mainProgress)
-                    # Set current, then measure V/I/L
+                    # Read the temperature while the current is set and V/I is measured
                     if not NO_TEMP_SENSOR:
-                        with QReadLocker(self.lock):
-                            self.data["temperature"][i]=self.tempController.getTemperature()                        
+                        temperatureResult=asyncCall(self.readTemperature)
+                    self.smu.setCurrent(self.iSet[i],self.info["Vcomp"])
+                    self.data["vMeas"][i],self.data["iMeas"][i]=self.smu.measure()
+                    if not NO_TEMP_SENSOR:
+                        self.data["temperature"][i]=temperatureResult.get()
                         self.cryostatOff=True if self.data["temperature"][i] > LOWTEMP_THRESHOLD else False                            
                     else:
                         self.cryostatOff=False
                         self.data["temperature"]=None
-                    self.smu.setCurrent(self.iSet[i],self.info["Vcomp"])
-                    self.data["vMeas"][i],self.data["iMeas"][i]=self.smu.measure()
                     self.currentIndex=i
                     try:
                         self.acquireSingleSpectrum(instrument,i)
@@ -1109,6 +1277,9 @@ class Spectrum(Measurement):
                         # For other exceptions, salvage data then re-raise the existing error with proper call stack
                         self.savePartialData(i)
                         raise
+                    # The spectrum integral is a coupling proxy for the drift monitor whenever the same current is measured again
+                    self.driftMonitor.addSample(self.driftMonitor.setPointKey("integral",self.iSet[i],CURRENT_MATCH_TOLERANCE),self.data["intensity"][:,i].sum())
+                    spectrumTime=time()-spectrumStart
                     self.sendStatusMessage("Finished acquiring data for spectrum "+str(self.currentIndex+1)+"/"+str(size(self.iSet)))
                     self.plot(i)
             except IOError, e:
@@ -1136,6 +1307,26 @@ class Spectrum(Measurement):
         self.finishedWork()
         self.sendProgress(1)
 
+    def _realignmentDue(self,alignTime,spectrumTime):
+        """ Return True if the drift monitor predicts that the coupling will have dropped by more than REALIGNMENT_LOSS_THRESHOLD by the
+        end of the next spectrum, which takes spectrumTime. The coupling is probed at half the predicted time until the threshold is reached,
+        or twice the last interval if no loss has been seen, between DRIFT_PROBE_INTERVAL and DRIFT_PROBE_MAX_INTERVAL """
+        now=time()
+        if now-alignTime<MIN_REALIGNMENT_TIME*60: return False
+        if now-self._probeTime>=self._probeInterval:
+            self.driftMonitor.addSample("probe",self._probeCoupling(),now)
+            self._probeTime=now
+            timeToThreshold=self.driftMonitor.timeToLoss(REALIGNMENT_LOSS_THRESHOLD,now)
+            interval=2*self._probeInterval if isinf(timeToThreshold) else timeToThreshold/2
+            self._probeInterval=clip(interval,DRIFT_PROBE_INTERVAL,DRIFT_PROBE_MAX_INTERVAL)
+        return self.driftMonitor.predictedLoss(now+spectrumTime)>REALIGNMENT_LOSS_THRESHOLD
+
+    def _probeCoupling(self):
+        """ Cheap coupling proxy for the drift monitor, which is a single reading of the fine align power meter at the fine align current """
+        pm=self.openInstrument(FineAlignPowerMeter)
+        self.smu.setCurrent(self.info.get("fineAlignCurrent",ALIGNMENT_CURRENT))
+        return pm.readPowerAuto(tau=ALIGNMENT_TAU if self.cryostatOff else ALIGNMENT_TAU_LOWTEMP)
+
     def savePartialData(self,i):
         if i > 0:
             self.data["wavelength"]=self.data["wavelength"][:,0:i]
@@ -1399,7 +1590,7 @@ class AdvantestSpectrum(Spectrum):
         self.info["type"]="AdvantestSpectrum"
     def initInstrument(self):
         """ Creates a reference to the instrument and initializes it to settings required before the start of a measurement """
-        osa=SpectrumAnalyzer()
+        osa=self.openInstrument(SpectrumAnalyzer)
         osa.setCenter(self.info["Center"]*1e9)
         osa.setNumPoints(self.info["numLambdaIndex"])
         osa.setResolution(self.info["Resolution"]*1e9)
@@ -1415,14 +1606,18 @@ class WinspecSpectrum(Spectrum):
     def __init__(self, *args, **kwargs):
         super(WinspecSpectrum, self).__init__(*args, **kwargs)
         self.info["type"]="WinspecSpectrum"
+        # asynchronous power meter reading which is in progress during the Winspec exposure, and the power meter it's read through
+        self._pendingPower=None
+        self._asyncPm=None
 
     def initInstrument(self):
         """ Creates a reference to the instrument and initializes it to settings required before the start of a measurement """
         if self.controlCurrent:
             # Create new object for winspec analyzer and set it up for the specified measurement
-            self.smu=SMU(autoZero=True,defaultCurrent=ALIGNMENT_CURRENT)
+            self.smu=self.openInstrument(SMU,autoZero=True,defaultCurrent=ALIGNMENT_CURRENT)
         else:
-            self.smu=DummySMU()
+            # The current is set by hand, except when simulating, where there's nobody to ask so the simulated SMU is set instead
+            self.smu=SMU() if SIMULATE else DummySMU()
         # Create a directory structure for the raw winspec data files if one doesn't already exist
         winspecDataPath=os.path.join(os.path.dirname(__DBPATH__),os.path.splitext(os.path.split(__DBPATH__)[1])[0]+"_winspec")
         if not os.path.exists(winspecDataPath):
@@ -1435,16 +1630,19 @@ class WinspecSpectrum(Spectrum):
         if not os.path.exists(winspecDataPath):
             os.makedirs(winspecDataPath)
         self.winspecDataPath=winspecDataPath
-        self.osa=osa=WinspecAnalyzer(self.smu.setOutputState,winspecDataPath)
+        self.osa=osa=WinspecAnalyzer(self._switchInput,winspecDataPath)
         osa.setResolution(self.info["Resolution"]*1e9)
         osa.setCenter(self.info["Center"]*1e9)
         osa.setNumPoints(self.info["numLambdaPoints"])
-        if osa.has2dDetector(): osa.autoSetROI()
+        if osa.has2dDetector(): osa.autoSetROI(self._alignmentState())
         if self.info["optimizeCenter"]:
             self.smu.setCurrent(self.iSet[-1],self.info["Vcomp"])
-            newCenter = osa.measureOptimalCenter()
-            osa.setCenter(newCenter)
-            self.info["Center"], self.info["CenterSet"] = newCenter*1e-9, self.info["Center"]
+            newCenter, confidence = osa.measureOptimalCenter()
+            if confidence >= MIN_CENTER_CONFIDENCE:
+                osa.setCenter(newCenter)
+                self.info["Center"], self.info["CenterSet"] = newCenter*1e-9, self.info["Center"]
+            else:
+                self.sendStatusMessage("Peak luminescence is poorly defined (confidence %.2f), so keeping the specified center" % confidence)
         return osa
 
     def acquireData(self,canvas=None,dummy=False):
@@ -1453,6 +1651,10 @@ class WinspecSpectrum(Spectrum):
             self.data["opticalEfficiency"]=zeros(self.info["numCurrPoints"])
             # keep track of the gain used for the measurement to improve learning condition for detector saturation
             self.gainSetting=zeros(self.info["numCurrPoints"])
+            # state of the power meter calibration, which is carried over from one spectrum to the next
+            self._pmBackground=None
+            self._calibratedEfficiency=[]
+            self._skippedCalibrations=0
         # call the acquireData() method of the main Spectrum parent class
         super(WinspecSpectrum, self).acquireData(canvas,dummy)
         # finally take note of the measured CPS data vs input power so it can be used to estimate exposure time next measurement
@@ -1461,21 +1663,34 @@ class WinspecSpectrum(Spectrum):
 
     def acquireSingleSpectrum(self,osa,idx):
         """ Finds the optimal exposure time, and acquires a single spectrum
-        then sets the data in self.data["wavelength"], self.data["intensity"] """
-        # Measure the power using a calibrated source as reference for absolute power
+        then sets the data in self.data["wavelength"], self.data["intensity"].
+        If the power meter calibration is skipped then the efficiency of the last calibration is used for the spectrum, and the
+        power on the secondary power meter (for the drift monitor) is estimated from the spectrum with it """
+        # Measure the power using a calibrated source as reference for absolute power, unless the efficiency has been stable enough to skip it
+        calibratedPower=None
         if POWER_METERS["secondary"]:
-            tau=ALIGNMENT_TAU if self.cryostatOff else ALIGNMENT_TAU_LOWTEMP
-            pm=SecondaryPowerMeter()
-            self.smu.setOutputState("OFF")
-            bg=pm.readPowerAuto(tau=tau)
-            self.smu.setOutputState("ON")
-            totalInputPower=max(pm.readPowerAuto(tau=tau)-bg,1e-12)
+            if self._powerCalibrationDue():
+                self._skippedCalibrations=0
+                calibratedPower=self._startPowerCalibration()
+            else:
+                self._skippedCalibrations+=1
+                osa.efficiency=self._calibratedEfficiency[-1]
+                self.sendStatusMessage("Optical efficiency is stable, so skipping the power meter calibration")
         # Specify the filename for the raw data
         self.osa.setDataFilename(str(self.iSet[self.currentIndex]*1e3).replace(".","p")+"mA")
         self.sendStatusMessage("Acquiring data for spectrum "+str(self.currentIndex+1)+"/"+str(size(self.iSet))+" starting with rangeIndex = " + str(osa.rangeIndex))
         tau=SPECTRUM_TAU if self.cryostatOff else SPECTRUM_TAU_LOWTEMP
-        calibratedPower=totalInputPower if POWER_METERS["secondary"] else None
-        wavelength,intensity,info=osa.obtainSpectrum(tau,calibratedPower)
+        try:
+            wavelength,intensity,info=osa.obtainSpectrum(tau,calibratedPower)
+        finally:
+            # Don't leave the reading running if obtainSpectrum failed, or it would overlap with the next one on the same connection
+            if self._pendingPower is not None: self._pendingPower.wait()
+            self._pendingPower=None
+        if POWER_METERS["secondary"]:
+            if calibratedPower is not None:
+                self._calibratedEfficiency.append(info["efficiency"])
+            # The total power on the secondary power meter is a coupling proxy for the drift monitor whenever the same current is measured again
+            self.driftMonitor.addSample(self.driftMonitor.setPointKey("secondaryPower",self.iSet[idx],CURRENT_MATCH_TOLERANCE),info["calibratedPower"])
         self.data["opticalEfficiency"][self.currentIndex]=info["efficiency"]
         self.data["SNR"][self.currentIndex]=info["SNR"]
         # return the data output
@@ -1483,6 +1698,51 @@ class WinspecSpectrum(Spectrum):
         self.data["wavelength"][:,idx]=wavelength
         self.data["intensity"][:,idx]=intensity   
 
+    def _powerCalibrationDue(self):
+        """ The power meter calibration is only needed if the optical efficiency drifted by more than POWER_CAL_DRIFT_THRESHOLD between the
+        last two calibrations, or if it's already been skipped POWER_CAL_MAX_SKIP times in a row """
+        eff=self._calibratedEfficiency
+        if len(eff)<2 or self._skippedCalibrations>=POWER_CAL_MAX_SKIP:
+            return True
+        return abs(eff[-1]-eff[-2]) > POWER_CAL_DRIFT_THRESHOLD*abs(eff[-2])
+
+    def _startPowerCalibration(self):
+        """ Start reading the total input power on the secondary power meter in the background, so that the reading overlaps with the Winspec exposure.
+        Returns a function which waits for the reading and returns the background-subtracted power, for use as calibratedPower in obtainSpectrum """
+        tau=ALIGNMENT_TAU if self.cryostatOff else ALIGNMENT_TAU_LOWTEMP
+        # All the readings of the power meter go through one AsyncInstrument, so that they're made one at a time and in order
+        pm=self.openInstrument(SecondaryPowerMeter)
+        if self._asyncPm is None or self._asyncPm.instrument is not pm:
+            self._asyncPm=AsyncInstrument(pm)
+        pm=self._asyncPm
+        if self._pmBackground is None or self._pmBackground["tau"]!=tau:
+            self._measurePowerBackground(pm,tau)
+        self._pendingPower=pm.readPowerAuto(tau=tau)
+        def calibratedPower():
+            signal=self._pendingPower.get()
+            powerRange=floor(log10(maximum(signal,1e-12)))
+            if self._pmBackground["range"] is None:
+                self._pmBackground["range"]=powerRange
+            elif self._pmBackground["range"]!=powerRange:
+                # The power meter has changed range since the background was measured, so remeasure it now that the exposure is done
+                self._measurePowerBackground(pm,tau,powerRange)
+            return maximum(signal-self._pmBackground["power"],1e-12)
+        return calibratedPower
+
+    def _measurePowerBackground(self,pm,tau,powerRange=None):
+        """ Measure the background of the secondary power meter (an AsyncInstrument) with the laser off, and cache it together with the
+        range of the signal """
+        self.smu.setOutputState("OFF")
+        bg=pm.readPowerAuto(tau=tau).get()
+        self.smu.setOutputState("ON")
+        self._pmBackground={"tau":tau,"range":powerRange,"power":bg}
+
+    def _switchInput(self,state):
+        """ Input state switch for the analyzer, which lets any power meter reading in progress finish before the laser is switched off """
+        if not state and self._pendingPower is not None:
+            self._pendingPower.wait()
+        self.smu.setOutputState(state)
+
     def estimateCPS(self,inputPower,gain):
         """ Helper function which estimates what the CPS at the detector should be given the inputPower """
         # Flag to control whether or not we measure the calibration data
@@ -1614,38 +1874,40 @@ class WinspecGainSpectrum(WinspecSpectrum):
         elif method=="winspec":
             self.sendStatusMessage("Checking the fine alignment...")
             winspecAnalyzer=self.osa
-            winspecAnalyzer.setNumPoints(3072)
-            winspecAnalyzer.setDataFilename()
             alignmentCurrent=self.info.get("fineAlignCurrent",ALIGNMENT_FINE_CURRENT_DEFAULT)
             self.smu.setCurrent(alignmentCurrent)
-            tau=ALIGNMENT_TAU if self.cryostatOff else ALIGNMENT_TAU_LOWTEMP
             p0=self.main.piezoCoordinates
-            # profitFunction=powerMeter.readPowerAuto(tau=tau)
+            # Measure a single detector frame centered on the lasing peak at each point, rather than stitching together a wide spectrum
+            center=winspecAnalyzer.getCenter()
+            winspecAnalyzer.setNumPoints(winspecAnalyzer.getNumberOfPixels())
+            winspecAnalyzer.setDataFilename()
+            peakCenter,confidence=winspecAnalyzer.measureOptimalCenter()
+            if confidence >= MIN_CENTER_CONFIDENCE: winspecAnalyzer.setCenter(peakCenter)
+            window=[]
             def profitFuncRipple():
-                """ returns the peak intensity minus the sum of the ripple in each of the modes in the Fabry-Perot spectrum """
-                wavelength,intensity,dict=winspecAnalyzer.obtainSpectrum(tau)
+                """ returns the peak intensity minus the mean ripple of the modes in the Fabry-Perot spectrum, within a window around the lasing peak """
+                wavelength,intensity,info=winspecAnalyzer.obtainSpectrum(ALIGNMENT_RIPPLE_TAU)
+                # The window is found from the first spectrum and then kept for the following points of the alignment, so that their
+                # ripple is comparable, until the lasing peak moves out of it
+                peak=argmax(intensity)
+                if not window or not window[0].start<=peak<window[0].stop:
+                    inWindow=nonzero(abs(wavelength-wavelength[peak])<=ALIGNMENT_RIPPLE_WINDOW)[0]
+                    window[:]=[slice(inWindow[0],inWindow[-1]+1)]
+                wavelength,intensity=wavelength[window[0]],intensity[window[0]]
                 maxIdxRaw=peakDetect(intensity)
                 maxIdx=peakClean(wavelength,intensity,maxIdxRaw)
-                ripplePeakIdx=setdiff1d(maxIdxRaw,maxIdx)
-                #self.main.canvas.plot(wavelength,intensity,wavelength[maxIdxRaw],intensity[maxIdxRaw],"x",wavelength[maxIdx],intensity[maxIdx],"o")
-                #QtCore.QCoreApplication.processEvents()
-                # Go through each mode and calculate the magnitude of the ripple
-                rippleSum=0.0
-                for M in range(len(maxIdx)-1):
-                    ripplePeakIdxM=ripplePeakIdx[logical_and(ripplePeakIdx>maxIdx[M],ripplePeakIdx<maxIdx[M+1])]
-                    if len(ripplePeakIdxM)>0:
-                        # Calculate difference between maximum ripple peak and minimum value of the current mode
-                        rippleMagM=max(intensity[ripplePeakIdxM])-min(intensity[maxIdx[M]:maxIdx[M+1]])
-                        peakMagM=intensity[maxIdx[M]]-min(intensity[maxIdx[M]:maxIdx[M+1]])
-                        rippleSum+=rippleMagM
-                return intensity.max()-10*rippleSum/len(maxIdx)
-            p,power=self.piezoAlignObject.autoalign(p0,ALIGNMENT_FINE_RES,ALIGNMENT_FINE_SPAN,profitFunction=profitFuncRipple)
-            finalProfit=profitFuncRipple()
+                if len(maxIdx)==0: return intensity.max()
+                return intensity.max()-10*modeRipple(intensity,maxIdxRaw,maxIdx).sum()/len(maxIdx)
+            try:
+                p,power=self.piezoAlignObject.autoalign(p0,ALIGNMENT_FINE_RES,ALIGNMENT_FINE_SPAN,profitFunction=profitFuncRipple)
+                finalProfit=profitFuncRipple()
+            finally:
+                winspecAnalyzer.setCenter(center)
+                winspecAnalyzer.setNumPoints(self.info["numLambdaPoints"])
             # Save the coodinates to the main object using a mutex in-case multi-threading is enabled
             with QReadLocker(self.lock):
                 self.main.piezoCoordinates=p
-            self.sendStatusMessage("Optimal position found at ("+str(round(p[0][0],3))+","+str(round(p[1][0],3))+") um with detected power of "+str(round(power*1e6,3))+"uW")
-            winspecAnalyzer.setNumPoints(self.info["numLambdaPoints"])
+            self.sendStatusMessage("Optimal position found at ("+str(round(p[0],3))+","+str(round(p[1],3))+") um with detected power of "+str(round(power*1e6,3))+"uW")
 
     def getAllGainPeakEnergies(self,threshold=0):
         """ Returns the energies of the gain peaks for each current"""
@@ -1891,9 +2153,13 @@ class RinSpectrum(Spectrum):
         self.data["photoCurrent"]=zeros(self.info["numCurrPoints"])
         self.info["highResMode"]=True
         self.info["measureFeedback"]=True
+        # Acquire the high resolution window at each current during the main sweep, instead of in a second sweep afterwards
+        self.info["singlePass"]=True
+        # RIN matrices calculated by getRin(), which are cleared whenever new data is acquired
+        self._rinCache={}
 
     def finishedWork(self, *args, **kwargs):
-        if self.info["highResMode"]:
+        if self.info["highResMode"] and not self.info["singlePass"]:
             # do a second high res measurement before finishing the measurement
             self.sendStatusMessage("Taking high resolution measurements...")
             self.acquireHighResData()
@@ -1901,25 +2167,29 @@ class RinSpectrum(Spectrum):
 
     def acquireData(self,*args, **kwargs):
         if self.info["measureFeedback"]:
-            pm=PrimaryPowerMeter()
-            smu=SMU(defaultCurrent=FEEDBACK_CALIBRATION_CURRENT)
-            smu.setCurrent(FEEDBACK_CALIBRATION_CURRENT)
-            smu.setOutputState(True)
-            power=pm.readPowerAuto()
-            defaultReferencePower=1.616e-3  # TODO: store/restore this from preferences
-            defaultFeedback=10*log10(power/defaultReferencePower)
-            # Ask user to confirm the reference level for feedback measurement
-            feedbackRefPower,status=QtGui.QInputDialog.getDouble(None,"Ref power",
-                    "Enter the 0dB ref power (mW) \nCurrent feedback level = "+"{:0.2f}".format(defaultFeedback)+" dB",
-                        defaultReferencePower*1000,0,inf,3)
-            # Measure the feeback amount if the user didn't abort
-            if status:
+            pm=self.openInstrument(PrimaryPowerMeter)
+            smu=self.openInstrument(SMU,defaultCurrent=FEEDBACK_CALIBRATION_CURRENT)
+            try:
+                smu.setCurrent(FEEDBACK_CALIBRATION_CURRENT)
                 smu.setOutputState(True)
-                self.data["feedbackAmount"]=fb=pm.readPowerAuto()*1000/feedbackRefPower
-                self.info["Name"]=self.info["Name"]+" ({:0.2f}dB feedback)".format(10*log10(fb))
-            else:
-                print("Measurement aborted")
-                return
+                power=pm.readPowerAuto()
+                defaultReferencePower=1.616e-3  # TODO: store/restore this from preferences
+                defaultFeedback=10*log10(power/defaultReferencePower)
+                # Ask user to confirm the reference level for feedback measurement
+                feedbackRefPower,status=QtGui.QInputDialog.getDouble(None,"Ref power",
+                        "Enter the 0dB ref power (mW) \nCurrent feedback level = "+"{:0.2f}".format(defaultFeedback)+" dB",
+                            defaultReferencePower*1000,0,inf,3)
+                # Measure the feeback amount if the user didn't abort
+                if status:
+                    smu.setOutputState(True)
+                    self.data["feedbackAmount"]=fb=pm.readPowerAuto()*1000/feedbackRefPower
+                    self.info["Name"]=self.info["Name"]+" ({:0.2f}dB feedback)".format(10*log10(fb))
+                else:
+                    print("Measurement aborted")
+                    return
+            finally:
+                # Return the SMU to the pool, so that the spectrum measurement can lease it with its own configuration
+                self.releaseInstrument(smu)
 
         return super(RinSpectrum, self).acquireData(*args,**kwargs)
 
@@ -1932,8 +2202,7 @@ class RinSpectrum(Spectrum):
             # Create instance and initialize instrument for capturing spectral data
             instrument=self.initInstrument()
             # Set higher resolution values for frequency and span
-            self.osa.setCenter(0.9)
-            self.osa.setSpan(1.8)
+            self.setSweepWindow(highResMode=True)
             # Create empty data arrays for high res data
             self.data["freqHighRes"]=zeros((mLambda,nCurr))
             self.data["powerHighRes"]=zeros((mLambda,nCurr))
@@ -1964,80 +2233,92 @@ class RinSpectrum(Spectrum):
 
     def initInstrument(self):
         """ Creates a reference to the instrument and initializes it to settings required before the start of a measurement """
-        self.smu=SMU(autoZero=True,defaultCurrent=ALIGNMENT_CURRENT,currRange=1)
-        self.osa=osa=SpectrumAnalyzer()
+        self.smu=self.openInstrument(SMU,autoZero=True,defaultCurrent=ALIGNMENT_CURRENT,currRange=1)
+        self.osa=osa=self.openInstrument(SpectrumAnalyzer)
         osa.setCenter(self.info["Center"]/1e9)
         osa.setSpan(self.info["Span"]/1e9)
         osa.setAttenuator(False,0)
         osa.setRbw(14) # 3MHz
         osa.setVbw(4) # 10kHz
         # leave sweep time set to auto. osa.setSweepTime(False,1000)
-        self.dmm=DMM()
+        self.dmm=self.openInstrument(DMM)
         self.dmm.setAuto()
         return osa
+
+    def setSweepWindow(self,highResMode=False):
+        """ Set the center and span of the ESA to either the main window or the high resolution window """
+        if highResMode:
+            self.osa.setCenter(RIN_HIGH_RES_CENTER)
+            self.osa.setSpan(RIN_HIGH_RES_SPAN)
+        else:
+            self.osa.setCenter(self.info["Center"]/1e9)
+            self.osa.setSpan(self.info["Span"]/1e9)
+
     def acquireSingleSpectrum(self,osa,idx,highResMode=False):
-        """ Acquires a single spectrum and sets data in self.data["wavelength"], self.data["intensity"] """
-        noiseBandwidth=self.osa.getNoiseBandwidth()
+        """ Acquires a single spectrum and sets data in self.data["wavelength"], self.data["intensity"]. 
+        In single pass mode the high resolution window is acquired straight afterwards at the same current using the same instruments.
+        The photocurrent is read from the DMM while the ESA is sweeping """
+        self._rinCache={}
+        # Windows to acquire at this current, where True is the high resolution window
+        windows=[False,True] if self.info["singlePass"] and self.info["highResMode"] and not highResMode else [highResMode]
         if idx == 0:
-            # Acquire background level on first measurement
+            # Acquire background level for each window on first measurement
+            thermalNoisePower={}
             self.smu.setOutputState("OFF")
-            f,bkg=self.osa.obtainSpectrum()
-            thermalNoisePower=bkg/noiseBandwidth
+            for window in windows:
+                if len(windows)>1: self.setSweepWindow(window)
+                f,bkg=self.osa.obtainSpectrum()
+                thermalNoisePower[window]=bkg/self.osa.getNoiseBandwidth()
             self.smu.setOutputState("ON")
-        x,y=self.osa.obtainSpectrum()
-        photoCurrent = self.dmm.measure()/self.info["dcConversion"]
-        if highResMode:
-            # Optionally store the data in a separate array from main data for high resolution window
-            self.data["freqHighRes"][:,idx]=x
-            self.data["powerHighRes"][:,idx]=y/noiseBandwidth
-            if idx==0: self.data["thermalNoisePowerHighRes"]=thermalNoisePower
-        else:
-            # Store the data in the main array
-            self.info["noiseBandwidth"]=noiseBandwidth
-            if idx==0: self.data["thermalNoisePower"]=thermalNoisePower
-            # Measure DC component and calculate shot noise component. Assume 50ohm matched load
+            if len(windows)>1:
+                self.data["freqHighRes"]=zeros((self.info["numLambdaPoints"],self.info["numCurrPoints"]))
+                self.data["powerHighRes"]=zeros((self.info["numLambdaPoints"],self.info["numCurrPoints"]))
+        # Measure DC component while the ESA sweeps
+        dcResult=AsyncInstrument(self.dmm).measure()
+        for window in windows:
+            if len(windows)>1: self.setSweepWindow(window)
+            noiseBandwidth=self.osa.getNoiseBandwidth()
+            x,y=self.osa.obtainSpectrum()
+            if window:
+                # Optionally store the data in a separate array from main data for high resolution window
+                self.data["freqHighRes"][:,idx]=x
+                self.data["powerHighRes"][:,idx]=y/noiseBandwidth
+                if idx==0: self.data["thermalNoisePowerHighRes"]=thermalNoisePower[window]
+            else:
+                # Store the data in the main array
+                self.info["noiseBandwidth"]=noiseBandwidth
+                if idx==0: self.data["thermalNoisePower"]=thermalNoisePower[window]
+                # Measure AC component. NOTE: using "wavelength" key, but actually frequency!
+                # TODO: Change key names!
+                self.data["wavelength"][:,idx]=x
+                self.data["intensity"][:,idx]=y/noiseBandwidth
+        photoCurrent = dcResult.get()/self.info["dcConversion"]
+        if not highResMode:
+            # Calculate shot noise component from the DC component. Assume 50ohm matched load
             self.data["photoCurrent"][idx]=photoCurrent
-            # Measure AC component. NOTE: using "wavelength" key, but actually frequency!
-            # TODO: Change key names!
-            self.data["wavelength"][:,idx]=x
-            self.data["intensity"][:,idx]=y/noiseBandwidth
         
 
     def plot(self,index=None,xLim=None,pLim=None,xAxisUnit="energy",title=None,offset=False,logscale=True, highResMode=False, reverse=False):
-        numSpectra=shape(self.data["wavelength"])[1]
+        numSpectra=self.numAcquired()
+        # Use high resolution data if requested and available, otherwise use ordinary data
+        freq,rin=self.getRin(highResMode and "freqHighRes" in self.data)
         if index is None:
-            if (not highResMode or not "freqHighRes" in self.data):
-                # Use ordinary data
-                startIdx=nonzero(self.data["wavelength"] >= RIN_MIN_FREQ)[0][0]
-                x=[self.data["wavelength"][startIdx:,i]/1e9 for i in range(numSpectra)]
-                y=[self.powerDensityToRin(self.data["intensity"][startIdx:,i],self.data["thermalNoisePower"][startIdx:],self.data["photoCurrent"][i])
-                    for i in range(numSpectra)]
-            else:
-                # Use high resolution data
-                startIdx=nonzero(self.data["freqHighRes"] >= RIN_MIN_FREQ)[0][0]
-                x=[self.data["freqHighRes"][startIdx:,i]/1e9 for i in range(numSpectra)]
-                y=[self.powerDensityToRin(self.data["powerHighRes"][startIdx:,i],self.data["thermalNoisePowerHighRes"][startIdx:],self.data["photoCurrent"][i])
-                    for i in range(numSpectra)]
-            iMeas=self.data["iMeas"]
+            x=[freq[:,i]/1e9 for i in range(numSpectra)]
+            y=[rin[:,i] for i in range(numSpectra)]
+            iMeas=self.data["iMeas"][:numSpectra]
             if reverse:
                 order=argsort(iMeas)[::-1]
                 iMeas=iMeas[order]
                 x=[x[i] for i in order]
                 y=[y[i] for i in order]
-            lineProp=["x-" for i in self.data["iMeas"]]
+            lineProp=["x-" for i in iMeas]
             legend=["{:0.0f}".format(iMeas[i]*1000)+"mA" for i in range(len(iMeas))]
             yAxis={"data":tuple(y),"label":"Relative Intensity Noise (dB/Hz)","legend":legend,"lineProp":lineProp}
             if title is None:
                 title=r"RIN vs frequency and current"
         else:
-            if (not highResMode or not "freqHighRes" in self.data):
-                startIdx=nonzero(self.data["wavelength"] >= RIN_MIN_FREQ)[0][0]
-                x=(self.data["wavelength"][startIdx:,index]/1e9,)
-                y=(self.powerDensityToRin(self.data["intensity"][startIdx:,index],self.data["thermalNoisePower"][startIdx:],self.data["photoCurrent"][index]),)
-            else:
-                startIdx=nonzero(self.data["freqHighRes"] >= RIN_MIN_FREQ)[0][0]
-                x=(self.data["freqHighRes"][startIdx:,index]/1e9,)
-                y=(self.powerDensityToRin(self.data["powerHighRes"][startIdx:,index],self.data["thermalNoisePowerHighRes"][startIdx:],self.data["photoCurrent"][index]),)
+            x=(freq[:,index]/1e9,)
+            y=(rin[:,index],)
             #iMeas=[self.data["iMeas"][index]]
             yAxis={"data":tuple(y),"label":"Relative Intensity Noise (dB/Hz)"}
             if title is None:
@@ -2058,26 +2339,49 @@ class RinSpectrum(Spectrum):
         """ Return the power in Watts given power in dBm """
         return 10*log10(power/1e-3)
 
+    def numAcquired(self):
+        """ Number of currents (columns of the data) acquired so far, which is all of them once the measurement has finished """
+        numSpectra=shape(self.data["wavelength"])[1]
+        return minimum(getattr(self,"currentIndex",numSpectra-1)+1,numSpectra)
+
+    def getRin(self,highResMode=False):
+        """ Return the frequency [Hz] and RIN [dB/Hz] above RIN_MIN_FREQ as matrices with one column per current, 
+        optionally using the high resolution data. The RIN of the currents which haven't been acquired yet is NaN.
+        The matrices are cached until new data is acquired """
+        if not hasattr(self,"_rinCache"): self._rinCache={}
+        if highResMode not in self._rinCache:
+            if highResMode:
+                freq,power,thermalNoise=self.data["freqHighRes"],self.data["powerHighRes"],self.data["thermalNoisePowerHighRes"]
+            else:
+                freq,power,thermalNoise=self.data["wavelength"],self.data["intensity"],self.data["thermalNoisePower"]
+            n=self.numAcquired()
+            startIdx=nonzero(freq[:,:n] >= RIN_MIN_FREQ)[0][0]
+            rin=zeros(shape(power[startIdx:]))*NaN
+            rin[:,:n]=self.powerDensityToRin(power[startIdx:,:n],thermalNoise[startIdx:],self.data["photoCurrent"][:n])
+            self._rinCache[highResMode]=(freq[startIdx:],rin)
+        return self._rinCache[highResMode]
+
     def powerDensityToRin(self,power,thermalNoise, photoCurrent, filter=True):
         """ Return the relative intensity noise given:
-         power: spectral power density due to light in W/Hz
-         thermalNoise: SPD due to thermal noise in specan, etc in W/Hz
-         photoCurrent: photocurrent in amperes generated by photodetector
+         power: spectral power density due to light in W/Hz (vector, or matrix with one column per photoCurrent)
+         thermalNoise: SPD due to thermal noise in specan, etc in W/Hz (vector)
+         photoCurrent: photocurrent in amperes generated by photodetector (scalar, or vector with one value per column of power)
          """
+        power=asarray(power)
+        thermalNoise=asarray(thermalNoise)
+        # Noise floor is calculated from the thermal noise vector before it is broadcast over the columns
+        noiseThreshold=2*std(thermalNoise)
+        if power.ndim==2: thermalNoise=thermalNoise[:,newaxis]
         # Laser Noise
         Pl = self.wattsToDbm(abs(power-thermalNoise))
         # Electrical power in dBm of photocurrent into matched 50ohms
-        Pe = self.wattsToDbm((photoCurrent)**2*50/2*self.info["preampGain"])
+        Pe = self.wattsToDbm(asarray(photoCurrent)**2*50/2*self.info["preampGain"])
         # Laser RIN
         rin = Pl - Pe
         # Filter values below the noise floor, replacing with noise floor
         if filter:
-            noiseMean=mean(thermalNoise)
-            noiseStd=std(thermalNoise)
-            noiseThreshold=2*noiseStd
             valid = (power-thermalNoise) > noiseThreshold
-            for idx in range(len(valid)):
-                if not valid[idx]: rin[idx]=self.wattsToDbm(noiseThreshold)-Pe
+            rin = where(valid, rin, self.wattsToDbm(noiseThreshold)-Pe)
         return rin
 
 class MeasurementAbortedError(Exception): pass
@@ -3,6 +3,8 @@ from PyQt4 import QtCore, QtGui
 import time, inspect
 import numpy as np
 from measurement import LIV, AdvantestSpectrum, WinspecSpectrum, WinspecGainSpectrum, SignalTooWeakError
+from instrumentpool import instrumentPool
+from alignmentservice import AlignmentService
 
 
 
@@ -10,6 +12,7 @@ TEMPERATURE_ERROR_THRESHOLD=5          # Temperature error below which we start
 TEMP_STABILITY_THRESHOLD=0.1
 TEMP_REMEASUREMENT_INTERVAL=1          # Interval at which we remeasure the temperature to see if the set point has been reached [s]
 BUFFER_LEN=20
+BACKGROUND_ALIGNMENT=True              # Keep the alignment optimal with an AlignmentService while waiting for each temperature point
            
 class Profile(QtCore.QObject):
     """ Class which controls a specific measurement profile """
@@ -33,6 +36,8 @@ class Profile(QtCore.QObject):
         self.main=parent
         self.lock=lock
         self.tempSetPoints=np.array([])
+        self.backgroundAlignment=BACKGROUND_ALIGNMENT
+        self.alignmentService=None
 
     @QtCore.pyqtSlot()
     def canceled(self):
@@ -44,25 +49,40 @@ class Profile(QtCore.QObject):
         self.profileStatus.emit(msg)
 
     def moveToTemp(self,temperature,waitTime):
-        """ Set the temperature, wait for it to reach its set point, then wait waitTime [minutes] for everything to stabilize """
+        """ Set the temperature, wait for it to reach its set point, then wait waitTime [minutes] for everything to stabilize.
+        If the profile has any measurements which align, then the alignment service keeps the coupling optimal while waiting """
         self.tempController.setTemperature(temperature)
         measBuffer=np.array([])
         measBuffer=np.append(measBuffer,self.tempController.getTemperature())
-        self.testProgress.emit(0)
-        self.testStatus.emit("Waiting for temperature to reach set-point")
-        while not self.temperatureStable(temperature,measBuffer):
-            time.sleep(TEMP_REMEASUREMENT_INTERVAL)
-            QtCore.QCoreApplication.processEvents()
-            measBuffer=np.append(measBuffer,self.tempController.getTemperature())[-BUFFER_LEN:]            
-        self.testStatus.emit("Waiting "+str(waitTime)+" minutes for temperature to stabilize")
-        t0=time.time()
-        while (time.time()-t0) < waitTime*60:
-            self.testProgress.emit((time.time()-t0)/waitTime/60*100)
-            time.sleep(TEMP_REMEASUREMENT_INTERVAL)
-            QtCore.QCoreApplication.processEvents()
+        service=self.alignmentService if self.needsAlignment() else None
+        if service is not None:
+            service.temperature=measBuffer[-1]
+            service.start()
+        try:
+            self.testProgress.emit(0)
+            self.testStatus.emit("Waiting for temperature to reach set-point")
+            while not self.temperatureStable(temperature,measBuffer):
+                time.sleep(TEMP_REMEASUREMENT_INTERVAL)
+                QtCore.QCoreApplication.processEvents()
+                measBuffer=np.append(measBuffer,self.tempController.getTemperature())[-BUFFER_LEN:]
+                if service is not None: service.temperature=measBuffer[-1]
+            self.testStatus.emit("Waiting "+str(waitTime)+" minutes for temperature to stabilize")
+            t0=time.time()
+            while (time.time()-t0) < waitTime*60:
+                self.testProgress.emit((time.time()-t0)/waitTime/60*100)
+                time.sleep(TEMP_REMEASUREMENT_INTERVAL)
+                QtCore.QCoreApplication.processEvents()
+        finally:
+            if service is not None:
+                self.testStatus.emit("Waiting for the background alignment to finish")
+                service.stop()
         self.testProgress.emit(1)
         self.testStatus.emit("Temperature stabilized!")
 
+    def needsAlignment(self):
+        """ Whether the background alignment should be run, i.e. it's enabled and any of the measurements does a rough or fine alignment """
+        return self.backgroundAlignment and any(spec["info"].get("roughAlign") or spec["info"].get("fineAlign") for spec in self.measurementSpecs)
+
     def temperatureStable(self,setTemperature,measBuffer):
         if len(measBuffer)<BUFFER_LEN:
             return False
@@ -86,6 +106,18 @@ class Profile(QtCore.QObject):
         self.define()
         self.numPoints=numPoints=len(self.tempSetPoints)
         self.allMeasurements=[]
+        self.alignmentService=AlignmentService(self.main,self.lock,instrumentPool,statusMessage=self.testStatus)
+        try:
+            self._runPoints(numPoints)
+        finally:
+            # Close the shared instrument connections so they return to front panel control
+            instrumentPool.close()
+        # Move back to room temperature and emit finished signal at end of the test
+        #self.moveToTemp(300,0)
+        self.finished.emit()
+
+    def _runPoints(self,numPoints):
+        """ Step through each temperature point and run each measurement, reusing the instrument connections from instrumentPool """
         for idx in range(numPoints):
             self.idx=idx
             self.profileProgress.emit(idx/numPoints*100)
@@ -99,6 +131,8 @@ class Profile(QtCore.QObject):
                 # Get the specifications for and create the current measurement object
                 spec=self.measurementSpecs[specIdx]
                 measurement=spec["class"](self.renderDictionary(spec["info"],idx),parent=self.main,lock=self.lock)
+                measurement.pool=instrumentPool
+                measurement.alignmentService=self.alignmentService
                 self.profileProgress.emit((idx+specIdx/len(self.measurementSpecs))/numPoints*100)
                 self.sendProfileStatus("Test "+str(specIdx+1)+"/"+str(len(self.measurementSpecs))+" ("+spec["info"]["Label"]+ ") at "+str(self.tempSetPoints[idx])+ "K temperature point "+str(idx+1)+"/"+str(numPoints))
                 # Forwarded signals
@@ -109,19 +143,24 @@ class Profile(QtCore.QObject):
                 measurement.measError.connect(self.profileError)
                 self.readyToDraw.connect(measurement.readyToDraw)
                 # Acquire data and save each to db
+                failed=True
                 try:
-                    measurement.acquireData()
-                except SignalTooWeakError as e:
-                    t0=time.time()
-                    while (time.time()-t0) < 60*60:
-                        self.sendProfileStatus("SignalTooWeakError occured; waiting 60min and trying again")
-                        self.testProgress.emit((time.time()-t0)/60/60*100)
-                        time.sleep(TEMP_REMEASUREMENT_INTERVAL)
-                        QtCore.QCoreApplication.processEvents()
                     try:
                         measurement.acquireData()
                     except SignalTooWeakError as e:
-                        raise
+                        # Don't hold on to the instruments while waiting
+                        measurement.releaseInstruments()
+                        t0=time.time()
+                        while (time.time()-t0) < 60*60:
+                            self.sendProfileStatus("SignalTooWeakError occured; waiting 60min and trying again")
+                            self.testProgress.emit((time.time()-t0)/60/60*100)
+                            time.sleep(TEMP_REMEASUREMENT_INTERVAL)
+                            QtCore.QCoreApplication.processEvents()
+                        measurement.acquireData()
+                    failed=False
+                finally:
+                    # If there was an error then reconnect the instruments next time, in case it was due to a lost connection
+                    measurement.releaseInstruments(failed)
                 self.main.session.saveToDB(measurement)
                 self.allMeasurements[idx].append(measurement)
                 # Plot the measurement
@@ -131,9 +170,6 @@ class Profile(QtCore.QObject):
                 self.main.session.append(measurement)
                 self.main.populateTree(id(measurement))
                 QtCore.QCoreApplication.processEvents()
-        # Move back to room temperature and emit finished signal at end of the test
-        #self.moveToTemp(300,0)
-        self.finished.emit()
 
     ####### ---------------- Only modify code below -------------  ###################
     def define(self):
@@ -0,0 +1,48 @@
+from __future__ import division
+from time import time
+from numpy import *
+
+WARM_START_HISTORY=5          # Number of the most recent profit maps of a stage used to predict the optimum for a warm start
+WARM_START_SPAN_FACTOR=2.0    # Search span for a warm start as a multiple of the distance between the predicted and the last optimum
+
+class ProfitMap(object):
+    """ Profits measured at (n,2) points by an alignment of one stage ("motor" or "piezo"), with the optimum found and the temperature
+    and drive current it was measured at """
+    def __init__(self,stage,points,profit,best,temperature=nan,current=nan,timestamp=None):
+        self.stage=stage
+        self.points=asarray(points,dtype=float)
+        self.profit=asarray(profit,dtype=float)
+        self.best=asarray(best,dtype=float)
+        self.temperature=temperature
+        self.current=current
+        self.timestamp=time() if timestamp is None else timestamp
+
+class ProfitMapCache(object):
+    """ History of the profit maps measured by each stage, which is used to warm start an alignment from the optimum predicted by the
+    drift of the previous optima with temperature, and with the previous profit map as a prior """
+    def __init__(self):
+        self.maps=[]
+
+    def append(self,profitMap):
+        self.maps.append(profitMap)
+
+    def history(self,stage):
+        """ Return the profit maps of the stage from the oldest to the newest """
+        return [m for m in self.maps if m.stage==stage]
+
+    def warmStart(self,stage,temperature=nan):
+        """ Return (p0,span,prior) to warm start the alignment of the stage at the given temperature, or None if it hasn't been aligned
+        before. p0 is the optimum predicted from a linear fit of the last WARM_START_HISTORY optima vs temperature (or the last optimum
+        if they don't span a range of temperatures), span is WARM_START_SPAN_FACTOR times its distance from the last optimum and prior is
+        the last profit map shifted by the same amount """
+        maps=self.history(stage)[-WARM_START_HISTORY:]
+        if not maps: return None
+        last=maps[-1]
+        temperatures=array([m.temperature for m in maps])
+        p0=last.best
+        if isfinite(temperature) and isfinite(temperatures).all() and ptp(temperatures)>0:
+            A=column_stack([ones(len(maps)),temperatures])
+            c,residuals,rank,sv=linalg.lstsq(A,array([m.best for m in maps]))
+            p0=c[0]+c[1]*temperature
+        span=WARM_START_SPAN_FACTOR*sqrt(sum((p0-last.best)**2))
+        return (tuple(p0),span,(last.points+(p0-last.best),last.profit))
@@ -0,0 +1,538 @@
+from __future__ import division
+import os, threading
+from time import sleep
+import numpy as np
+from scipy import constants as scipycsts
+from PyQt4 import QtCore
+
+# Use the simulated instruments instead of the real hardware. Set the LMS_SIMULATE environment variable to switch it on
+SIMULATE="LMS_SIMULATE" in os.environ
+# Latency [s] of a single call to each simulated instrument, on top of any integration or movement time
+LATENCIES={"smu":10e-3,"powerMeter":20e-3,"winspec":50e-3,"esa":200e-3,"dmm":20e-3,"temperature":10e-3,"stage":5e-3}
+# Factor by which all simulated delays are multiplied when sleeping. 0 runs the simulation as fast as possible
+TIME_SCALE=1.0
+# Relative noise of the power meter and DMM readings at an averaging time of NOISE_REF_TAU [ms]
+POWER_NOISE=0.01
+NOISE_REF_TAU=100
+# Simulated spectrometer and spectrum analyzer
+MAX_COUNTS=2**16            # 16-bit detector, so maximum number of counts is 2^16
+DETECTOR_EFFICIENCY=0.02    # Counts per photon at the input of the spectrometer
+DETECTOR_DARK_COUNTS=600    # Mean dark level in counts
+DETECTOR_READ_NOISE=5       # Read noise in counts
+DETECTOR_PIXELS=1024        # Number of pixels across the detector
+ESA_NUM_POINTS=501          # Number of points in each ESA sweep
+ESA_SWEEP_TIME=0.5          # ESA sweep time [s]
+ESA_LOAD=50                 # Load resistance of the photodetector [ohm]
+RBW_SETTINGS={14:3e6}       # Resolution bandwidth [Hz] of the ESA RBW settings that are used
+PHOTODIODE_RESPONSIVITY=0.8 # Responsivity of the photodiodes [A/W]
+DMM_TRANSIMPEDANCE=1000     # Transimpedance [V/A] of the amplifier read by the DMM
+# Travel of the simulated stages, in um for the piezo and mm for the motor
+PIEZO_TRAVEL=20.0
+MOTOR_TRAVEL=4.0
+MOTOR_SPEED=1.0             # Speed of the motor stage [mm/s]
+MOTOR_SETTLE_TIME=0.15      # Time for the motor stage to accelerate and settle on every blocking move [s]
+
+class aptconsts(object):
+    """ Constants used from the APT library """
+    PIEZO_CLOSED_LOOP_MODE=2
+
+class LaserModel(object):
+    """ Physical model of the laser under test, giving the LIV, Fabry-Perot spectrum and RIN vs current and temperature.
+    Currents are in A, temperatures in K, wavelengths in m and frequencies in Hz """
+    def __init__(self,thresholdCurrent=8e-3,slopeEfficiency=0.3,seriesResistance=15,idealityFactor=2,saturationCurrent=1e-13,
+            spontaneousEfficiency=2e-3,T0=60,referenceTemperature=295,centerWavelength=980e-9,gainTuning=0.3e-9,modeTuning=0.08e-9,
+            modeSpacing=0.3e-9,gainBandwidth=25e-9,modeLinewidth=0.02e-9,modeSelectivity=20,relaxationFrequency=3e9,kFactor=0.3e-9,
+            dampingOffset=1e9,lowFrequencyRin=-140,rinFloor=-165):
+        self.thresholdCurrent=thresholdCurrent
+        self.slopeEfficiency=slopeEfficiency
+        self.seriesResistance=seriesResistance
+        self.idealityFactor=idealityFactor
+        self.saturationCurrent=saturationCurrent
+        self.spontaneousEfficiency=spontaneousEfficiency
+        self.T0=T0
+        self.referenceTemperature=referenceTemperature
+        self.centerWavelength=centerWavelength
+        self.gainTuning=gainTuning              # shift of the gain peak [m/K]
+        self.modeTuning=modeTuning              # shift of the cavity modes [m/K]
+        self.modeSpacing=modeSpacing
+        self.gainBandwidth=gainBandwidth        # FWHM of the gain spectrum [m]
+        self.modeLinewidth=modeLinewidth        # FWHM of each mode as seen by the spectrometer [m]
+        self.modeSelectivity=modeSelectivity    # how quickly the lasing spectrum narrows above threshold
+        self.relaxationFrequency=relaxationFrequency    # relaxation oscillation frequency at twice threshold [Hz]
+        self.kFactor=kFactor                    # damping K-factor [s]
+        self.dampingOffset=dampingOffset        # damping at zero relaxation frequency [1/s]
+        self.lowFrequencyRin=lowFrequencyRin    # low frequency RIN at twice threshold [dB/Hz]
+        self.rinFloor=rinFloor                  # RIN floor [dB/Hz]
+
+    def threshold(self,temperature):
+        """ Threshold current at the specified temperature """
+        return self.thresholdCurrent*np.exp((temperature-self.referenceTemperature)/self.T0)
+
+    def outputPower(self,current,temperature):
+        """ Total output power [W], as spontaneous emission below threshold plus stimulated emission above it """
+        current=np.maximum(current,0)
+        return self.spontaneousEfficiency*current+self.slopeEfficiency*np.maximum(current-self.threshold(temperature),0)
+
+    def voltage(self,current,temperature):
+        """ Forward voltage of the diode [V] """
+        current=np.maximum(current,0)
+        thermalVoltage=scipycsts.k*temperature/scipycsts.e
+        return self.idealityFactor*thermalVoltage*np.log1p(current/self.saturationCurrent)+current*self.seriesResistance
+
+    def spectrum(self,wavelength,current,temperature):
+        """ Power [W] in each of the wavelength bins, so that the spectrum sums to the power within the wavelength range """
+        wavelength=np.asarray(wavelength)
+        dT=temperature-self.referenceTemperature
+        gainPeak=self.centerWavelength+self.gainTuning*dT
+        sigma=self.gainBandwidth/(2*np.sqrt(2*np.log(2)))
+        envelope=np.exp(-(wavelength-gainPeak)**2/(2*sigma**2))
+        # Cavity modes near the gain peak, with a gain envelope that narrows with the current above threshold
+        firstMode=self.centerWavelength+self.modeTuning*dT
+        m=np.arange(np.floor((gainPeak-3*sigma-firstMode)/self.modeSpacing),np.ceil((gainPeak+3*sigma-firstMode)/self.modeSpacing)+1)
+        modes=firstMode+m*self.modeSpacing
+        aboveThreshold=max(current/self.threshold(temperature)-1,0)
+        modePower=np.exp(-(1+self.modeSelectivity*aboveThreshold)*(modes-gainPeak)**2/(2*sigma**2))
+        halfWidth=self.modeLinewidth/2
+        lasing=np.dot(halfWidth**2/((wavelength[:,np.newaxis]-modes)**2+halfWidth**2),modePower)
+        # Normalize each part to its total power, using the full spectrum rather than just the part within the wavelength range
+        step=abs(wavelength[-1]-wavelength[0])/max(len(wavelength)-1,1)
+        spontaneousPower=self.spontaneousEfficiency*max(current,0)
+        stimulatedPower=self.outputPower(current,temperature)-spontaneousPower
+        spectrum=spontaneousPower*envelope*step/(sigma*np.sqrt(2*np.pi))
+        if stimulatedPower>0:
+            spectrum+=stimulatedPower*lasing*step/(np.pi*halfWidth*modePower.sum())
+        return spectrum
+
+    def peakWavelength(self,current,temperature):
+        """ Wavelength of the strongest mode [m] """
+        wavelength=self.centerWavelength+self.gainTuning*(temperature-self.referenceTemperature)+np.linspace(-self.gainBandwidth,self.gainBandwidth,4001)
+        return wavelength[np.argmax(self.spectrum(wavelength,current,temperature))]
+
+    def rin(self,frequency,current,temperature):
+        """ Relative intensity noise [1/Hz], with the relaxation oscillation peak moving up with the square root of the current above threshold """
+        frequency=np.asarray(frequency)
+        x=current/self.threshold(temperature)-1
+        floor=10**(self.rinFloor/10)
+        if x<=0:
+            return 10**(self.lowFrequencyRin/10)*np.ones(np.shape(frequency))
+        fr=self.relaxationFrequency*np.sqrt(x)
+        gamma=self.kFactor*fr**2+self.dampingOffset
+        response=fr**4/((fr**2-frequency**2)**2+(gamma*frequency/(2*np.pi))**2)
+        return 10**(self.lowFrequencyRin/10)/x**3*response+floor
+
+class SimulatedSetup(object):
+    """ Shared state of the simulated test setup, i.e. the laser, its drive current and temperature and the positions of the stages
+    which couple its light into the fiber. The setup keeps a simulated clock which is advanced by every instrument call, so that
+    temperature changes and alignment drift don't depend on TIME_SCALE. Each thread has its own simulated time, so that calls made
+    at the same time from different threads overlap, and the clock is the latest time any of them has reached """
+    def __init__(self,laser=None,seed=None,piezoOptimum=(11.2,8.7),motorOptimum=(2.013,1.987),piezoWaist=3.0,motorWaist=0.01,
+            maxCoupling=0.5,driftRate=0.01,thermalTimeConstant=60.0,temperature=295.0):
+        self.laser=laser if laser is not None else LaserModel()
+        self.random=np.random.RandomState(seed)
+        self.piezoOptimum=np.array(piezoOptimum)
+        self.motorOptimum=np.array(motorOptimum)
+        self.piezoWaist=piezoWaist          # 1/e radius of the coupling vs piezo position [um]
+        self.motorWaist=motorWaist          # 1/e radius of the coupling vs motor position [mm]
+        self.maxCoupling=maxCoupling
+        self.driftRate=driftRate            # drift of the piezo optimum [um/min]
+        self.thermalTimeConstant=thermalTimeConstant
+        self.current=0.0
+        self.outputOn=False
+        self.temperature=temperature
+        self.setPoint=temperature
+        self.piezo=np.array([PIEZO_TRAVEL/2,PIEZO_TRAVEL/2])
+        self.motor=np.array([MOTOR_TRAVEL/2,MOTOR_TRAVEL/2])
+        self.clock=0.0
+        self._timeline=threading.local()    # simulated time of each thread, which is the clock for threads that haven't waited yet
+        self.moves={}                       # stage moves in progress, which are advanced along with the clock
+        self.lock=threading.RLock()
+
+    def now(self):
+        """ Simulated time [s] of the calling thread """
+        return getattr(self._timeline,"time",self.clock)
+
+    def setNow(self,t):
+        """ Set the simulated time of the calling thread, e.g. to when a call it waited for on another thread finished """
+        self._timeline.time=t
+
+    def wait(self,duration):
+        """ Advance the simulated time of the calling thread by duration [s], and the clock if it gets past it, sleeping for duration*TIME_SCALE """
+        with self.lock:
+            end=self.now()+duration
+            self.setNow(end)
+            if end>self.clock:
+                # Relax the temperature towards the set point
+                self.temperature=self.setPoint+(self.temperature-self.setPoint)*np.exp(-(end-self.clock)/self.thermalTimeConstant)
+                self.clock=end
+                self._updateMoves()
+        if TIME_SCALE>0:
+            sleep(duration*TIME_SCALE)
+
+    def startMove(self,positions,channel,target,speed):
+        """ Start moving positions[channel] (where positions is the piezo or motor array) to target at speed, without advancing the clock """
+        with self.lock:
+            if np.isinf(speed):
+                positions[channel]=target
+            else:
+                self.moves[(id(positions),channel)]=(positions,channel,self.clock,positions[channel],target,speed)
+
+    def stopMove(self,positions,channel):
+        """ Stop a move started by startMove at the current position. Return True if it was still in progress """
+        with self.lock:
+            return self.moves.pop((id(positions),channel),None) is not None
+
+    def isMoving(self,positions,channel):
+        with self.lock:
+            return (id(positions),channel) in self.moves
+
+    def _updateMoves(self):
+        """ Set the positions of the stages which are moving according to the clock, and remove the moves which have finished """
+        for key,(positions,channel,startTime,start,target,speed) in list(self.moves.items()):
+            distance=speed*(self.clock-startTime)
+            if distance>=abs(target-start):
+                positions[channel]=target
+                del self.moves[key]
+            else:
+                positions[channel]=start+np.sign(target-start)*distance
+
+    def drive(self):
+        """ Current flowing through the laser """
+        return self.current if self.outputOn else 0.0
+
+    def coupling(self):
+        """ Fraction of the laser power coupled into the fiber at the current stage positions """
+        drift=self.driftRate*self.clock/60
+        piezo=np.sum((self.piezo-self.piezoOptimum-drift)**2)/self.piezoWaist**2
+        motor=np.sum((self.motor-self.motorOptimum)**2)/self.motorWaist**2
+        return self.maxCoupling*np.exp(-piezo-motor)
+
+    def fiberPower(self):
+        """ Optical power coupled into the fiber [W] """
+        return self.laser.outputPower(self.drive(),self.temperature)*self.coupling()
+
+    def noisy(self,value,relativeNoise):
+        """ Add gaussian noise with the relative standard deviation to value """
+        return value*(1+relativeNoise*self.random.randn())
+
+# Setup shared by all simulated instruments. Replace it (or its laser) to simulate a different device
+setup=SimulatedSetup()
+
+def simulatedTime():
+    """ Simulated time [s] of the calling thread, which replaces time.time() for timing the simulated instruments """
+    return setup.now()
+
+class SimulatedAsyncResult(object):
+    """ AsyncResult of a call which asyncinstrument.asyncCall makes on a worker thread when simulating. The call starts from the
+    simulated time of the thread which made it, and waiting for its result brings that thread's simulated time up to when the call
+    finished, so overlapping instrument calls take the longest of their times on the simulated clock rather than the sum of them """
+    def __init__(self,submit,func,args,kwargs):
+        start=setup.now()
+        self._end=start
+        def call():
+            setup.setNow(start)
+            try:
+                return func(*args,**kwargs)
+            finally:
+                self._end=setup.now()
+        self._result=submit(call)
+
+    def _join(self):
+        if self._result.ready(): setup.setNow(max(setup.now(),self._end))
+
+    def ready(self):
+        return self._result.ready()
+
+    def successful(self):
+        return self._result.successful()
+
+    def wait(self,timeout=None):
+        self._result.wait(timeout)
+        self._join()
+
+    def get(self,timeout=None):
+        try:
+            return self._result.get(timeout)
+        finally:
+            self._join()
+
+class SMU(object):
+    """ Simulated source measure unit driving the laser """
+    def __init__(self,autoZero=False,disableScreen=False,defaultCurrent=0.0,currRange=None,*args,**kwargs):
+        self.defaultCurrent=defaultCurrent
+        setup.current=defaultCurrent
+
+    def setCurrent(self,current,compliance=None):
+        setup.wait(LATENCIES["smu"])
+        setup.current=current
+
+    def setOutputState(self,state):
+        setup.wait(LATENCIES["smu"])
+        setup.outputOn=state in (True,"ON",1)
+
+    def measure(self):
+        """ Return the measured (voltage, current) """
+        setup.wait(LATENCIES["smu"])
+        current=setup.drive()
+        voltage=setup.laser.voltage(current,setup.temperature)
+        return (setup.noisy(voltage,1e-4),setup.noisy(current,1e-4))
+
+class PowerMeter(object):
+    """ Simulated power meter reading the power coupled into the fiber """
+    def __init__(self,*args,**kwargs):
+        pass
+
+    def readPowerAuto(self,tau=NOISE_REF_TAU,mode="mean"):
+        """ Read the power [W] averaged over tau [ms], or the maximum power over tau if mode is "max" """
+        setup.wait(LATENCIES["powerMeter"]+tau*1e-3)
+        noise=POWER_NOISE*np.sqrt(NOISE_REF_TAU/max(tau,1e-3))
+        power=setup.fiberPower()
+        if mode=="max": power*=1+2*noise
+        return max(setup.noisy(power,noise),0)+1e-12
+
+class DMM(object):
+    """ Simulated DMM reading the transimpedance amplifier of the RIN photodetector """
+    def __init__(self,*args,**kwargs):
+        pass
+
+    def setAuto(self):
+        setup.wait(LATENCIES["dmm"])
+
+    def measure(self):
+        setup.wait(LATENCIES["dmm"])
+        return setup.noisy(setup.fiberPower()*PHOTODIODE_RESPONSIVITY*DMM_TRANSIMPEDANCE,POWER_NOISE)
+
+class SpectrumAnalyzer(object):
+    """ Simulated electrical spectrum analyzer measuring the intensity noise of the laser on a photodetector. Frequencies are set in GHz """
+    def __init__(self,*args,**kwargs):
+        self.center=5.0
+        self.span=10.0
+        self.rbw=RBW_SETTINGS[14]
+        self.numPoints=ESA_NUM_POINTS
+
+    def setCenter(self,center):
+        self.center=center
+
+    def setSpan(self,span):
+        self.span=span
+
+    def setRbw(self,rbw):
+        self.rbw=RBW_SETTINGS.get(rbw,self.rbw)
+
+    def setVbw(self,vbw): pass
+    def setAttenuator(self,auto,attenuation): pass
+    def setSweepTime(self,auto,sweepTime=None): pass
+    def setSweepMode(self,mode): pass
+
+    def getNoiseBandwidth(self):
+        return self.rbw
+
+    def obtainSpectrum(self):
+        """ Return the frequency [Hz] and electrical power [W] in the resolution bandwidth, from RIN, shot noise and thermal noise """
+        setup.wait(LATENCIES["esa"]+ESA_SWEEP_TIME)
+        f=np.linspace(self.center-self.span/2,self.center+self.span/2,self.numPoints)*1e9
+        photoCurrent=setup.fiberPower()*PHOTODIODE_RESPONSIVITY
+        density=photoCurrent**2*setup.laser.rin(f,setup.drive(),setup.temperature)+2*scipycsts.e*photoCurrent+4*scipycsts.k*setup.temperature/ESA_LOAD
+        power=density*ESA_LOAD*self.rbw
+        return (f,power*(1+0.1*setup.random.randn(len(f))))
+
+class WinspecAnalyzer(QtCore.QObject):
+    """ Simulated version of winspecanalyzer.WinspecAnalyzer, with the same interface as used by the measurements """
+    updateProgress=QtCore.pyqtSignal(float)
+    statusMessage=QtCore.pyqtSignal(str)
+    plotDataReady=QtCore.pyqtSignal(dict)
+    def __init__(self,inputStateSwitch=None,rawDataDir=None,*args,**kwargs):
+        super(WinspecAnalyzer, self).__init__(*args,**kwargs)
+        self.inputStateSwitch=inputStateSwitch if inputStateSwitch!=None else (lambda state: None)
+        self.rawDataDir=rawDataDir
+        self.efficiency=0.05
+        self.rangeIndex=4
+        self.running=True
+        self.center=980.0
+        self.resolution=0.1
+        self.numPoints=DETECTOR_PIXELS
+        self.exposure=0.1
+        self.roi=None
+        self.bgMeasRequired=True
+
+    def setCenter(self,center):
+        self.center=center
+    def getCenter(self):
+        return self.center
+    def setResolution(self,resolution):
+        self.resolution=resolution
+    def getNumberOfPixels(self):
+        return DETECTOR_PIXELS
+    def setNumPoints(self,numPoints):
+        self.numPoints=numPoints
+    def setDataFilename(self,filename="temp"): pass
+    def setBackgroundFilename(self,filename="background"): pass
+    def setRange(self,rangeIndex,forceSet=False):
+        if rangeIndex!=self.rangeIndex: self.bgMeasRequired=True
+        self.rangeIndex=rangeIndex
+    def setROI(self,roi):
+        if roi!=self.roi: self.bgMeasRequired=True
+        self.roi=roi
+    def autoSetROI(self,alignment=None):
+        setup.wait(LATENCIES["winspec"])
+    def has2dDetector(self):
+        return False
+    def tempLocked(self):
+        return True
+    def getExposureTime(self):
+        return self.exposure
+
+    def measureOptimalCenter(self,tau=1):
+        """ Return the wavelength [nm] of the strongest mode and the confidence in it """
+        setup.wait(LATENCIES["winspec"]+tau*1e-3)
+        return (setup.laser.peakWavelength(setup.drive(),setup.temperature)*1e9,1.0)
+
+    def readSingleWinspecSpectrumAuto(self,tau=1,*args,**kwargs):
+        """ Return the wavelength [nm], counts and spectrum information, choosing the exposure (in powers of 2 s, like the discrete
+        ranges of the real analyzer) to use most of the detector range. A background is measured with the input switched off first
+        whenever the exposure or range has changed """
+        wavelength=self.center+(np.arange(self.numPoints)-(self.numPoints-1)/2)*self.resolution
+        power=setup.laser.spectrum(wavelength*1e-9,setup.drive(),setup.temperature)*setup.coupling()
+        cps=power*DETECTOR_EFFICIENCY/(scipycsts.h*scipycsts.c/(wavelength*1e-9))
+        exposure=min(2.0**np.floor(np.log2(0.8*(MAX_COUNTS-DETECTOR_DARK_COUNTS)/max(cps.max(),1))),8.0)
+        if exposure!=self.exposure: self.bgMeasRequired=True
+        self.exposure=exposure
+        if self.bgMeasRequired:
+            self.inputStateSwitch(False)
+            setup.wait(LATENCIES["winspec"]+max(self.exposure,tau*1e-3))
+            self.inputStateSwitch(True)
+            self.bgMeasRequired=False
+        setup.wait(LATENCIES["winspec"]+max(self.exposure,tau*1e-3))
+        noiseFloor=DETECTOR_DARK_COUNTS+DETECTOR_READ_NOISE*setup.random.randn(self.numPoints)
+        counts=np.maximum(setup.random.poisson(cps*self.exposure)+DETECTOR_READ_NOISE*setup.random.randn(self.numPoints),0)
+        return (wavelength,counts,{"noiseFloor":noiseFloor,"saturating":False,"maxSample":counts.max(),"exposure":self.exposure})
+
+    def readPowerAuto(self,*args,**kwargs):
+        wavelength,counts,spectrumDict=self.readSingleWinspecSpectrumAuto(*args,**kwargs)
+        return np.sum(scipycsts.h*scipycsts.c/(wavelength*1e-9)*counts/self.exposure/self.efficiency)
+
+    def obtainSpectrum(self,tau=1,calibratedPower=None,timeout=None):
+        """ Return the wavelength [m], power [W] and spectrum information, as in WinspecAnalyzer.obtainSpectrum """
+        self.inputStateSwitch(True)
+        wavelength,counts,spectrumDict=self.readSingleWinspecSpectrumAuto(tau)
+        wavelength=wavelength/1e9
+        cps=counts/self.exposure
+        photonEnergy=scipycsts.h*scipycsts.c/wavelength
+        if callable(calibratedPower):
+            calibratedPower=calibratedPower()
+        if calibratedPower!=None:
+            self.efficiency=np.sum(cps*photonEnergy)/calibratedPower
+        else:
+            calibratedPower=np.sum(cps*photonEnergy)/self.efficiency
+        spectrumDict["efficiency"]=self.efficiency
+        spectrumDict["calibratedPower"]=calibratedPower
+        spectrumDict["SNR"]=counts.max()/np.std(spectrumDict["noiseFloor"])
+        return (wavelength,photonEnergy*cps/self.efficiency,spectrumDict)
+
+class TemperatureController(QtCore.QObject):
+    """ Simulated temperature controller, where the temperature relaxes exponentially to the set point """
+    def __init__(self,*args,**kwargs):
+        super(TemperatureController, self).__init__(*args,**kwargs)
+
+    @QtCore.pyqtSlot()
+    def getTemperature(self):
+        setup.wait(LATENCIES["temperature"])
+        temperature=setup.temperature+0.01*setup.random.randn()
+        self.emit(QtCore.SIGNAL("tempDataReady"),temperature)
+        return temperature
+
+    @QtCore.pyqtSlot()
+    def getSetTemperature(self):
+        setup.wait(LATENCIES["temperature"])
+        self.emit(QtCore.SIGNAL("setTempDataReady"),setup.setPoint)
+        return setup.setPoint
+
+    def setTemperature(self,temperature):
+        setup.wait(LATENCIES["temperature"])
+        setup.setPoint=temperature
+
+class _AptStage(object):
+    """ Two channel stage with the subset of the APT interface used by align, plus simultaneous multi-channel moves and non-blocking
+    moves for continuous scans """
+    travel=None
+    speed=np.inf
+    axes=None       # Name of the array of positions in setup which the stage moves
+    def __init__(self,*args,**kwargs):
+        self.channelAddresses=[0,1]
+        self.velocity=[self.speed,self.speed]
+
+    def _positions(self):
+        return getattr(setup,self.axes)
+
+    def _moveTime(self,channel,distance):
+        return LATENCIES["stage"]
+
+    def SetControlMode(self,channel,mode): pass
+
+    def zero(self,channel):
+        self.setPosition(channel,0)
+
+    def moveToCenter(self,channel):
+        self.setPosition(channel,self.GetMaxTravel(channel)/2)
+
+    def GetMaxTravel(self,channel=0):
+        return self.travel
+
+    def getPosition(self,channel):
+        return float(self._positions()[channel])
+
+    def GetPosOutput(self,channel):
+        return self.getPosition(channel)
+
+    def setPosition(self,channel,position):
+        positions=self._positions()
+        setup.stopMove(positions,channel)
+        position=min(max(position,0),self.GetMaxTravel(channel))
+        setup.wait(self._moveTime(channel,abs(position-positions[channel])))
+        positions[channel]=position
+
+    def setPositions(self,channels,positions):
+        """ Move each of the channels to its position at the same time, waiting once for the slowest of them """
+        current=self._positions()
+        targets=[]
+        for channel,position in zip(channels,positions):
+            setup.stopMove(current,channel)
+            targets.append(min(max(position,0),self.GetMaxTravel(channel)))
+        setup.wait(max([self._moveTime(channel,abs(target-current[channel])) for channel,target in zip(channels,targets)]))
+        for channel,target in zip(channels,targets):
+            current[channel]=target
+
+    def setVelocity(self,channel,velocity):
+        """ Set the velocity used for moves on channel, limited to the maximum speed of the stage """
+        self.velocity[channel]=min(velocity,self.speed)
+
+    def getVelocity(self,channel):
+        return self.velocity[channel]
+
+    def startMove(self,channel,position):
+        """ Start moving channel to position at the current velocity and return without waiting for it to get there """
+        positions=self._positions()
+        setup.stopMove(positions,channel)
+        setup.wait(LATENCIES["stage"])
+        setup.startMove(positions,channel,min(max(position,0),self.GetMaxTravel(channel)),self.velocity[channel])
+
+    def isMoving(self,channel):
+        return setup.isMoving(self._positions(),channel)
+
+    def stopMove(self,channel):
+        """ Stop a move started by startMove wherever the stage has got to """
+        if setup.stopMove(self._positions(),channel):
+            setup.wait(LATENCIES["stage"])
+
+class AptPiezo(_AptStage):
+    """ Simulated piezo stage, with positions in um """
+    travel=PIEZO_TRAVEL
+    axes="piezo"
+
+class AptMotor(_AptStage):
+    """ Simulated stepper motor stage, with positions in mm """
+    travel=MOTOR_TRAVEL
+    speed=MOTOR_SPEED
+    axes="motor"
+
+    def _moveTime(self,channel,distance):
+        return LATENCIES["stage"]+MOTOR_SETTLE_TIME+distance/self.velocity[channel]
@@ -0,0 +1,124 @@
+from __future__ import division
+import numpy as np
+
+# Number of center wavelengths at which the dispersion of each grating is tabulated
+DISPERSION_TABLE_POINTS=2000
+# Number of decimal places of the center wavelength [nm] used to identify a cached stitching plan
+PLAN_CENTER_DECIMALS=3
+
+class DispersionTable(object):
+    """ Lookup table giving the wavelengths [nm] at the left and right edge of the detector vs the spectrometer center wavelength for one grating.
+    The table is tabulated from the calibration polynomials in the detector definition over the calibration range, and the polynomials
+    themselves are only evaluated for centers outside of that range """
+    def __init__(self,calibration,grating,calRange,numPoints=DISPERSION_TABLE_POINTS):
+        self.pLeftFromCenter=calibration["leftFromCenter"][grating]
+        self.pRightFromCenter=calibration["rightFromCenter"][grating]
+        self.pCenterFromLeft=calibration["centerFromLeft"][grating]
+        self.pCenterFromRight=calibration["centerFromRight"][grating]
+        self.center=np.linspace(calRange[0],calRange[1],numPoints)
+        self.left=np.polyval(self.pLeftFromCenter,self.center)
+        self.right=np.polyval(self.pRightFromCenter,self.center)
+
+    def leftFromCenter(self,center):
+        """ Wavelength at the left edge of the detector when the spectrometer is at center """
+        return self._lookup(center,self.center,self.left,self.pLeftFromCenter)
+
+    def rightFromCenter(self,center):
+        """ Wavelength at the right edge of the detector when the spectrometer is at center """
+        return self._lookup(center,self.center,self.right,self.pRightFromCenter)
+
+    def centerFromLeft(self,left):
+        """ Center wavelength which puts the specified wavelength at the left edge of the detector """
+        return self._lookup(left,self.left,self.center,self.pCenterFromLeft)
+
+    def centerFromRight(self,right):
+        """ Center wavelength which puts the specified wavelength at the right edge of the detector """
+        return self._lookup(right,self.right,self.center,self.pCenterFromRight)
+
+    def _lookup(self,x,xp,fp,p):
+        """ Linearly interpolate the table, falling back to the calibration polynomial outside of the tabulated range """
+        if xp[0] <= x <= xp[-1]:
+            return float(np.interp(x,xp,fp))
+        return float(np.polyval(p,x))
+
+class StitchPlanner(object):
+    """ Plans the spectrometer center wavelengths for a stitched spectrum, and the common wavelength grid to resample onto.
+    Plans are cached for each (grating, center, numSpectra, overlap) so they are only calculated once per measurement series """
+    def __init__(self,detector):
+        calibration=detector["calibration"]
+        self.tables=[DispersionTable(calibration,grating,detector["calibrationRange"][grating])
+            for grating in range(len(calibration["leftFromCenter"]))]
+        self._plans={}
+
+    def centerWavelengths(self,gratingNum,center,numSpectra,overlap=0):
+        """ Return the center wavelength [nm] for each of numSpectra (odd) sub-spectra centered at center, such that the edges of
+        neighbouring sub-spectra line up, optionally overlapping by the specified wavelength [nm] """
+        key=(gratingNum,round(center,PLAN_CENTER_DECIMALS),numSpectra,round(overlap,PLAN_CENTER_DECIMALS))
+        if key not in self._plans:
+            self._plans[key]=self._plan(self.tables[gratingNum-1],center,numSpectra,overlap)
+        return self._plans[key].copy()
+
+    def wavelengthGrid(self,gratingNum,allCenterLambda,numPoints):
+        """ Return a monotonic wavelength grid [nm] with numPoints spanning all of the sub-spectra in the plan """
+        table=self.tables[gratingNum-1]
+        return np.linspace(table.leftFromCenter(min(allCenterLambda)),table.rightFromCenter(max(allCenterLambda)),numPoints)
+
+    def _plan(self,table,center,numSpectra,overlap):
+        """ Step outwards from the central spectrum in pairs (left and right) and calculate the desired center wavelengths """
+        assert (numSpectra % 2)!=0
+        allCenterLambda=np.zeros(numSpectra)
+        numSideSpectra=int((numSpectra-1)/2) # number of spectra on either side of the central one
+        allCenterLambda[numSideSpectra]=center
+        leftMinima=table.leftFromCenter(center)
+        rightMaxima=table.rightFromCenter(center)
+        for idx in range(numSideSpectra):
+            # Want the maxima/minima of each spectra to line up with the minima/maxima of the next spectra
+            leftCenter=table.centerFromRight(leftMinima+overlap)
+            rightCenter=table.centerFromLeft(rightMaxima-overlap)
+            allCenterLambda[numSideSpectra-idx-1]=leftCenter
+            allCenterLambda[numSideSpectra+idx+1]=rightCenter
+            # Calculate the outer edge for both of the current spectra
+            leftMinima=table.leftFromCenter(leftCenter)
+            rightMaxima=table.rightFromCenter(rightCenter)
+        return allCenterLambda
+
+class SpectrumAccumulator(object):
+    """ Resamples sub-spectra onto a common monotonic wavelength grid as they arrive. Where sub-spectra overlap, each one is weighted
+    by its distance to its own nearest edge, which gives a linear cross-fade across the seam instead of a step """
+    def __init__(self,grid):
+        self.grid=grid
+        self._weightedSum=np.zeros(len(grid))
+        self._weights=np.zeros(len(grid))
+        # Small weight given to points exactly at the edge of a sub-spectrum so that they are still counted as covered
+        self._epsilon=1e-6*abs(grid[-1]-grid[0])/max(len(grid)-1,1)
+
+    def add(self,wavelength,values):
+        """ Add a sub-spectrum with the given wavelength [nm] and values """
+        order=np.argsort(wavelength)
+        wavelength=wavelength[order]
+        values=values[order]
+        lo,hi=wavelength[0],wavelength[-1]
+        inside=np.logical_and(self.grid>=lo,self.grid<=hi)
+        x=self.grid[inside]
+        weight=np.minimum(x-lo,hi-x)+self._epsilon
+        self._weightedSum[inside]+=weight*np.interp(x,wavelength,values)
+        self._weights[inside]+=weight
+
+    def covered(self):
+        """ Boolean mask of the grid points which are covered by at least one of the sub-spectra """
+        return self._weights>0
+
+    def result(self,fill=0.0):
+        """ Return the stitched values on the grid. Points in a gap between sub-spectra are linearly interpolated across it, but the
+        points beyond the first and last sub-spectrum (where the grid planned from the calibration overshoots what was measured) aren't
+        extrapolated. They are set to fill instead, which is 0 since the counts are background subtracted, or can be NaN to mask them """
+        covered=self.covered()
+        values=fill*np.ones(len(self.grid))
+        if covered.any():
+            values[covered]=self._weightedSum[covered]/self._weights[covered]
+            first,last=np.nonzero(covered)[0][[0,-1]]
+            gap=~covered
+            gap[:first]=False
+            gap[last+1:]=False
+            values[gap]=np.interp(self.grid[gap],self.grid[covered],values[covered])
+        return values
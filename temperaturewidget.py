@@ -6,7 +6,11 @@ class TempMonitorError(Exception): pass
 import PyQt4, sys, os
 from PyQt4 import QtGui, QtCore
 from PyQt4.QtCore import Qt, QThread
-from drivepy.scientificinstruments.temperaturecontroller import TemperatureController
+from simulator import SIMULATE
+if SIMULATE:
+    from simulator import TemperatureController
+else:
+    from drivepy.scientificinstruments.temperaturecontroller import TemperatureController
 
 
 from numpy import *
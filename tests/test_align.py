@@ -0,0 +1,137 @@
+from __future__ import division
+import os, sys, unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import numpy as np
+    import align
+except ImportError as e:
+    # PyQt, scipy or the APT library (unless simulating) aren't installed
+    align=None
+
+TRAVEL=20.0
+
+class _Stage(object):
+    """ Stand-in for the stage controller, which only keeps the position """
+    def __init__(self):
+        self.position=[TRAVEL/2,TRAVEL/2]
+    def GetMaxTravel(self,channel=0):
+        return TRAVEL
+    def getPosition(self,channel):
+        return self.position[channel]
+    def setPosition(self,channel,position):
+        self.position[channel]=position
+    def setPositions(self,channels,positions):
+        for channel,position in zip(channels,positions):
+            self.position[channel]=position
+
+def _aligner(optimum=(12.3,8.6),waist=2.0,background=0.0):
+    """ Aligner on a stage with a gaussian profit around optimum, and the list of the points it measured """
+    aligner=align._Align()
+    aligner.ctrl=_Stage()
+    measured=[]
+    def profitFunction():
+        p=np.array(aligner.ctrl.position)
+        measured.append(tuple(p))
+        return background+np.exp(-np.sum((p-optimum)**2)/waist**2)
+    return aligner,profitFunction,measured
+
+@unittest.skipIf(align is None,"the alignment dependencies aren't available")
+class ModelStepTest(unittest.TestCase):
+    """ _Align._modelStep fits a quadratic to the log of the profit and steps towards its peak within the trust region """
+    def gaussian(self,d,peak,curvature=(1.0,0.5)):
+        return np.exp(-curvature[0]*(d[:,0]-peak[0])**2-curvature[1]*(d[:,1]-peak[1])**2)
+
+    def setUp(self):
+        self.aligner=align._Align()
+        self.d=np.array([(0,0),(1,0),(-1,0),(0,1),(0,-1),(1,1)],dtype=float)
+
+    def testStepToPeakOfGaussian(self):
+        step=self.aligner._modelStep(self.d,self.gaussian(self.d,(0.7,-0.4)),10)
+        np.testing.assert_allclose(step,(0.7,-0.4),atol=1e-9)
+
+    def testStepIsLimitedToRadius(self):
+        step=self.aligner._modelStep(self.d,self.gaussian(self.d,(3.0,4.0)),1.0)
+        self.assertAlmostEqual(np.sqrt(np.sum(step**2)),1.0)
+        np.testing.assert_allclose(step/np.sqrt(np.sum(step**2)),(0.6,0.8),atol=1e-9)
+
+    def testUphillWithoutMaximum(self):
+        # A saddle has no peak, so the step goes up the gradient to the edge of the trust region
+        profit=np.exp(self.d[:,0]+0.5*self.d[:,0]**2-0.5*self.d[:,1]**2)
+        step=self.aligner._modelStep(self.d,profit,2.0)
+        np.testing.assert_allclose(step,(2.0,0.0),atol=1e-9)
+
+    def testTooFewPointsForCurvatureUsesGradient(self):
+        d=self.d[[0,1,3]]
+        step=self.aligner._modelStep(d,np.exp(0.5*d[:,0]),1.0)
+        np.testing.assert_allclose(step,(1.0,0.0),atol=1e-9)
+
+    def testDegeneratePointsGiveNone(self):
+        d=np.zeros((3,2))
+        self.assertIsNone(self.aligner._modelStep(d,np.ones(3),1.0))
+
+    def testPriorGivesTheCurvature(self):
+        # Only the three points needed for the offset and gradient are new, and the prior (with its own scale) gives the shape
+        prior=(self.d+(0.5,0.5),0.1*self.gaussian(self.d+(0.5,0.5),(0.7,-0.4)))
+        d=self.d[[0,1,3]]
+        step=self.aligner._modelStep(d,self.gaussian(d,(0.7,-0.4)),10,prior)
+        np.testing.assert_allclose(step,(0.7,-0.4),atol=1e-9)
+
+@unittest.skipIf(align is None,"the alignment dependencies aren't available")
+class ModelSearchTest(unittest.TestCase):
+    def testFindsOptimum(self):
+        aligner,profitFunction,measured=_aligner()
+        best=aligner.modelSearch((10.0,10.0),0.1,5.0,profitFunction)
+        np.testing.assert_allclose(best,(12.3,8.6),atol=0.1)
+        self.assertLessEqual(len(measured),align.MODEL_MAX_EVALUATIONS)
+
+@unittest.skipIf(align is None,"the alignment dependencies aren't available")
+class SearchGridTest(unittest.TestCase):
+    """ _Align.searchGrid hill climbs over the grid from p0 to the local maximum """
+    def testClimbsToMaximum(self):
+        aligner,profitFunction,measured=_aligner()
+        x=y=np.arange(0,TRAVEL+0.01,0.5)
+        I=np.zeros((len(y),len(x)))
+        ix,iy=aligner.searchGrid(x,y,(8.0,12.0),profitFunction,I)
+        self.assertEqual((x[ix],y[iy]),(12.5,8.5))
+        # Each point is only measured once, and far fewer points than the whole grid are measured
+        self.assertEqual(len(set(measured)),len(measured))
+        self.assertLess(len(measured),I.size/10)
+        self.assertEqual(I[iy,ix],I.max())
+
+    def testPointsOutsideTheTravelAreNotMeasured(self):
+        aligner,profitFunction,measured=_aligner(optimum=(-5.0,-5.0),waist=10.0)
+        x=y=np.arange(-2,4,1.0)
+        ix,iy=aligner.searchGrid(x,y,(2.0,2.0),profitFunction)
+        self.assertEqual((x[ix],y[iy]),(0.0,0.0))
+        self.assertTrue((np.array(measured)>=0).all())
+
+@unittest.skipIf(align is None,"the alignment dependencies aren't available")
+class PyramidSearchTest(unittest.TestCase):
+    """ _Align.pyramidSearch measures a coarse spiral and refines the best points at finer resolutions """
+    def testRefinesToFinalResolution(self):
+        aligner,profitFunction,measured=_aligner(waist=1.0)
+        points,profit=aligner.pyramidSearch((10.0,10.0),0.25,6.0,profitFunction,coarseRes=2.0)
+        best=points[np.argmax(profit)]
+        self.assertLessEqual(np.max(np.abs(best-(12.3,8.6))),0.25/2+1e-9)
+        self.assertEqual(len(points),len(measured))
+        # No point is measured twice
+        self.assertEqual(len(set(measured)),len(measured))
+        # Much fewer points than a raster at the final resolution
+        self.assertLess(len(measured),(2*6.0/0.25+1)**2/10)
+
+    def testStopsAtThreshold(self):
+        aligner,profitFunction,measured=_aligner(waist=1.0)
+        points,profit=aligner.pyramidSearch((10.0,10.0),0.25,6.0,profitFunction,threshold=0.5,coarseRes=2.0)
+        self.assertGreaterEqual(profit.max(),0.5)
+        # The search stops at the first point above the threshold
+        self.assertEqual(tuple(points[np.argmax(profit)]),measured[-1])
+        self.assertEqual(list(profit>=0.5).count(True),1)
+
+    def testNoPointsWithinTravel(self):
+        aligner,profitFunction,measured=_aligner()
+        points,profit=aligner.pyramidSearch((-10.0,-10.0),0.25,1.0,profitFunction,coarseRes=0.5)
+        self.assertEqual(len(profit),0)
+        self.assertEqual(measured,[])
+
+if __name__=="__main__":
+    unittest.main()
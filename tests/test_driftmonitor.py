@@ -0,0 +1,84 @@
+from __future__ import division
+import os, sys, unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import driftmonitor
+    from driftmonitor import DriftMonitor, nearestIndex
+    from numpy import array, linspace, sort, hstack, concatenate, diff
+except ImportError as e:
+    # numpy isn't installed
+    driftmonitor=None
+
+TOLERANCE=1e-6
+
+@unittest.skipIf(driftmonitor is None,"numpy isn't available")
+class SetPointProxyTest(unittest.TestCase):
+    """ Proxies keyed by the current set point (the spectrum integral and the secondary power meter) are only compared to their
+    reference when the same current is measured again """
+    def sweep(self,monitor,currents,t,loss=0.0):
+        for current in currents:
+            monitor.addSample(monitor.setPointKey("integral",current,TOLERANCE),(1-loss)*round(current,5),t)
+            monitor.addSample(monitor.setPointKey("secondaryPower",current,TOLERANCE),(1-loss)*2*round(current,5),t)
+
+    def testSingleSweepOnlyGivesReferences(self):
+        monitor=DriftMonitor()
+        monitor.reset(0)
+        self.sweep(monitor,[10e-3,20e-3,30e-3],60)
+        self.assertEqual(monitor.samples,[])
+        self.assertEqual(len(monitor.references),6)
+
+    def testRepeatedCurrentsAreCompared(self):
+        monitor=DriftMonitor()
+        monitor.reset(0)
+        currents=[10e-3,20e-3,30e-3]
+        self.sweep(monitor,currents,60)
+        # The same set points with floating point error, e.g. from a different linspace
+        self.sweep(monitor,[0.1*i+1e-9 for i in (0.1,0.2,0.3)],120,loss=0.03)
+        self.assertEqual(len(monitor.samples),6)
+        coefficient=0.03/(120**2-60**2)
+        self.assertAlmostEqual(monitor.lossCoefficient()/coefficient,1)
+        self.assertAlmostEqual(monitor.predictedLoss(120),coefficient*120**2)
+
+    def testCurrentsStraddlingARoundingBoundaryAreCompared(self):
+        monitor=DriftMonitor()
+        monitor.reset(0)
+        self.sweep(monitor,[10.5e-6-0.4*TOLERANCE],60)
+        self.sweep(monitor,[10.5e-6+0.4*TOLERANCE],120)
+        self.assertEqual(len(monitor.samples),2)
+
+    def testDifferentCurrentsHaveDifferentKeys(self):
+        monitor=DriftMonitor()
+        monitor.reset(0)
+        self.sweep(monitor,[10e-3],60)
+        self.assertNotEqual(monitor.setPointKey("integral",10e-3,TOLERANCE),monitor.setPointKey("integral",10.01e-3,TOLERANCE))
+        self.assertNotEqual(monitor.setPointKey("integral",10e-3,TOLERANCE),monitor.setPointKey("secondaryPower",10e-3,TOLERANCE))
+
+@unittest.skipIf(driftmonitor is None,"numpy isn't available")
+class NearestIndexTest(unittest.TestCase):
+    """ nearestIndex matches values to the nearest element of a grid within a tolerance """
+    def testUnsortedGrid(self):
+        grid=[3.0,1.0,2.0]
+        self.assertEqual(list(nearestIndex(grid,[1.0,2.0,3.0,2.4],0.5)),[1,2,0,2])
+
+    def testOutsideToleranceIsMinusOne(self):
+        self.assertEqual(list(nearestIndex([1.0,2.0],[0.0,1.4,1.6,3.0],0.45)),[-1,0,1,-1])
+
+    def testValuesBeyondTheEnds(self):
+        self.assertEqual(list(nearestIndex([1.0,2.0],[0.9,2.1],0.2)),[0,1])
+
+    def testUnionOfCurrentSweeps(self):
+        # The union of the set points of sweeps with different ranges and steps, merging values which only differ by rounding errors,
+        # as for the peak RIN plot, has a column for every set point of every sweep
+        sweeps=[linspace(10e-3,30e-3,5),linspace(0.01,0.05,9),array([0.1*i for i in (0.1,0.2,0.3)])]
+        union=sort(hstack(sweeps))
+        union=union[concatenate(([True],diff(union)>TOLERANCE))]
+        self.assertEqual(len(union),9)
+        for sweep in sweeps:
+            idx=nearestIndex(union,sweep,TOLERANCE)
+            self.assertTrue((idx>=0).all())
+            self.assertTrue((abs(union[idx]-sweep)<=TOLERANCE).all())
+            # and each set point of the union is only found in a sweep where it was measured
+            self.assertEqual(list(nearestIndex(sweep,union,TOLERANCE)>=0).count(True),len(sweep))
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+from __future__ import division
+import os, sys, unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import numpy as np
+    import profitmap
+    from profitmap import ProfitMap, ProfitMapCache
+except ImportError as e:
+    # numpy isn't installed
+    profitmap=None
+
+def _profitMap(stage,best,temperature,timestamp=0):
+    """ Profit map with a 3x3 grid of points around best """
+    d=np.array([(dx,dy) for dx in (-1,0,1) for dy in (-1,0,1)],dtype=float)
+    return ProfitMap(stage,np.array(best)+d,np.exp(-np.sum(d**2,1)),best,temperature,timestamp=timestamp)
+
+@unittest.skipIf(profitmap is None,"numpy isn't available")
+class WarmStartTest(unittest.TestCase):
+    """ ProfitMapCache.warmStart predicts the optimum of a stage from the drift of its previous optima with temperature """
+    def testNoHistory(self):
+        cache=ProfitMapCache()
+        cache.append(_profitMap("piezo",(1,1),295))
+        self.assertIsNone(cache.warmStart("motor",295))
+
+    def testLastOptimumWithoutTemperature(self):
+        cache=ProfitMapCache()
+        cache.append(_profitMap("piezo",(1,1),295))
+        cache.append(_profitMap("piezo",(2,3),300))
+        p0,span,prior=cache.warmStart("piezo")
+        np.testing.assert_allclose(p0,(2,3))
+        self.assertEqual(span,0)
+        np.testing.assert_allclose(prior[0],cache.maps[-1].points)
+
+    def testLastOptimumAtSingleTemperature(self):
+        cache=ProfitMapCache()
+        cache.append(_profitMap("piezo",(1,1),295))
+        cache.append(_profitMap("piezo",(2,3),295))
+        p0,span,prior=cache.warmStart("piezo",250)
+        np.testing.assert_allclose(p0,(2,3))
+
+    def testLinearDriftWithTemperature(self):
+        cache=ProfitMapCache()
+        for temperature in (280,290,300):
+            cache.append(_profitMap("piezo",(10+0.1*(temperature-280),5-0.05*(temperature-280)),temperature))
+        cache.append(_profitMap("motor",(0,0),310))
+        p0,span,prior=cache.warmStart("piezo",320)
+        np.testing.assert_allclose(p0,(14,3))
+        last=cache.history("piezo")[-1]
+        shift=np.array(p0)-last.best
+        self.assertAlmostEqual(span,profitmap.WARM_START_SPAN_FACTOR*np.sqrt(np.sum(shift**2)))
+        # The prior is the last map of the stage moved to the predicted optimum, with the same profits
+        np.testing.assert_allclose(prior[0],last.points+shift)
+        np.testing.assert_allclose(prior[1],last.profit)
+
+    def testOnlyRecentHistoryIsUsed(self):
+        cache=ProfitMapCache()
+        # An old outlier which is outside of the history used for the fit
+        cache.append(_profitMap("piezo",(100,100),270))
+        for temperature in range(280,280+profitmap.WARM_START_HISTORY):
+            cache.append(_profitMap("piezo",(temperature-280,0),temperature))
+        p0,span,prior=cache.warmStart("piezo",300)
+        np.testing.assert_allclose(p0,(20,0),atol=1e-9)
+
+if __name__=="__main__":
+    unittest.main()
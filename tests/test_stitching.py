@@ -0,0 +1,68 @@
+from __future__ import division
+import os, sys, unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import numpy as np
+    from stitching import SpectrumAccumulator
+except ImportError as e:
+    # numpy isn't installed
+    np=None
+
+@unittest.skipIf(np is None,"numpy isn't available")
+class SpectrumAccumulatorTest(unittest.TestCase):
+    """ SpectrumAccumulator resamples the sub-spectra onto the grid and cross-fades them where they overlap """
+    def testSingleSpectrumIsResampled(self):
+        accumulator=SpectrumAccumulator(np.linspace(0,10,41))
+        wavelength=np.linspace(0,10,11)
+        accumulator.add(wavelength,2*wavelength+1)
+        np.testing.assert_allclose(accumulator.result(),2*accumulator.grid+1)
+
+    def testUnsortedWavelengthsAreSorted(self):
+        accumulator=SpectrumAccumulator(np.linspace(0,10,41))
+        wavelength=np.linspace(10,0,11)
+        accumulator.add(wavelength,wavelength**2)
+        np.testing.assert_allclose(accumulator.result(),np.interp(accumulator.grid,wavelength[::-1],wavelength[::-1]**2))
+
+    def testOverlapIsCrossFaded(self):
+        accumulator=SpectrumAccumulator(np.linspace(0,10,101))
+        accumulator.add(np.linspace(0,6,61),np.ones(61))
+        accumulator.add(np.linspace(4,10,61),3*np.ones(61))
+        grid,values=accumulator.grid,accumulator.result()
+        np.testing.assert_allclose(values[grid<4],1)
+        np.testing.assert_allclose(values[grid>6],3)
+        # Each sub-spectrum is weighted by its distance to its own edge, so the seam is a linear ramp from 1 to 3
+        overlap=np.logical_and(grid>4.05,grid<5.95)
+        np.testing.assert_allclose(values[overlap],1+2*(grid[overlap]-4)/2,rtol=1e-5)
+        self.assertTrue((np.diff(values)>=-1e-9).all())
+
+    def testAgreeingSpectraAreUnchangedByBlending(self):
+        accumulator=SpectrumAccumulator(np.linspace(0,10,101))
+        for lo,hi in [(0,4),(3,7),(6,10)]:
+            wavelength=np.linspace(lo,hi,41)
+            accumulator.add(wavelength,np.sin(wavelength))
+        np.testing.assert_allclose(accumulator.result(),np.sin(accumulator.grid),atol=2e-3)
+
+    def testGapIsInterpolated(self):
+        accumulator=SpectrumAccumulator(np.linspace(0,10,101))
+        accumulator.add(np.linspace(0,4,41),np.ones(41))
+        accumulator.add(np.linspace(6,10,41),3*np.ones(41))
+        grid,values=accumulator.grid,accumulator.result()
+        gap=np.logical_and(grid>4,grid<6)
+        np.testing.assert_allclose(values[gap],1+(grid[gap]-4),rtol=1e-5)
+
+    def testUncoveredEndsAreNotExtrapolated(self):
+        accumulator=SpectrumAccumulator(np.linspace(0,10,101))
+        accumulator.add(np.linspace(2,8,61),5*np.ones(61))
+        grid=accumulator.grid
+        outside=np.logical_or(grid<2-1e-9,grid>8+1e-9)
+        np.testing.assert_array_equal(accumulator.covered(),~outside)
+        np.testing.assert_array_equal(accumulator.result()[outside],0)
+        self.assertTrue(np.isnan(accumulator.result(fill=np.nan)[outside]).all())
+        np.testing.assert_allclose(accumulator.result()[~outside],5)
+
+    def testNothingAdded(self):
+        accumulator=SpectrumAccumulator(np.linspace(0,10,11))
+        np.testing.assert_array_equal(accumulator.result(),np.zeros(11))
+
+if __name__=="__main__":
+    unittest.main()
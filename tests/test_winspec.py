@@ -0,0 +1,54 @@
+from __future__ import division
+import os, sys, unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import winspec
+    from winspec import csts
+except ImportError as e:
+    # Winspec and its type library are only installed on the lab PC
+    winspec=None
+
+class _DocFile(object):
+    """ Stand-in for a WinX32.DocFile holding frames of xdim by ydim (binned) pixels """
+    def __init__(self,xdim,ydim):
+        self.params={csts.DM_XDIM:xdim,csts.DM_YDIM:ydim}
+    def GetParam(self,paramNum):
+        return (self.params[paramNum],0)
+
+@unittest.skipIf(winspec is None,"Winspec isn't available")
+class UseFileReadTest(unittest.TestCase):
+    """ Winspec._useFileRead chooses between reading the frames via ActiveX and from the file on disk """
+    def winspecWithDocFile(self,xdim,ydim):
+        w=winspec.Winspec.__new__(winspec.Winspec)
+        w._paramCache={}
+        w.docFile=_DocFile(xdim,ydim)
+        return w
+
+    def setUp(self):
+        self.readFromFile=winspec.READ_FROM_FILE
+        winspec.READ_FROM_FILE=None
+
+    def tearDown(self):
+        winspec.READ_FROM_FILE=self.readFromFile
+
+    def testSingleFrameUsesCOM(self):
+        # A full 640x512 frame is over FILE_READ_MIN_BYTES, but it's still only one ActiveX call
+        self.assertFalse(self.winspecWithDocFile(640,512)._useFileRead(1))
+
+    def testFewBinnedFramesUseCOM(self):
+        self.assertFalse(self.winspecWithDocFile(1024,1)._useFileRead(2))
+
+    def testManyFramesUseFile(self):
+        self.assertTrue(self.winspecWithDocFile(1024,1)._useFileRead(winspec.FILE_READ_MIN_FRAMES))
+
+    def testLargeFramesUseFile(self):
+        self.assertTrue(self.winspecWithDocFile(640,512)._useFileRead(2))
+
+    def testForcedStrategy(self):
+        winspec.READ_FROM_FILE=False
+        self.assertFalse(self.winspecWithDocFile(1024,1)._useFileRead(100))
+        winspec.READ_FROM_FILE=True
+        self.assertTrue(self.winspecWithDocFile(1024,1)._useFileRead(1))
+
+if __name__=="__main__":
+    unittest.main()
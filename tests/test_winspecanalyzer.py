@@ -0,0 +1,69 @@
+from __future__ import division
+import os, sys, unittest
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+try:
+    import numpy as np
+    import winspecanalyzer
+    from winspecanalyzer import blockSums, blockCentroid, optimalBand
+except (ImportError, NameError) as e:
+    # PyQt or scipy aren't installed, or Winspec isn't (which the analyzer's defaults come from)
+    winspecanalyzer=None
+
+@unittest.skipIf(winspecanalyzer is None,"the Winspec analyzer dependencies aren't available")
+class BlockCentroidTest(unittest.TestCase):
+    """ blockCentroid finds the brightest block of pixels and the sub-pixel centroid of it """
+    def setUp(self):
+        self.random=np.random.RandomState(0)
+        self.x=np.linspace(950,1010,1024)
+
+    def testBlockSums(self):
+        np.testing.assert_array_equal(blockSums(np.arange(6),3),[3,6,9,12])
+        np.testing.assert_array_equal(blockSums(np.ones((2,4)),2,axis=0),[[2,2,2,2]])
+
+    def testCentroidOfPeak(self):
+        pixels=np.arange(1024)
+        data=1000*np.exp(-0.5*((pixels-400.3)/1.5)**2)+self.random.randn(1024)
+        center,confidence=blockCentroid(self.x,data,winspecanalyzer.PEAK_LUM_BLOCK_SIZE)
+        self.assertAlmostEqual(center,np.interp(400.3,pixels,self.x),delta=0.3*(self.x[1]-self.x[0]))
+        self.assertGreater(confidence,0.9)
+
+    def testNoiseHasLowConfidence(self):
+        center,confidence=blockCentroid(self.x,self.random.randn(1024),winspecanalyzer.PEAK_LUM_BLOCK_SIZE)
+        self.assertLess(confidence,0.5)
+
+    def testNoiselessPeakIsCertain(self):
+        data=np.zeros(1024)
+        data[100:103]=[1,2,1]
+        center,confidence=blockCentroid(self.x,data,winspecanalyzer.PEAK_LUM_BLOCK_SIZE)
+        self.assertAlmostEqual(center,self.x[101])
+        self.assertEqual(confidence,1.0)
+
+    def testBlockLargerThanData(self):
+        center,confidence=blockCentroid(self.x[:3],[0,1,0],5)
+        self.assertAlmostEqual(center,self.x[1])
+
+@unittest.skipIf(winspecanalyzer is None,"the Winspec analyzer dependencies aren't available")
+class OptimalBandTest(unittest.TestCase):
+    """ optimalBand chooses the rows of a 2D detector to bin for the best SNR """
+    def image(self,center,width,amplitude=100.0,rows=100,noise=5.0):
+        random=np.random.RandomState(1)
+        profile=amplitude*np.exp(-0.5*((np.arange(rows)-center)/width)**2)
+        return np.outer(np.hanning(256),profile)+noise*random.randn(256,rows)
+
+    def testBandContainsTheSpot(self):
+        top,bottom=optimalBand(self.image(40.0,3.0))
+        # 1-based inclusive rows around the spot, which don't extend far into the rows which are only noise
+        self.assertTrue(top<=41<=bottom)
+        self.assertTrue(30<top and bottom<52)
+
+    def testWeakerSpotGivesNarrowerBand(self):
+        strong=optimalBand(self.image(60.0,4.0,amplitude=1000.0))
+        weak=optimalBand(self.image(60.0,4.0,amplitude=2.0))
+        self.assertLess(weak[1]-weak[0],strong[1]-strong[0])
+
+    def testSpotAtTheEdge(self):
+        top,bottom=optimalBand(self.image(0.0,3.0))
+        self.assertEqual(top,1)
+
+if __name__=="__main__":
+    unittest.main()
@@ -6,7 +6,8 @@ if winspecTypeLib is None:
 from win32com.client import constants as csts
 from ctypes import c_long, c_float, c_bool
 from numpy import *
-import os,string,struct,ast
+import os,string,ast,json
+from spefile import read_spe, read_spe_frames
 
 # By default store spectrum files in $USER_HOME_DIR\Winspec
 WINSPEC_DEFAULT_DIR = os.path.join(os.path.expanduser('~'), 'Winspec')
@@ -23,9 +24,34 @@ DEFAULT_EXPOSURE = 0.2
 # Default wavelength range to measure calibration over
 DEFAULT_CAL_RANGE = {0:(900, 1100), 1:(1100, 1500), 2:(1100, 1500)}
 # Name of detector definition file used to store calibration data, etc
-DETECTOR_DEF_FILE = 'detector.txt'
-# Flag to enable reading spectra from the file (i.e. from disk) instead of reading via ActiveX. MUCH faster when large numFrames
-READ_FROM_FILE=False                     
+DETECTOR_DEF_FILE = 'detector.json'
+# Name of the legacy (unversioned) detector definition file, which is only read if DETECTOR_DEF_FILE doesn't exist
+LEGACY_DETECTOR_DEF_FILE = 'detector.txt'
+# Version of the detector definition written to DETECTOR_DEF_FILE
+DETECTOR_DEF_VERSION = 2
+# Order of the polynomials relating the center wavelength to the wavelengths at the edges of the detector
+CAL_POLY_ORDER = 5
+# Number of evenly spaced center wavelengths initially measured over the calibration range of each grating (must be > CAL_POLY_ORDER)
+CAL_INITIAL_POINTS = 7
+# Maximum number of center wavelengths measured over the calibration range of each grating
+CAL_MAX_POINTS = 100
+# Maximum error [nm] of the local interpolation at a newly measured center before the interval around it is refined
+CAL_MAX_RESIDUAL = 0.01
+# Order of the polynomial through the nearest measured centers which predicts the edges at a new center (must be < CAL_INITIAL_POINTS)
+CAL_LOCAL_ORDER = 3
+# Exposure time [s] used for the dummy acquisitions during calibration
+CAL_EXPOSURE = 1e-6
+# Experiment parameters which are cached in the Winspec object instead of being read via ActiveX on every call. The detector size 
+# is static, and the others are only changed through setExpParamSafe (or by loading an experiment setup, which clears the cache)
+CACHED_EXP_PARAMS = (csts.EXP_XDIMDET, csts.EXP_YDIMDET, csts.EXP_EXPOSURE, csts.EXP_ACCUMS, csts.EXP_SEQUENTS, csts.EXP_USEROI)
+# Flag to choose how spectra are read back from Winspec (True: always read from the file on disk, False: always read via ActiveX,
+# None: choose automatically from the number and size of the frames). Reading from file is MUCH faster when large numFrames
+READ_FROM_FILE=None
+# Minimum number of frames for which the automatic strategy reads from the file on disk instead of via ActiveX
+FILE_READ_MIN_FRAMES=10
+# Minimum total size of the (binned) frames [bytes] for which the automatic strategy reads a multi-frame acquisition from the file
+# on disk instead of via ActiveX. A single frame is always read via ActiveX, since that's only one call however big the frame is
+FILE_READ_MIN_BYTES=2**20
 
 class Winspec(object):
     """ Wrapper around the Winspec COM object which provides high level methods to move and measure spectra with Winspec.
@@ -52,6 +78,12 @@ class Winspec(object):
         # Create objects for the experiment, spectrometer, and data document
         self.expSetup = w32c.Dispatch("WinX32.ExpSetup")
         self.spectroObj = w32c.Dispatch("WinX32.SpectroObjMgr").Current
+        # Anything cached from a previous connection can't be trusted
+        self.clearCache()
+
+    def clearCache(self):
+        """ Clear the cached parameters so that they are read from Winspec again on the next call """
+        self._paramCache = {}
 
     def setExpSetupProfile(self,fname):
         """ Initializes the experiment setup by loading a default file. 
@@ -61,6 +93,7 @@ class Winspec(object):
         dir=os.path.join(os.getcwd(),"winspec_config")+os.sep
         success=page.LoadExperimentSetup(dir,fname) # note: this seems to return true even if the file wasn't found
         del ExpSetupUI
+        self.clearCache()
 
     def acquireBackgroundSpectrum(self,exposureTime=None):
         """ Acquire a background """
@@ -103,9 +136,10 @@ class Winspec(object):
                     pass
                 acquisition()
 
-    def readBackground(self, row = 0):
+    def readBackground(self, row = 0, fname = None):
         # The only way to get the background data seems to be by reading the file from disk (~1ms latency)
-        noiseFloorSpectrum=array(read_spe(self.getExpParamSafe(csts.EXP_DARKNAME))["data"])
+        if fname is None: fname=self.getExpParamSafe(csts.EXP_DARKNAME)
+        noiseFloorSpectrum=array(read_spe(fname)["data"])
         return noiseFloorSpectrum[0, row, :]
     def deleteBackgroundFile(self):
         os.remove(self.getExpParamSafe(csts.EXP_DARKNAME))
@@ -131,9 +165,37 @@ class Winspec(object):
             docFiles=w32c.Dispatch("WinX32.DocFiles")
             docFiles.CloseAll()
             del self.docFile
+            self._invalidateCalibration()
         # return the data
         return wavelengthData,counts,outDict
 
+    def acquireSpectrumDeferred(self,numFrames=1,exposureTime=None):
+        """ Acquire a spectrum like acquireSpectrum, but return as soon as Winspec has finished the acquisition, with a function which
+        reads the frames from the file on disk and returns the same (wavelength, counts, dictionary) as acquireSpectrum.
+        The function doesn't use ActiveX, so it can run in another thread while Winspec is used for something else, e.g. moving the
+        spectrometer to the next position """
+        if exposureTime: self.setExposureTime(exposureTime)
+        self.setNumFrames(numFrames)
+        self.setSpectroscopyMode(True)
+        assert self.getRoiHeight() == 1, "Not in spectroscopy mode"
+        assert self.getNumAccumulations()==1, "The automatic detection of saturation requires no more than 1 accumulation"
+        self.docFile = w32c.Dispatch("WinX32.DocFile")
+        self._invalidateCalibration()
+        self._runAcquisition()
+        # Read everything that needs Winspec before it moves on: the calibration belongs to the position the spectrum was acquired at
+        p=self.getCalibrationCoeffs()
+        assert self.backgroundSubtractFlag(), "The background subtract flag was not set for current Winspec file"
+        dataFilename=self.getDataFilename()
+        backgroundFilename=self.getExpParamSafe(csts.EXP_DARKNAME)
+        docFiles=w32c.Dispatch("WinX32.DocFiles")
+        docFiles.CloseAll()
+        del self.docFile
+        self._invalidateCalibration()
+        def readSpectrum():
+            countSum,countMax,rowMax=self._readFramesFromFile(dataFilename)
+            return self._spectrumFromFrames(p,countSum,countMax,rowMax,numFrames,self.readBackground(rowMax,backgroundFilename))
+        return readSpectrum
+
     def _getWinspecSpectrum(self,numFrames=1):
         """ Acquire a spectrum from winspec numRepetetions times and return the average.
         Also check to see if the data was saturating or if there was anything abnormal with it """
@@ -141,6 +203,33 @@ class Winspec(object):
         # Set the docfile
         assert self.getNumAccumulations()==1, "The automatic detection of saturation requires no more than 1 accumulation"
         self.docFile = w32c.Dispatch("WinX32.DocFile")
+        self._invalidateCalibration()
+        self._runAcquisition()
+        # Read back the sum and maximum of each pixel over all frames, so memory doesn't grow with numFrames
+        if self._useFileRead(numFrames):
+            countSum,countMax,rowMax=self._readFramesFromFile()
+        else:
+            countSum,countMax,rowMax=self._readFramesFromCOM(numFrames)
+        # Get the background data and return the std of it back so we know the noise floor
+        assert self.backgroundSubtractFlag(), "The background subtract flag was not set for current Winspec file"
+        return self._spectrumFromFrames(self.getCalibrationCoeffs(),countSum,countMax,rowMax,numFrames,self.readBackground(rowMax))
+
+    def _spectrumFromFrames(self,p,countSum,countMax,rowMax,numFrames,noiseFloor):
+        """ Convert the sum and maximum of the frames to wavelength (with the calibration polynomial p), average counts and the
+        dictionary describing the spectrum """
+        wavelengthData=polyval(p,range(1,1+len(countSum)))
+        # check if any frame of the file is saturating
+        saturating=self.isSaturating(countMax+noiseFloor)
+        # return three arguments giving lambda, counts (averaged over each frame), and some extra stuff in a dictionary
+        avgCounts=countSum/numFrames
+        avgCounts[avgCounts<0]=0    # make sure no entries are below zero in final data
+        outDict={"saturating":saturating, "noiseFloor":noiseFloor, "maxSample":amax(countMax)}
+        return (wavelengthData,avgCounts,outDict)
+
+    def _runAcquisition(self):
+        """ Get Winspec to start the acquisition into the current docFile and wait for it to finish """
+        # The calibration of the docFile is updated by the acquisition
+        self._invalidateCalibration()
         if self.expSetup.Start(self.docFile)[0]:
             EXP_RUNNING=csts.EXP_RUNNING
             # Check the status of the acquisition
@@ -153,45 +242,55 @@ class Winspec(object):
                 raise CommError, 'Could not obtain status of experiment from Winspec while obtaining spectrum'
         else:
             raise CommError, 'Could not initiate acquisition in Winspec while trying to obtaining spectrum'
-        if not READ_FROM_FILE:
-            # Read each frame of the data file from Winspec by passing a pointer to a memory location where Python can find it
-            datapointer = c_float()
-            for idx in range(int(numFrames)):
-                # Extract frame of data via datapointer
-                try:
-                    frameCounts = array(self.docFile.GetFrame(idx+1, datapointer))
-                except Exception as e:
-                    raise CommError, "Could not read data from Winspec: " + str(e.args[0])
-                # Raise error if no data was read back
-                if frameCounts is None: raise CommError,"No data returned from Winspec"
-                # If a 2D sensor then take the maximum row
-                rowMax = argmax(sum(frameCounts, 0)) if shape(frameCounts)[0] > 1 else 0
-                frameCounts = frameCounts[:, rowMax]
-                # If first frame then create a numpy array where we will store the data
-                if idx==0: counts=zeros((len(frameCounts),numFrames))
-                # Put the frame into the numpy array
-                counts[:,idx] = frameCounts
-        else:
-            # Read directly from spectrum file, as this can be much faster than COM interface for large num frames
-            fname=self.getDataFilename()
-            if string.lower(fname[-4:])!=".spe": fname=fname+".spe"
-            dataList=read_spe(fname)["data"]
+
+    def _useFileRead(self,numFrames):
+        """ Decide whether to read the frames of the current docFile from the file on disk or via ActiveX. ActiveX has a large overhead
+        per frame, so the file is used when there are several frames and either many of them or lots of data. The size of each frame is
+        read from the docFile, so it's the size after binning (frames are transferred as 4 byte floats) """
+        if READ_FROM_FILE is not None: return READ_FROM_FILE
+        if numFrames<=1: return False
+        numBytes=numFrames*self.docFile.GetParam(csts.DM_XDIM)[0]*self.docFile.GetParam(csts.DM_YDIM)[0]*4
+        return numFrames>=FILE_READ_MIN_FRAMES or numBytes>=FILE_READ_MIN_BYTES
+
+    def _readFramesFromCOM(self,numFrames):
+        """ Read each frame of the data file from Winspec by passing a pointer to a memory location where Python can find it.
+        Returns the sum and maximum of each pixel over all frames, and the row of the detector that was used """
+        datapointer = c_float()
+        for idx in range(int(numFrames)):
+            # Extract frame of data via datapointer
+            try:
+                frameCounts = self.docFile.GetFrame(idx+1, datapointer)
+            except Exception as e:
+                raise CommError, "Could not read data from Winspec: " + str(e.args[0])
+            # Raise error if no data was read back
+            if frameCounts is None: raise CommError,"No data returned from Winspec"
+            frameCounts = array(frameCounts,dtype=float)
             # If a 2D sensor then take the maximum row
-            rowMax = argmax(sum(array(dataList)[0,:,:], 1)) if shape(dataList)[1] > 1 else 0
-            counts=array(dataList)[:,rowMax,:].transpose()
-        # Convert the pixel data to wavelength using calibration data from Winspec
-        p=self.getCalibrationCoeffs()
-        wavelengthData=polyval(p,range(1,1+counts.shape[0]))
-        # Get the background data and return the std of it back so we know the noise floor
-        assert self.backgroundSubtractFlag(), "The background subtract flag was not set for current Winspec file"
-        noiseFloor=self.readBackground(rowMax)
-        # check if any frame of the file is saturating
-        saturating=self.isSaturating(counts+tile(noiseFloor,(numFrames,1)).transpose())
-        # return three arguments giving lambda, counts (averaged over each frame), and some extra stuff in a dictionary
-        avgCounts=sum(counts,1)/numFrames
-        avgCounts[avgCounts<0]=0    # make sure no entries are below zero in final data
-        outDict={"saturating":saturating, "noiseFloor":noiseFloor, "maxSample":amax(counts)}
-        return (wavelengthData,avgCounts,outDict)
+            rowMax = argmax(sum(frameCounts, 0)) if shape(frameCounts)[0] > 1 else 0
+            frameCounts = frameCounts[:, rowMax]
+            # If first frame then create the running sum and maximum, otherwise update them in place
+            if idx==0:
+                countSum=frameCounts.copy()
+                countMax=frameCounts.copy()
+            else:
+                countSum+=frameCounts
+                maximum(countMax,frameCounts,countMax)
+        return countSum,countMax,rowMax
+
+    def _readFramesFromFile(self,fname=None):
+        """ Read the frames directly from the spectrum file (default the current data file) by memory mapping it, as this can be much
+        faster than the COM interface for large num frames. Returns the sum and maximum of each pixel over all frames, and the row of the
+        detector that was used """
+        if fname is None: fname=self.getDataFilename()
+        if string.lower(fname[-4:])!=".spe": fname=fname+".spe"
+        frames=read_spe_frames(fname)
+        # If a 2D sensor then take the maximum row
+        rowMax = argmax(sum(frames[0,:,:], 1)) if frames.shape[1] > 1 else 0
+        rows=frames[:,rowMax,:]
+        # Copy the reductions out of the memory map so that the file is released when frames goes out of scope
+        countSum=array(rows.sum(0,dtype=float64))
+        countMax=array(rows.max(0),dtype=float)
+        return countSum,countMax,rowMax
 
     def acquireImageBackground(self, exposureTime=None):
         """ Takes a 2D background reading. Requires a 2D detector """
@@ -210,6 +309,8 @@ class Winspec(object):
         self.setSpectroscopyMode(False)
         datapointer = c_float()
         self.docFile = w32c.Dispatch("WinX32.DocFile")
+        self._invalidateCalibration()
+        self._runAcquisition()
         return array(self.docFile.GetFrame(1, datapointer))
         
     def isSaturating(self,countData):
@@ -268,6 +369,8 @@ class Winspec(object):
             self.spectroObj.SetParam(csts.SPT_NEW_GRATING,gratingNum)
         self.spectroObj.SetParam(csts.SPT_NEW_POSITION,center)
         self.spectroObj.Move()
+        self._invalidateCalibration()
+        if gratingNum!=None: self._paramCache["grating"]=gratingNum
     
     def setMirrorState(self,state=True):
         """ Sets the state of the final mirror. If state=True the mirror is set to the front, otherwise the side """
@@ -281,6 +384,7 @@ class Winspec(object):
         # DEPRECATED :: USE setPosition() instead
         self.spectroObj.SetParam(csts.SPT_NEW_POSITION,center)
         self.spectroObj.Move()
+        self._invalidateCalibration()
 
     def getCenter(self):
         """ Get the center wavelength """
@@ -289,17 +393,29 @@ class Winspec(object):
     def setGrating(self,gratingNum):
         self.spectroObj.SetParam(csts.SPT_NEW_GRATING,gratingNum)
         self.spectroObj.Move()
+        self._invalidateCalibration()
+        self._paramCache["grating"]=gratingNum
 
     def getGrating(self):
-        return self.spectroObj.GetParam(csts.SPT_CUR_GRATING)[0]
+        if "grating" not in self._paramCache:
+            self._paramCache["grating"]=self.spectroObj.GetParam(csts.SPT_CUR_GRATING)[0]
+        return self._paramCache["grating"]
+
+    def _invalidateCalibration(self):
+        """ Drop the cached calibration, which has to be done whenever the spectrometer moves or the docFile is replaced or deleted """
+        self._paramCache.pop("calibration",None)
 
     def getCalibrationCoeffs(self):
         """ Return a numpy array of poynomial coefficients for the calibration at current position """
+        # The cached calibration is only valid for the docFile it was read from
+        cached=self._paramCache.get("calibration")
+        if cached is not None and cached[0] is self.docFile: return cached[1].copy()
         calibration = self.docFile.GetCalibration()
         p=array([])
         for idx in range(calibration.Order+1)[::-1]:
             p=append(p,calibration.PolyCoeffs(idx))
-        return p
+        self._paramCache["calibration"]=(self.docFile,p)
+        return p.copy()
 
     def getNumberOfPixels(self):
         return self.getExpParamSafe(csts.EXP_XDIMDET)
@@ -318,8 +434,10 @@ class Winspec(object):
 
     def getExpParamSafe(self,paramNum):
         """ Gets a parameter from Winspec experiment and raises an exception if there was an error """
+        if paramNum in self._paramCache: return self._paramCache[paramNum]
         paramValue,status=self.expSetup.GetParam(paramNum)
         if status==0:
+            if paramNum in CACHED_EXP_PARAMS: self._paramCache[paramNum]=paramValue
             return paramValue
         else:
             raise CommError, "There was an error getting an experimental parameter from Winspec"
@@ -328,8 +446,11 @@ class Winspec(object):
         """ Sets a parameter from Winspec experiment and raises an exception if there was an error """
         status=self.expSetup.SetParam(paramNum,paramValue)
         if status==0:
+            if paramNum in CACHED_EXP_PARAMS: self._paramCache[paramNum]=paramValue
             return True
         else:
+            # The state of the parameter in Winspec is unknown after an error
+            self._paramCache.pop(paramNum,None)
             raise CommError, "There was an error getting an experimental parameter from Winspec"
 
     def setOverwriteWarning(self,state=0):
@@ -413,40 +534,74 @@ class Winspec(object):
         cal = self.detector["calibration"]
         return (cal["centerFromLeft"][g],cal["centerFromRight"][g],cal["leftFromCenter"][g],cal["rightFromCenter"][g])
 
-    def measureCalibration(self):
+    def measureCalibration(self,gratings=None):
         """ Measure the calibration data from Winspec necessary to do a step and glue, and store it in DETECTOR_DEF_FILE.
-       Works by scanning the spectrometer through some wavelength range, and extracting min and max wavelengths from dummy data """
+        Works by scanning the spectrometer through the calibration range and reading the min and max wavelengths of the detector 
+        from the calibration of a dummy acquisition. The centers are chosen adaptively, by bisecting only those intervals where a local
+        interpolation of the centers measured so far doesn't predict a newly measured center to within CAL_MAX_RESIDUAL. 
+        Optionally only recalibrate the specified (0-based) gratings, e.g. after a grating swap """
         self.sendStatusMessage("Extracting the calibration data from Winspec")
-        self.setExposureTime(1e-6)  # only dummy data so make measurement as fast as possible
+        if gratings is None: gratings=[0,1,2]
+        self.setExposureTime(CAL_EXPOSURE)  # only dummy data so make measurement as fast as possible
         self.acquireBackgroundSpectrum()
-        # Initialize calibration data
-        self.detector["calibration"] = {}
-        self.detector["calibration"]["leftFromCenter"] = [None]*3
-        self.detector["calibration"]["rightFromCenter"] = [None]*3
-        self.detector["calibration"]["centerFromLeft"] = [None]*3
-        self.detector["calibration"]["centerFromRight"] = [None]*3
-        self.detector["resolution"] = [None]*3
-        for grating in [0,1,2]:
-            calRange = self.detector["calibrationRange"][grating]
-            lambdaCenter=linspace(calRange[0],calRange[1],100)
-            lambdaMin=zeros(size(lambdaCenter))
-            lambdaMax=zeros(size(lambdaCenter))
-            self.setGrating(grating+1)
-            for lambdaIdx in range(len(lambdaCenter)):
-                self.setPosition(lambdaCenter[lambdaIdx])
-                x,y,s=self.acquireSpectrum(cleanup=False) # get dummy spectrum
-                p=self.getCalibrationCoeffs()
-                lambdaMin[lambdaIdx]=polyval(p,1)
-                lambdaMax[lambdaIdx]=polyval(p,len(x))
-            # Fit 5th order polynomial to the data for left and right ends of the spectrum
-            lfc=self.detector["calibration"]["leftFromCenter"][grating]=list(polyfit(lambdaCenter,lambdaMin,5))
-            rfc=self.detector["calibration"]["rightFromCenter"][grating]=list(polyfit(lambdaCenter,lambdaMax,5))
-            self.detector["calibration"]["centerFromLeft"][grating]=list(polyfit(lambdaMin,lambdaCenter,5))
-            self.detector["calibration"]["centerFromRight"][grating]=list(polyfit(lambdaMax,lambdaCenter,5))
-            self.detector["resolution"][grating] = (polyval(rfc, mean(calRange))-polyval(lfc, mean(calRange)))/self.detector["width"]
-        f=open(DETECTOR_DEF_FILE,'w')
-        f.write(str(self.detector))
-        f.close()
+        self.setNumFrames(1)
+        self.setSpectroscopyMode(True)
+        # Initialize calibration data, keeping any existing data for gratings which aren't being recalibrated
+        if "calibration" not in self.detector:
+            self.detector["calibration"] = {"leftFromCenter":[None]*3, "rightFromCenter":[None]*3, "centerFromLeft":[None]*3, "centerFromRight":[None]*3}
+            self.detector["resolution"] = [None]*3
+        # A single docFile is reused for all of the dummy acquisitions
+        self.docFile = w32c.Dispatch("WinX32.DocFile")
+        self._invalidateCalibration()
+        try:
+            for grating in gratings:
+                calRange = self.detector["calibrationRange"][grating]
+                self.setGrating(grating+1)
+                lambdaCenter,lambdaMin,lambdaMax=self._scanCalibration(calRange)
+                self.sendStatusMessage("Calibrated grating %d using %d center wavelengths" % (grating+1, len(lambdaCenter)))
+                # Fit polynomials to the data for left and right ends of the spectrum
+                lfc=self.detector["calibration"]["leftFromCenter"][grating]=list(polyfit(lambdaCenter,lambdaMin,CAL_POLY_ORDER))
+                rfc=self.detector["calibration"]["rightFromCenter"][grating]=list(polyfit(lambdaCenter,lambdaMax,CAL_POLY_ORDER))
+                self.detector["calibration"]["centerFromLeft"][grating]=list(polyfit(lambdaMin,lambdaCenter,CAL_POLY_ORDER))
+                self.detector["calibration"]["centerFromRight"][grating]=list(polyfit(lambdaMax,lambdaCenter,CAL_POLY_ORDER))
+                self.detector["resolution"][grating] = (polyval(rfc, mean(calRange))-polyval(lfc, mean(calRange)))/self.detector["width"]
+        finally:
+            docFiles=w32c.Dispatch("WinX32.DocFiles")
+            docFiles.CloseAll()
+            del self.docFile
+            self._invalidateCalibration()
+        writeDetectorDefinition(self.detector)
+
+    def _scanCalibration(self,calRange):
+        """ Measure the detector edges at adaptively chosen centers over calRange for the current grating. 
+        Returns sorted arrays of the center, min and max wavelengths. The error is judged against a local interpolation rather than the 
+        global calibration polynomials, since its error shrinks as the centers get closer together, so the refinement converges """
+        centers=list(linspace(calRange[0],calRange[1],CAL_INITIAL_POINTS))
+        edges=[self._measureCalibrationEdges(center) for center in centers]
+        intervals=zip(centers[:-1],centers[1:])
+        while intervals and len(centers)+len(intervals)<=CAL_MAX_POINTS:
+            refine=[]
+            for a,b in intervals:
+                center=(a+b)/2
+                predicted=[localInterpolation(centers,[e[k] for e in edges],center,CAL_LOCAL_ORDER) for k in (0,1)]
+                left,right=self._measureCalibrationEdges(center)
+                centers.append(center)
+                edges.append((left,right))
+                # Only keep bisecting where the neighbouring centers don't predict the new point
+                if abs(predicted[0]-left) > CAL_MAX_RESIDUAL or abs(predicted[1]-right) > CAL_MAX_RESIDUAL:
+                    refine+=[(a,center),(center,b)]
+            intervals=refine
+        idx=argsort(centers)
+        edges=array(edges)[idx]
+        return array(centers)[idx],edges[:,0],edges[:,1]
+
+    def _measureCalibrationEdges(self,center):
+        """ Move to center and return the wavelengths of the first and last pixel. The COM interface only exposes the 
+        pixel calibration through a DocFile, so a dummy acquisition is needed, but none of the data is read back """
+        self.setPosition(center)
+        self._runAcquisition()
+        p=self.getCalibrationCoeffs()
+        return (polyval(p,1),polyval(p,self.detector["width"]))
 
     def sendStatusMessage(self,msg):
         """ Send a status message to the user """
@@ -463,338 +618,40 @@ class Winspec(object):
         docFiles.CloseAll()
 
 
+def localInterpolation(x,y,x0,order):
+    """ Value at x0 of the polynomial of the given order through the order+1 points (x,y) which are nearest to x0 """
+    x=asarray(x)
+    nearest=argsort(abs(x-x0))[:order+1]
+    return polyval(polyfit(x[nearest],asarray(y)[nearest],len(nearest)-1),x0)
+
 def readDetectorDefinition():
-    """ Read the detector definition from the file 'detector.txt'
+    """ Read the detector definition from DETECTOR_DEF_FILE, or from LEGACY_DETECTOR_DEF_FILE if it hasn't been converted yet
     TODO: try get all of the same information directly from Winspec """
+    if not os.path.exists(DETECTOR_DEF_FILE) and os.path.exists(LEGACY_DETECTOR_DEF_FILE):
+        f=open(LEGACY_DETECTOR_DEF_FILE,'r')
+        s = f.read()
+        f.close()
+        return ast.literal_eval(s)
     try:
         f=open(DETECTOR_DEF_FILE,'r')
     except IOError as e:
-        raise IOError, "Could not read Winspec detector definition from detector.txt.\n" + str(e.args[0])
-    s = f.read()
+        raise IOError, "Could not read Winspec detector definition from %s.\n" % DETECTOR_DEF_FILE + str(e.args[0])
+    definition=json.load(f)
+    f.close()
+    version=definition.pop("version",None)
+    if version!=DETECTOR_DEF_VERSION:
+        raise IOError, "Unsupported version %s of the Winspec detector definition in %s" % (version, DETECTOR_DEF_FILE)
+    # JSON only has string keys and lists, so convert back to the structure used by Winspec
+    definition["calibrationRange"]=dict((int(k),tuple(v)) for k,v in definition["calibrationRange"].items())
+    return definition
+
+def writeDetectorDefinition(detector):
+    """ Write the detector definition to DETECTOR_DEF_FILE, tagged with DETECTOR_DEF_VERSION """
+    definition=dict(detector)
+    definition["version"]=DETECTOR_DEF_VERSION
+    f=open(DETECTOR_DEF_FILE,'w')
+    json.dump(definition,f,indent=1,sort_keys=True)
     f.close()
-    return ast.literal_eval(s)
-
-
-def read_spe(spefilename, verbose=False):
-    """ 
-    Read a binary PI SPE file into a python dictionary
-
-    Inputs:
-
-        spefilename --  string specifying the name of the SPE file to be read
-        verbose     --  boolean print debug statements (True) or not (False)
-
-        Outputs
-        spedict     
-        
-            python dictionary containing header and data information
-            from the SPE file
-            Content of the dictionary is:
-            spedict = {'data':[],    # a list of 2D numpy arrays, one per image
-            'IGAIN':pimaxGain,
-            'EXPOSURE':exp_sec,
-            'SPEFNAME':spefilename,
-            'OBSDATE':date,
-            'CHIPTEMP':detectorTemperature
-            }
-
-    I use the struct module to unpack the binary SPE data.
-    Some useful formats for struct.unpack_from() include:
-    fmt   c type          python
-    c     char            string of length 1
-    s     char[]          string (Ns is a string N characters long)
-    h     short           integer 
-    H     unsigned short  integer
-    l     long            integer
-    f     float           float
-    d     double          float
-
-    The SPE file defines new c types including:
-        BYTE  = unsigned char
-        WORD  = unsigned short
-        DWORD = unsigned long
-
-
-    Example usage:
-    Given an SPE file named test.SPE, you can read the SPE data into
-    a python dictionary named spedict with the following:
-    >>> import piUtils
-    >>> spedict = piUtils.readSpe('test.SPE')
-    """
-  
-    # open SPE file as binary input
-    spe = open(spefilename, "rb")
-    
-    # Header length is a fixed number
-    nBytesInHeader = 4100
-
-    # Read the entire header
-    header = spe.read(nBytesInHeader)
-    
-    # version of WinView used
-    swversion = struct.unpack_from("16s", header, offset=688)[0]
-    
-    # version of header used
-    # Eventually, need to adjust the header unpacking
-    # based on the headerVersion.  
-    headerVersion = struct.unpack_from("f", header, offset=1992)[0]
-  
-    # which camera controller was used?
-    controllerVersion = struct.unpack_from("h", header, offset=0)[0]
-    if verbose:
-        print "swversion         = ", swversion
-        print "headerVersion     = ", headerVersion
-        print "controllerVersion = ", controllerVersion
-    
-    # Date of the observation
-    # (format is DDMONYYYY  e.g. 27Jan2009)
-    date = struct.unpack_from("9s", header, offset=20)[0]
-    
-    # Exposure time (float)
-    exp_sec = struct.unpack_from("f", header, offset=10)[0]
-    
-    # Intensifier gain
-    pimaxGain = struct.unpack_from("h", header, offset=148)[0]
-
-    # Not sure which "gain" this is
-    gain = struct.unpack_from("H", header, offset=198)[0]
-    
-    # Data type (0=float, 1=long integer, 2=integer, 3=unsigned int)
-    data_type = struct.unpack_from("h", header, offset=108)[0]
-
-    comments = struct.unpack_from("400s", header, offset=200)[0]
-
-    # CCD Chip Temperature (Degrees C)
-    detectorTemperature = struct.unpack_from("f", header, offset=36)[0]
-
-    # The following get read but are not used
-    # (this part is only lightly tested...)
-    analogGain = struct.unpack_from("h", header, offset=4092)[0]
-    noscan = struct.unpack_from("h", header, offset=34)[0]
-    pimaxUsed = struct.unpack_from("h", header, offset=144)[0]
-    pimaxMode = struct.unpack_from("h", header, offset=146)[0]
-
-    ########### here's from Kasey
-    #int avgexp 2 number of accumulations per scan (why don't they call this "accumulations"?)
-#TODO: this isn't actually accumulations, so fix it...    
-    accumulations = struct.unpack_from("h", header, offset=668)[0]
-    if accumulations == -1:
-        # if > 32767, set to -1 and 
-        # see lavgexp below (668) 
-        #accumulations = struct.unpack_from("l", header, offset=668)[0]
-        # or should it be DWORD, NumExpAccums (1422): Number of Time experiment accumulated        
-        accumulations = struct.unpack_from("l", header, offset=1422)[0]
-        
-    """Start of X Calibration Structure (although I added things to it that I thought were relevant,
-       like the center wavelength..."""
-    xcalib = {}
-    
-    #SHORT SpecAutoSpectroMode 70 T/F Spectrograph Used
-    xcalib['SpecAutoSpectroMode'] = bool( struct.unpack_from("h", header, offset=70)[0] )
-
-    #float SpecCenterWlNm # 72 Center Wavelength in Nm
-    xcalib['SpecCenterWlNm'] = struct.unpack_from("f", header, offset=72)[0]
-    
-    #SHORT SpecGlueFlag 76 T/F File is Glued
-    xcalib['SpecGlueFlag'] = bool( struct.unpack_from("h", header, offset=76)[0] )
-
-    #float SpecGlueStartWlNm 78 Starting Wavelength in Nm
-    xcalib['SpecGlueStartWlNm'] = struct.unpack_from("f", header, offset=78)[0]
-
-    #float SpecGlueEndWlNm 82 Starting Wavelength in Nm
-    xcalib['SpecGlueEndWlNm'] = struct.unpack_from("f", header, offset=82)[0]
-
-    #float SpecGlueMinOvrlpNm 86 Minimum Overlap in Nm
-    xcalib['SpecGlueMinOvrlpNm'] = struct.unpack_from("f", header, offset=86)[0]
-
-    #float SpecGlueFinalResNm 90 Final Resolution in Nm
-    xcalib['SpecGlueFinalResNm'] = struct.unpack_from("f", header, offset=90)[0]
-
-    #  short   BackGrndApplied              150  1 if background subtraction done
-    xcalib['BackgroundApplied'] = struct.unpack_from("h", header, offset=150)[0]
-    BackgroundApplied=False
-    if xcalib['BackgroundApplied']==1: BackgroundApplied=True
-
-    #  float   SpecGrooves                  650  Spectrograph Grating Grooves
-    xcalib['SpecGrooves'] = struct.unpack_from("f", header, offset=650)[0]
-
-    #  short   flatFieldApplied             706  1 if flat field was applied.
-    xcalib['flatFieldApplied'] = struct.unpack_from("h", header, offset=706)[0]
-    flatFieldApplied=False
-    if xcalib['flatFieldApplied']==1: flatFieldApplied=True
-    
-    #double offset # 3000 offset for absolute data scaling */
-    xcalib['offset'] = struct.unpack_from("d", header, offset=3000)[0]
-
-    #double factor # 3008 factor for absolute data scaling */
-    xcalib['factor'] = struct.unpack_from("d", header, offset=3008)[0]
-    
-    #char current_unit # 3016 selected scaling unit */
-    xcalib['current_unit'] = struct.unpack_from("c", header, offset=3016)[0]
-
-    #char reserved1 # 3017 reserved */
-    xcalib['reserved1'] = struct.unpack_from("c", header, offset=3017)[0]
-
-    #char string[40] # 3018 special string for scaling */
-    xcalib['string'] = struct.unpack_from("40c", header, offset=3018)
-    
-    #char reserved2[40] # 3058 reserved */
-    xcalib['reserved2'] = struct.unpack_from("40c", header, offset=3058)
-
-    #char calib_valid # 3098 flag if calibration is valid */
-    xcalib['calib_valid'] = struct.unpack_from("c", header, offset=3098)[0]
-
-    #char input_unit # 3099 current input units for */
-    xcalib['input_unit'] = struct.unpack_from("c", header, offset=3099)[0]
-    """/* "calib_value" */"""
-
-    #char polynom_unit # 3100 linear UNIT and used */
-    xcalib['polynom_unit'] = struct.unpack_from("c", header, offset=3100)[0]
-    """/* in the "polynom_coeff" */"""
-
-    #char polynom_order # 3101 ORDER of calibration POLYNOM */
-    xcalib['polynom_order'] = struct.unpack_from("c", header, offset=3101)[0]
-
-    #char calib_count # 3102 valid calibration data pairs */
-    xcalib['calib_count'] = struct.unpack_from("c", header, offset=3102)[0]
-
-    #double pixel_position[10];/* 3103 pixel pos. of calibration data */
-    xcalib['pixel_position'] = struct.unpack_from("10d", header, offset=3103)
-
-    #double calib_value[10] # 3183 calibration VALUE at above pos */
-    xcalib['calib_value'] = struct.unpack_from("10d", header, offset=3183)
-
-    #double polynom_coeff[6] # 3263 polynom COEFFICIENTS */
-    xcalib['polynom_coeff'] = struct.unpack_from("6d", header, offset=3263)
-
-    #double laser_position # 3311 laser wavenumber for relativ WN */
-    xcalib['laser_position'] = struct.unpack_from("d", header, offset=3311)[0]
-
-    #char reserved3 # 3319 reserved */
-    xcalib['reserved3'] = struct.unpack_from("c", header, offset=3319)[0]
-
-    #unsigned char new_calib_flag # 3320 If set to 200, valid label below */
-    #xcalib['calib_value'] = struct.unpack_from("BYTE", header, offset=3320)[0] # how to do this?
-
-    #char calib_label[81] # 3321 Calibration label (NULL term'd) */
-    xcalib['calib_label'] = struct.unpack_from("81c", header, offset=3321)
-
-    #char expansion[87] # 3402 Calibration Expansion area */
-    xcalib['expansion'] = struct.unpack_from("87c", header, offset=3402)
-    ########### end of Kasey's addition
-
-    if verbose:
-        print "date      = ["+date+"]"
-        print "exp_sec   = ", exp_sec
-        print "pimaxGain = ", pimaxGain
-        print "gain (?)  = ", gain
-        print "data_type = ", data_type
-        print "comments  = ["+comments+"]"
-        print "analogGain = ", analogGain
-        print "noscan = ", noscan
-        print "detectorTemperature [C] = ", detectorTemperature
-        print "pimaxUsed = ", pimaxUsed
-
-    # Determine the data type format string for
-    # upcoming struct.unpack_from() calls
-    if data_type == 0:
-        # float (4 bytes)
-        dataTypeStr = "f"  #untested
-        bytesPerPixel = 4
-        dtype = "float32"
-    elif data_type == 1:
-        # long (4 bytes)
-        dataTypeStr = "l"  #untested
-        bytesPerPixel = 4
-        dtype = "int32"
-    elif data_type == 2:
-        # short (2 bytes)
-        dataTypeStr = "h"  #untested
-        bytesPerPixel = 2
-        dtype = "int32"
-    elif data_type == 3:  
-        # unsigned short (2 bytes)
-        dataTypeStr = "H"  # 16 bits in python on intel mac
-        bytesPerPixel = 2
-        dtype = "int32"  # for numpy.array().
-        # other options include:
-        # IntN, UintN, where N = 8,16,32 or 64
-        # and Float32, Float64, Complex64, Complex128
-        # but need to verify that pyfits._ImageBaseHDU.ImgCode cna handle it
-        # right now, ImgCode must be float32, float64, int16, int32, int64 or uint8
-    else:
-        print "unknown data type"
-        print "returning..."
-        sys.exit()
-  
-    # Number of pixels on x-axis and y-axis
-    nx = struct.unpack_from("H", header, offset=42)[0]
-    ny = struct.unpack_from("H", header, offset=656)[0]
-    
-    # Number of image frames in this SPE file
-    nframes = struct.unpack_from("l", header, offset=1446)[0]
-
-    if verbose:
-        print "nx, ny, nframes = ", nx, ", ", ny, ", ", nframes
-    
-    npixels = nx*ny
-    npixStr = str(npixels)
-    fmtStr  = npixStr+dataTypeStr
-    if verbose:
-        print "fmtStr = ", fmtStr
-    
-    # How many bytes per image?
-    nbytesPerFrame = npixels*bytesPerPixel
-    if verbose:
-        print "nbytesPerFrame = ", nbytesPerFrame
-
-    # Create a dictionary that holds some header information
-    # and contains a placeholder for the image data
-    spedict = {'data':[],    # can have more than one image frame per SPE file
-                'IGAIN':pimaxGain,
-                'EXPOSURE':exp_sec,
-                'SPEFNAME':spefilename,
-                'OBSDATE':date,
-                'CHIPTEMP':detectorTemperature,
-                'COMMENTS':comments,
-                'XCALIB':xcalib,
-                'ACCUMULATIONS':accumulations,
-                'FLATFIELD':flatFieldApplied,
-                'BACKGROUND':BackgroundApplied
-                }
-    
-    # Now read in the image data
-    # Loop over each image frame in the image
-    if verbose:
-        print "Reading image frames number ",
-    for ii in range(nframes):
-        iistr = str(ii)
-        data = spe.read(nbytesPerFrame)
-        if verbose:
-            print ii," ",
-    
-        # read pixel values into a 1-D numpy array. the "=" forces it to use
-        # standard python datatype size (4bytes for 'l') rather than native
-        # (which on 64bit is 8bytes for 'l', for example).
-        # See http://docs.python.org/library/struct.html
-        dataArr = array(struct.unpack_from("="+fmtStr, data, offset=0),
-                            dtype=dtype)
-
-        # Resize array to nx by ny pixels
-        # notice order... (y,x)
-        dataArr.resize((ny, nx))
-        #print dataArr.shape
-
-        # Push this image frame data onto the end of the list of images
-        # but first cast the datatype to float (if it's not already)
-        # this isn't necessary, but shouldn't hurt and could save me
-        # from doing integer math when i really meant floating-point...
-        spedict['data'].append( dataArr.astype(float) )
-
-    if verbose:
-        print ""
-  
-    return spedict
 
 class CommError(Exception): pass
 class noBackgroundError(Exception): pass
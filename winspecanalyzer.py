@@ -1,6 +1,7 @@
 ﻿from __future__ import division
 import numpy as np
 import os, time
+from multiprocessing.pool import ThreadPool
 from scipy import constants as scipycsts
 # Ignore import errors so that the public methods can be used even when winspec isn't installed
 try:
@@ -9,12 +10,20 @@ try:
 except ImportError as e:
     print("Error importing from winspec... \n" + e.args[0])
 from PyQt4 import QtCore
+from stitching import StitchPlanner, SpectrumAccumulator
 
 # Block size to use for finding the peak luminesence
 PEAK_LUM_BLOCK_SIZE = 5
+# Signal to noise ratio of the peak luminesence block at which its confidence is 0.5
+PEAK_CONFIDENCE_SNR = 10
 # Window defining the min and max boundaries for the optimal signal strength
 MAX_COUNTS=2**16            # 16-bit detector, so maximum number of counts is 2^16
 OPTIMAL_SIGNAL_WIN=(0.5*MAX_COUNTS,0.9*MAX_COUNTS)
+# Maximum number of times the exposure is reduced by ROI_EXPOSURE_STEP when the image used to find the ROI is saturating
+ROI_MAX_ATTEMPTS = 3
+ROI_EXPOSURE_STEP = 10
+# Number of pixels by which neighbouring sub-spectra should overlap when gluing, so that the seam can be blended
+STITCH_OVERLAP_PIXELS = 8
 # Max measurement time we are willing to accept
 WINSPEC_MAX_MEAS_TIME=100.0
 # List of tuples containing the filter wheel position, gain, and exposure time
@@ -49,6 +58,56 @@ def wattsToCPS(wavelength,watts,efficiency):
     """ Convert from watts to counts per second """
     return watts*efficiency/photonEnergy(wavelength)
 
+def blockSums(data,blockSize,axis=-1):
+    """ Sum every block of blockSize consecutive elements of data along axis using a cumulative sum. 
+    Element k of the result is the sum of elements k to k+blockSize-1, so the result is blockSize-1 shorter than data along axis """
+    cumulative=np.cumsum(np.asarray(data,dtype=float),axis=axis)
+    cumulative=np.insert(cumulative,0,0,axis=axis)
+    n=cumulative.shape[axis]
+    return np.take(cumulative,np.arange(blockSize,n),axis=axis)-np.take(cumulative,np.arange(n-blockSize),axis=axis)
+
+def blockCentroid(x,data,blockSize):
+    """ Find the block of blockSize elements with the largest sum in data, and return the sub-pixel centroid of the block interpolated 
+    on x, together with a confidence between 0 and 1. The confidence is snr/(snr+PEAK_CONFIDENCE_SNR), where snr is the excess of the 
+    block over the median block in units of the noise, which is estimated from the pixel to pixel differences """
+    data=np.asarray(data,dtype=float)
+    blockSize=min(blockSize,len(data))
+    sums=blockSums(data,blockSize)
+    start=np.argmax(sums)
+    block=np.maximum(data[start:start+blockSize],0)
+    centroid=start+np.dot(np.arange(blockSize),block)/np.sum(block) if np.sum(block)>0 else start+(blockSize-1)//2
+    excess=sums[start]-np.median(sums)
+    noise=np.sqrt(blockSize)*1.4826*np.median(np.abs(np.diff(data)))/np.sqrt(2) if len(data)>1 else 0
+    snr=excess/noise if noise>0 else (np.inf if excess>0 else 0)
+    confidence=1.0 if np.isinf(snr) else snr/(snr+PEAK_CONFIDENCE_SNR)
+    return (float(np.interp(centroid,np.arange(len(x)),x)),float(confidence))
+
+def optimalBand(image):
+    """ Find the band of rows (axis 1) of a background subtracted image which gives the best SNR when binned together. 
+    The SNR of a band with n rows and signal S is S/sqrt(n*rowVariance+S), where the noise variance of each row is estimated 
+    from the pixel to pixel differences. The band is grown outwards from the brightest row, a row at a time on whichever side is 
+    brighter, which gives the best band of every height for a single spot in linear time.
+    Returns (top, bottom) indices of the band, numbered from 1 and inclusive as for a Winspec ROI """
+    image=np.asarray(image,dtype=float)
+    rowSignal=np.sum(image,0)
+    pixelSigma=1.4826*np.median(np.abs(np.diff(image,axis=0)))/np.sqrt(2)
+    rowVariance=max(image.shape[0]*pixelSigma**2,1e-12)
+    last=len(rowSignal)-1
+    top=bottom=int(np.argmax(rowSignal))
+    signal=rowSignal[top]
+    best=(-np.inf,top,bottom)
+    while True:
+        snr=signal/np.sqrt((bottom-top+1)*rowVariance+max(signal,0))
+        if snr>best[0]: best=(snr,top,bottom)
+        if top==0 and bottom==last: break
+        if bottom==last or (top>0 and rowSignal[top-1]>=rowSignal[bottom+1]):
+            top-=1
+            signal+=rowSignal[top]
+        else:
+            bottom+=1
+            signal+=rowSignal[bottom]
+    return (best[1]+1,best[2]+1)
+
 class WinspecAnalyzer(QtCore.QObject):
     """ High level convenience class for Winspec which gives it auto-range capability and conversion from cps to watts etc """
     updateProgress=QtCore.pyqtSignal(float)
@@ -62,18 +121,24 @@ class WinspecAnalyzer(QtCore.QObject):
         # self.attenuator controls an external attenuator with controllable attenuation
         self.attentuator=FilterWheel()
         # Set some default values
+        self.roi=None
+        # ROI found by autoSetROI as a tuple of (key, roi), so it's reused until the alignment, detector or grating changes
+        self._roiCache=None
+        self.rangeIndex=DEFAULT_RANGE
+        self.bgMeasRequired=True
         self.setRange(DEFAULT_RANGE,forceSet=True)        
         self.efficiency=DEFAULT_EFFICIENCY
         self.running=True
         self.numSpectra=1
         self.gratingNumber=self._getGratingNumber()
         self.centerLambda=self.getCenter()
+        # Precompute the dispersion tables used to plan and resample stitched spectra
+        self.stitcher=StitchPlanner(self._connection.detector)
         # Set the Winspec filename to temporary
         self.rawDataDir=rawDataDir
         self.setDataFilename()
         self.setBackgroundFilename()
         self._connection.setOverwriteWarning(False)
-        self.roi = None
      
     def readPowerAuto(self,*args, **kwargs):
         """ Read a Winspec spectrum, automatically setting the gain and exposure time to reasonable values, and return the power """
@@ -84,60 +149,108 @@ class WinspecAnalyzer(QtCore.QObject):
     def obtainSpectrum(self,tau=DEFAULT_TAU,calibratedPower=None,timeout=DEFAULT_TIMEOUT):
         """ Acquire a spectrum by gluing together as many sub-spectra as necessary to get the full span.
         Uses the currently set center,span,and resolution in the instance object.
+        If calibratedPower isn't given then the efficiency of the last calibration is carried forward to convert the counts to power, and
+        the power which the calibration would have measured is estimated from it, as "calibratedPower" in the returned dictionary.
         Return the wavelength [m], power [W], and a dictionary containing useful information about the measurement for storage """
-        # Force the physical settings of Winspec to be that of current range
+        # Force the physical settings of Winspec to be that of current range. The background is only remeasured if they'd changed
         self.setRange(self.rangeIndex,forceSet=True)
         self.inputStateSwitch(True)
         # Acquire measurements
         if self.numSpectra == 1:
             wavelength,counts,spectrumDict=self.readSingleWinspecSpectrumAuto(tau)
+            cps=counts*self._cpsScale()
         else:
-            # Setup empty variables to hold the data
-            pixels=self._connection.getNumberOfPixels()
-            wavelength=np.zeros(self.numSpectra*pixels)
-            counts=np.zeros(self.numSpectra*pixels)
-            # Acquire the central spectrum
-            assert (self.numSpectra % 2)!=0
-            centerIndex=int((self.numSpectra-1)/2)
-            self._setDataFilename(self.dataFilename+"_"+str(centerIndex))
-            wavelength_i,counts_i,spectrumDict=self.readSingleWinspecSpectrumAuto(tau)
-            wavelength[pixels*centerIndex:pixels*(centerIndex+1)]=wavelength_i
-            counts[pixels*centerIndex:pixels*(centerIndex+1)]=counts_i
-            # Find the center position we need to get all the other spectra to lineup nicely
-            allCenterLambda=self.findCenterWavelengths(self.numSpectra,self.centerLambda,min(wavelength_i),max(wavelength_i))
-            # Now measure the rest of the spectra, but using identical settings from the central spectrum
-            for idx in range(self.numSpectra):
-                if idx != centerIndex:
-                    # abort the test if that's what the user wants
-                    if not self.running:
-                        raise MeasurementAbortedError
-                    # update sub-progress
-                    self.updateProgress.emit((idx+1.0)/(self.numSpectra+1))
-                    # set the filename
-                    self._setDataFilename(self.dataFilename+"_"+str(idx))
-                    self.statusMessage.emit("Acquiring data for subspectrum " + str(idx+1)+"/"+str(self.numSpectra))
-                    self._setCenter(allCenterLambda[idx])
-                    wavelength_i,counts_i,spectrumDict_i=self.readSingleWinspecSpectrumAuto(tau,rangeMode="fixed")
-                    wavelength[pixels*idx:pixels*(idx+1)]=wavelength_i
-                    counts[pixels*idx:pixels*(idx+1)]=counts_i
-                    self.plotDataReady.emit({"x":{"data":wavelength_i,"label":"Wavelength [nm]"},"y":{"data":counts_i,"label":"counts"}})
-                    QtCore.QCoreApplication.processEvents()
-            # move the spectrometer back to the center
-            self._setCenter(self.centerLambda)
+            wavelength,counts,cps,spectrumDict=self._obtainStitchedSpectrum(tau)
         # convert wavelength from nm to m
         wavelength=wavelength/1e9
-        # Calculate CPS
-        cps=counts/self.getExposureTime()/self.getAttenuation()/self.getAbsoluteGain()
-        # If a calibration power was specified then calculate the efficiency from it
+        # If a calibration power was specified then calculate the efficiency from it. It can also be a function which returns
+        # the power, so that the power can be measured while the spectrum is acquired
+        if callable(calibratedPower):
+            calibratedPower=calibratedPower()
         if calibratedPower!=None:
             self.efficiency=calculateOpticalEfficiency(wavelength,cps,calibratedPower)
+        else:
+            calibratedPower=calculateOpticalEfficiency(wavelength,cps,1.0)/self.efficiency
         # Calculate the absolute power using the efficiency (a default value is used if calibratedPower not given)
         intensity=cpsToWatts(wavelength,cps,self.efficiency)
         # Add some more stuff to spectrumDict
         spectrumDict["efficiency"]=self.efficiency
+        spectrumDict["calibratedPower"]=calibratedPower
         spectrumDict["SNR"]=max(counts)/np.std(spectrumDict["noiseFloor"])
         # Return the final result
-        return (wavelength,intensity,spectrumDict)                    
+        return (wavelength,intensity,spectrumDict)
+
+    def _obtainStitchedSpectrum(self,tau):
+        """ Acquire numSpectra sub-spectra and stitch them together, returning wavelength [nm], counts, cps and the spectrumDict of the central spectrum.
+        The sub-spectra after the central one are pipelined: as soon as Winspec has finished acquiring sub-spectrum k, reading it from the
+        file on disk and stitching it is handed to a worker thread, and the spectrometer is moved to the center of k+1 and its acquisition
+        started, so that the readout and processing of k overlap with the move and exposure of k+1 """
+        # Plan the center wavelengths and the common wavelength grid for the stitched spectrum
+        pixels=self._connection.getNumberOfPixels()
+        overlap=STITCH_OVERLAP_PIXELS*self._connection.detector["resolution"][self.gratingNumber-1]
+        allCenterLambda=self.findCenterWavelengths(self.numSpectra,self.centerLambda*1e-9,overlap)
+        accumulator=SpectrumAccumulator(self.stitcher.wavelengthGrid(self.gratingNumber,allCenterLambda,self.numSpectra*pixels))
+        # Acquire the central spectrum
+        centerIndex=int((self.numSpectra-1)/2)
+        self._setDataFilename(self.dataFilename+"_"+str(centerIndex))
+        wavelength_i,counts_i,spectrumDict=self.readSingleWinspecSpectrumAuto(tau)
+        # The central spectrum fixes the range for all the others, so the cps scaling only needs to be read from Winspec once
+        scale=self._cpsScale()
+        accumulator.add(wavelength_i,counts_i)
+        # Now measure the rest of the spectra, but using identical settings from the central spectrum
+        order=[idx for idx in range(self.numSpectra) if idx != centerIndex]
+        worker=ThreadPool(1)
+        pending=[]
+        try:
+            for k in range(len(order)):
+                idx=order[k]
+                # abort the test if that's what the user wants
+                if not self.running:
+                    raise MeasurementAbortedError
+                # update sub-progress
+                self.updateProgress.emit((k+2.0)/(self.numSpectra+1))
+                # set the filename
+                self._setDataFilename(self.dataFilename+"_"+str(idx))
+                self.statusMessage.emit("Acquiring data for subspectrum " + str(idx+1)+"/"+str(self.numSpectra))
+                self._setCenter(allCenterLambda[idx])
+                readSpectrum=self._startFixedRangeSpectrum(tau)
+                pending.append(worker.apply_async(self._stitchSubSpectrum,(accumulator,readSpectrum)))
+                QtCore.QCoreApplication.processEvents()
+            # Wait for the worker to finish with the last sub-spectrum (re-raising any exception from the worker)
+            for result in pending:
+                result.get()
+        finally:
+            worker.close()
+            worker.join()
+            # move the spectrometer back to the center
+            self._setCenter(self.centerLambda)
+        counts=accumulator.result()
+        return (accumulator.grid,counts,counts*scale,spectrumDict)
+
+    def _startFixedRangeSpectrum(self,tau):
+        """ Start reading a spectrum with the current range, like readSingleWinspecSpectrumAuto(tau,rangeMode="fixed"), and return a
+        function which reads it out from the file and checks it once Winspec has finished the acquisition. The function doesn't use Winspec,
+        so that it can be called by the stitching worker while the spectrometer moves on """
+        if self.has2dDetector() and not self.roi: raise ValueError, "You must set the ROI when using a 2D detector"
+        if self.bgMeasRequired:
+            # Turn off the input signal, measure background, then turn it back on again
+            self.inputStateSwitch(False)
+            self._connection.acquireBackgroundSpectrum()
+            self.inputStateSwitch(True) 
+            self.bgMeasRequired = False
+        readSpectrum=self._connection.acquireSpectrumDeferred(self.accumulations(tau))
+        def readChecked():
+            wavelength,counts,spectrumDict=readSpectrum()
+            if spectrumDict["saturating"]:
+                raise CommError, "The measured power was outside the measurement range with rangeMode=fixed"
+            return (wavelength,counts,spectrumDict)
+        return readChecked
+
+    def _stitchSubSpectrum(self,accumulator,readSpectrum):
+        """ Read out a sub-spectrum started by _startFixedRangeSpectrum, add it to the accumulator and plot it """
+        wavelength,counts,spectrumDict=readSpectrum()
+        accumulator.add(wavelength,counts)
+        self.plotDataReady.emit({"x":{"data":wavelength,"label":"Wavelength [nm]"},"y":{"data":counts,"label":"counts"}})
 
     def readSingleWinspecSpectrumAuto(self,tau=DEFAULT_TAU,timeout=DEFAULT_TIMEOUT,rangeMode="auto", mode=None):
         """ Reads the counts using auto-range functionality and averaged over specified time interval tau in ms, remeasuring as required if any errors.
@@ -201,48 +314,60 @@ class WinspecAnalyzer(QtCore.QObject):
         attenuation,gain,exposure=GAIN_SETTINGS[rangeIndex]
         if forceSet or attenuation!=self.getAttenuatorPosition(): 
             self.attentuator.setPosition(attenuation)
-        if forceSet or gain!=self.getGainSetting(): 
+        gainChanged=gain!=self.getGainSetting()
+        if forceSet or gainChanged: 
             self._connection.setGain(gain)
-            self.bgMeasRequired = True
-        if forceSet or exposure!=self.getExposureTime():
+        exposureChanged=exposure!=self.getExposureTime()
+        if forceSet or exposureChanged:
             self._connection.setExposureTime(exposure)
+        # forceSet writes the settings again in case they were changed in Winspec itself, but the background is still valid unless they differed
+        if gainChanged or exposureChanged:
             self.bgMeasRequired = True
         self.rangeIndex=rangeIndex
 
-    def autoSetROI(self):
-        # TODO: implement this
-        # image = self._connection.acquireImage()
-        # Find either max x pixel strip or the middle of the saturating strip
-        # Need to acquire image background before entering this method
-        roi = (222,229)
+    def autoSetROI(self, alignment=None):
+        """ Find the vertical ROI on a 2D detector which gives the best SNR when binned (see optimalBand), using a background 
+        subtracted image at the current exposure. If alignment identifies the current alignment (e.g. the stage coordinates), then 
+        the ROI is cached and reused until the alignment, the detector or the grating changes """
+        key=(alignment,self.getNumberOfPixels(),self._connection.getDetectorHeight(),self.gratingNumber)
+        if alignment is not None and self._roiCache is not None and self._roiCache[0]==key:
+            self.setROI(self._roiCache[1])
+            return self._roiCache[1]
+        exposure=self.getExposureTime()
+        for attempt in range(ROI_MAX_ATTEMPTS):
+            # Turn off the input signal, measure background, then turn it back on again
+            self.inputStateSwitch(False)
+            self._connection.acquireImageBackground(exposure)
+            self.inputStateSwitch(True)
+            image=self._connection.acquireImage(exposure)
+            if np.max(image) < OPTIMAL_SIGNAL_WIN[1]: break
+            exposure=exposure/ROI_EXPOSURE_STEP
+        # The background file now holds an image, and the exposure may have changed, so restore the range
+        self.setRange(self.rangeIndex,forceSet=True)
+        roi=optimalBand(image)
+        self.statusMessage.emit("Automatically set the ROI to rows %d to %d" % roi)
+        if alignment is not None: self._roiCache=(key,roi)
         self.setROI(roi)
-        
+        return roi
+
     def setROI(self, roi):
+        if roi!=self.roi: self.bgMeasRequired = True
         self.roi = roi
         if self.has2dDetector(): self._connection.setVerticalROI(*roi)
 
     def measureOptimalCenter(self, tau = DEFAULT_TAU):
-        """ Use the lowest resolution grating to find the wavelength of maximum luminesence """
+        """ Use the lowest resolution grating to find the wavelength of maximum luminesence. 
+        Returns a tuple with the sub-pixel wavelength [nm] and a confidence between 0 and 1 (see blockCentroid) """
         grating = self._getGratingNumber()
         self._setGratingNumber(3)
         wavelength,counts,spectrumDict=self.readSingleWinspecSpectrumAuto(tau)
-        maxIdx = self._argMaxBlock(counts, PEAK_LUM_BLOCK_SIZE)
         self._setGratingNumber(grating)
-        return wavelength[maxIdx]
+        return blockCentroid(wavelength, counts, PEAK_LUM_BLOCK_SIZE)
 
     def _argMaxBlock(self, data, blockSize):
         """ Find the index of the data array such that the sum of the elements in the block centred at the index is global max """
         if len(data) < blockSize: return np.argmax(data)
-        blockSum = np.sum(data[:blockSize])
-        maxSum = blockSum
-        maxIdx = blockSize - 1
-        for i in xrange(blockSize, len(data)):
-            blockSum -= data[i-blockSize]
-            blockSum += data[i]
-            if blockSum > maxSum:
-                maxSum = blockSum
-                maxIdx = i
-        return maxIdx - blockSize//2
+        return np.argmax(blockSums(data, blockSize)) + (blockSize-1)//2
 
 
     def setDataFilename(self,filename="temp"):
@@ -271,6 +396,10 @@ class WinspecAnalyzer(QtCore.QObject):
         """ Gets the center wavlength """
         return self._connection.getCenter()
         
+    def getNumberOfPixels(self):
+        """ Number of pixels across the detector, i.e. the number of points in a single sub-spectrum """
+        return self._connection.getNumberOfPixels()
+
     def setNumPoints(self,numPoints):
         """ Set the number of points (i.e. spectra) to measure... must be a multiple of the number of pixels """
         self.numSpectra=int(numPoints/self._connection.getNumberOfPixels())
@@ -314,6 +443,10 @@ class WinspecAnalyzer(QtCore.QObject):
         self._connection.setExposureTime(exposure)
         self.bgMeasRequired = True
 
+    def _cpsScale(self):
+        """ Return the factor which converts counts at the current range into counts per second at the detector input """
+        return 1/self.getExposureTime()/self.getAttenuation()/self.getAbsoluteGain()
+
     def accumulations(self,tau):
         """ Calculate the number of accumulations necessary to keep the measurement time above tau given current exposure time """
         return int(np.ceil(tau/1000/GAIN_SETTINGS[self.rangeIndex][2]))
@@ -324,27 +457,7 @@ class WinspecAnalyzer(QtCore.QObject):
     def has2dDetector(self):
         return self._connection.getDetectorHeight() > 1
 
-    def findCenterWavelengths(self,numSpectra,centerLambda,leftMinima,rightMaxima):
-        """ Given numSpectra, finds the position to set the spectrometer at for each spectrum.
-        Also requires the center, min, and max lambda for the central starting point [all in m]"""
-        # Get some polynomials which specify the relation between the center wavelength and the real measured wavelength minima/maxima
-        pCenterFromMinima,pCenterFromMaxima,pMinimaFromCenter,pMaximaFromCenter=self._connection.getDispersionCalibration()
-        # Set the center wavelength of the central spectrum to the user specified center wavelength (numSpectra must be odd)
-        allCenterLambda=np.zeros(numSpectra)
-        numSideSpectra=int((numSpectra-1)/2) # number of spectra on either side of the central one
-        allCenterLambda[numSideSpectra]=centerLambda*1e9
-        # Step through the side spectra outwards from the central spectrum in pairs (left and right) and calculate the desired center wavelengths
-        for idx in range(numSideSpectra):
-            # Want the maxima/minima of each spectra to line up with the minima/maxima of the next spectra
-            idealLeftMaxima=leftMinima
-            idealRightMinima=rightMaxima
-            # Calculate where we should center the spectrometer to get the edges to line up
-            leftCenter=np.polyval(pCenterFromMaxima,idealLeftMaxima)
-            rightCenter=np.polyval(pCenterFromMinima,idealRightMinima)
-            # assign these to the allCenterLambda arrays
-            allCenterLambda[numSideSpectra-idx-1]=leftCenter
-            allCenterLambda[numSideSpectra+idx+1]=rightCenter
-            # Calculate the outer edge for both of the current spectra
-            leftMinima=np.polyval(pMinimaFromCenter,leftCenter)
-            rightMaxima=np.polyval(pMaximaFromCenter,rightCenter)
-        return allCenterLambda
\ No newline at end of file
+    def findCenterWavelengths(self,numSpectra,centerLambda,overlap=0):
+        """ Given numSpectra and the center of the central spectrum [m], finds the position [nm] to set the spectrometer at for each spectrum
+        so that neighbouring spectra line up, optionally overlapping by the specified wavelength [nm]. Plans are cached for each grating, center and numSpectra """
+        return self.stitcher.centerWavelengths(self.gratingNumber,centerLambda*1e9,numSpectra,overlap)